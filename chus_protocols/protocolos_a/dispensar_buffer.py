@@ -1,22 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-
-# Load library
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import protocol_plan
+from library.protocols import liquid_level
+from library.protocols import run_report
 
 
 metadata = {
@@ -56,24 +53,26 @@ tube_type_dest = 'criotubo'                     # Selected destination tube for
 # ------------------------
 air_gap_vol_ci = 1
 x_offset = [0, 0]
+pickup_submersion = 2.5                         # mm below the liquid level left by each aspiration
 
 
 # ----------------------------
 # Main
 # ----------------------------
 (buffer) = lab_stuff.buffer(buffer_name)
-(area_source, vcono_source, hcono_source, _, _) = lab_stuff.tubes(tube_type_source)
-(_, _, _, dispense_height, _) = lab_stuff.tubes(tube_type_dest)
-tube_physical_description = {
-    'h_cono': hcono_source,
-    'v_cono': vcono_source
-}
+tube_source = lab_stuff.tube(tube_type_source)
+dispense_height = lab_stuff.tube(tube_type_dest).hdisp
+source_container = liquid_level.Container(diameter=tube_source.diameter,
+                                          bottom='cone', bottom_height=tube_source.hcono)
 
 
 def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_destinations)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_1000ul', slot, '1000µl filter tiprack') for slot in ['11']]
 
@@ -81,34 +80,52 @@ def run(ctx: protocol_api.ProtocolContext):
     p1000 = ctx.load_instrument('p1000_single_gen2', 'right', tip_racks=tips)
 
     # Source (in this case falcon 50ml of buffer)
-    reagents = ctx.load_labware('opentrons_6_tuberack_falcon_50ml_conical', '8', 'Buffer tuberack in Falcon tube')
+    plan = protocol_plan.Plan()
+    reagents = plan.register('buffer', ctx.load_labware('opentrons_6_tuberack_falcon_50ml_conical', '8',
+                                                        'Buffer tuberack in Falcon tube'))
     source_labware = reagents.wells()[0]
 
     # Destination (in this case 96 x tuberack of 2ml)
     rack_num = math.ceil(num_destinations / NUM_OF_SOURCES_PER_RACK) if num_destinations < MAX_NUM_OF_SOURCES else MIN_NUM_OF_SOURCES
-    dest_racks = common.generate_source_table([ctx.load_labware(
+    dest_racks = common.generate_source_table([plan.register('dest' + str(i + 1), ctx.load_labware(
         'opentrons_24_tuberack_generic_2ml_screwcap', slot,
-        'source tuberack with screwcap' + str(i + 1)) for i, slot in enumerate(['5', '6', '2', '3'][:rack_num])
+        'source tuberack with screwcap' + str(i + 1))) for i, slot in enumerate(['5', '6', '2', '3'][:rack_num])
     ])
 
     destinations = dest_racks[:num_destinations]
 
+    # ------------------
+    # Compile
+    # ------------------
+    initial_volume = buffer['vol_well']
+    # Calculate every pickup_height based on remaining volume and shape of container
+    pickup_heights, _ = liquid_level.pickup_heights(source_container, initial_volume,
+                                                    [volume_to_be_moved] * len(destinations),
+                                                    submersion=pickup_submersion)
+    plan.pick_up('p1000')
+    for destination_labware, pickup_height in zip(destinations, pickup_heights):
+        plan.aspirate('p1000', source_labware, volume_to_be_moved, float(pickup_height), x_offset=x_offset[0], rate=1.2)
+        if air_gap_vol_ci != 0:
+            plan.aspirate('p1000', source_labware, air_gap_vol_ci, -2, reference='top',
+                          rate=buffer.get('flow_rate_aspirate'))
+        if buffer.get('delay'):
+            plan.delay(buffer.get('delay'))
+        plan.dispense('p1000', destination_labware, volume_to_be_moved + air_gap_vol_ci, dispense_height,
+                      x_offset=x_offset[1], rate=buffer.get('flow_rate_dispense'))
+        plan.blow_out('p1000', destination_labware)
+        plan.touch_tip('p1000')
+    plan.drop('p1000')
+
+    # Air gaps are aspirated from the source but do not consume buffer
+    plan.validate({'p1000': p1000.max_volume},
+                  {('buffer', 0): initial_volume + air_gap_vol_ci * len(destinations)})
+
     # ------------------
     # Protocol
     # ------------------
-    if not p1000.hw_pipette['has_tip']:
-        common.pick_up(p1000)
-
-    for destination_labware in destinations:
-        # Calculate pickup_height based on remaining volume and shape of container
-        pickup_height, _ = common.calc_height(ctx, buffer, tube_physical_description,
-                                              area_source, volume_to_be_moved)
-        common.move_vol_multichannel(ctx, p1000, reagent=buffer, source=source_labware, dest=destination_labware,
-                                     vol=volume_to_be_moved, air_gap_vol=air_gap_vol_ci,
-                                     pickup_height=pickup_height, disp_height=dispense_height,
-                                     x_offset=x_offset, blow_out=True, touch_tip=True)
-    # Drop pipette tip
-    p1000.drop_tip()
+    plan.execute(ctx, {'p1000': p1000})
+
+    report.finish()
 
     # Notify users
     # common.notify_finish_process()
@@ -1,22 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-
-# Load library
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import pooling
+from library.protocols import run_report
 
 
 metadata = {
@@ -48,7 +44,12 @@ tube_type_source = 'criotubo'                # Selected source tube for this pro
 # ------------------------
 num_samples = 95                            # total number of destinations
 final_volume = 1000                         # final volume in uL in the tube
-pooling_factor = 10                         # num of destinations per source
+pooling_mode = 'fixed'                      # 'fixed': consecutive pools, 'matrix': every sample to a row and a column pool
+pooling_factor = 10                         # samples per pool in 'fixed' mode, a list for variable sizes: [10, 10, 5]
+prevalence = None                           # 'fixed' mode: expected positive rate (e.g. 0.02) to choose the pool size
+matrix_rows = 8                             # 'matrix' mode: rows of each matrix of samples
+matrix_cols = 12                            # 'matrix' mode: columns of each matrix of samples
+max_volume_per_sample = 500                 # uL each sample tube can give to all its pools
 dispense_height = -10                       # dispense height in the deepwell
 
 # ------------------------
@@ -61,7 +62,7 @@ x_offset = [0, 0]
 # ----------------------------
 # Main
 # ----------------------------
-(_, _, _, _, pickup_height) = lab_stuff.tubes(tube_type_source)
+pickup_height = lab_stuff.tube(tube_type_source).hpick
 (sample) = lab_stuff.buffer(reagent_name)
 
 
@@ -69,6 +70,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_samples)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_200ul', slot, '200µl filter tiprack') for slot in ['11']]
 
@@ -86,7 +90,7 @@ def run(ctx: protocol_api.ProtocolContext):
 
     # Destination (in this case Xs well plate)
     dest_plate = ctx.load_labware('abgene_96_wellplate_800ul', '9', 'ABGENE 96 Well Plate 800 µL')
-    destinations = dest_plate.wells()[:num_samples]
+    destinations = dest_plate.wells()
 
     # ------------------
     # Protocol
@@ -94,39 +98,38 @@ def run(ctx: protocol_api.ProtocolContext):
     if not p300.hw_pipette['has_tip']:
         common.pick_up(p300)
 
-    custom_sources = split_list(sample_sources, pooling_factor)
-
-    for sources, dest in zip(custom_sources, destinations):
-        for source in sources:
+    if pooling_mode == 'matrix':
+        pools = pooling.plan_matrix(num_samples, matrix_rows, matrix_cols)
+    else:
+        pool_size = pooling.optimal_pool_size(prevalence) if prevalence else pooling_factor
+        pools = pooling.plan_pools(num_samples, pool_size)
+    if len(pools) > len(destinations):
+        raise ValueError('{} pools do not fit in {} destinations'.format(len(pools), len(destinations)))
+    transfers = pooling.sample_transfers(pools, final_volume)
+    pooling.check_sample_volumes(transfers, max_volume_per_sample)
+    pooling.save_pool_map(ctx, metadata['protocolName'],
+                          pooling.pool_map(pools, sample_sources, destinations, pooling_mode))
+
+    # Each sample is aspirated once for all its pools (its row and its column in 'matrix' mode) when it fits in
+    # the tip. A tip that touched a pool never goes back into the sample tube: every further trip takes a new tip
+    for sample_index, pool_volumes in transfers:
+        trips = common.plan_multi_dispense(len(pool_volumes), [v for _, v in pool_volumes], p300.max_volume,
+                                           air_gap_vol=air_gap_vol_sample)
+        for trip in trips:
             if not p300.hw_pipette['has_tip']:
                 common.pick_up(p300)
 
-            # Calculate pickup_height based on remaining volume and shape of container
-            common.move_vol_multichannel(ctx, p300, reagent=sample, source=source, dest=dest,
-                                         vol=volume_to_be_transfered / pooling_factor, air_gap_vol=air_gap_vol_sample,
-                                         pickup_height=pickup_height, disp_height=dispense_height,
-                                         x_offset=x_offset, blow_out=True, touch_tip=True)
+            common.multi_dispense(ctx, p300, reagent=sample, source=sample_sources[sample_index],
+                                  dests=[destinations[pool_volumes[i][0]] for i, _ in trip], vol=[v for _, v in trip],
+                                  air_gap_vol=air_gap_vol_sample, x_offset=x_offset, pickup_height=pickup_height,
+                                  disp_height=dispense_height, blow_out=False, touch_tip=True)
+            # Blow out the last drops into the pool, not back into the sample tube
+            p300.blow_out(destinations[pool_volumes[trip[-1][0]][0]].top(z=-2))
             # Drop pipette tip
             p300.drop_tip()
 
+    report.finish()
+
     # Notify users
     # common.notify_finish_process()
 
-
-# ----------------------------
-# Aux functions
-# ----------------------------
-def split_list(l: list, n: int):
-    """
-    Split list in several chunks of n elements
-
-    :param l: list to split in chunks
-    :param n: number of elements per chunk
-
-    :return: chunk list's generator
-
-    :example of use:
-    list(split_list(list(range(0,100)), 10))
-    """
-    for i in range(0, len(l), n):
-        yield l[i:i+n]
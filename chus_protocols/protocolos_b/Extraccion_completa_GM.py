@@ -36,6 +36,18 @@ import numpy as np
 from timeit import default_timer as timer
 from datetime import datetime
 import csv
+import sys
+
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import instrumentation
+from library.protocols import liquid_level
+from library.protocols import run_report
+from library.protocols import checkpoint
+from library.protocols import tip_store
 
 
 # #####################################################
@@ -54,6 +66,7 @@ metadata = {
 # #####################################################
 NUM_SAMPLES = 96
 RESET_TIPCOUNT = True
+RESUME = False # Go on from the last completed step of a stopped run
 PROTOCOL_ID = "GM"
 recycle_tip = False # Do you want to recycle tips? It shoud only be set True for testing
 photosensitivity = False
@@ -68,10 +81,9 @@ robot = None
 switch = True
 # initialize tip_log dictionary
 tip_log = {}
-tip_log['count'] = {}
-tip_log['tips'] = {}
-tip_log['max'] = {}
 tip_log['used'] = {}
+# tip state of the robot, persisted across runs
+tip_state = None
 #pip speed
 aspirate_default_speed = 1
 dispense_default_speed = 1
@@ -115,17 +127,12 @@ class Tube:
         self._diameter = diameter
         self._base_type = base_type
         self._height_base = height_base
-        self._min_height = min_height
         self._reservoir = reservoir
 
-        if base_type == 1:
-            self._volume_base = (math.pi * diameter**3) / 12
-            self._height_base = diameter / 2
-        elif base_type == 2:
-            self._volume_base = (math.pi * diameter**2 * height_base) / 12
-        else:
-            self._volume_base = 0
-            self._height_base = 0
+        # Liquid-level model of the tube, the hemisphere takes diameter / 2 as its height
+        self._container = liquid_level.Container(diameter=diameter,
+                                                 bottom={1: 'hemisphere', 2: 'cone'}.get(base_type, 'flat'),
+                                                 bottom_height=height_base, min_height=min_height)
 
     @property
     def reservoir(self):
@@ -139,17 +146,10 @@ class Tube:
     def actual_volume(self, value):
         self._actual_volume = value
 
-    def calc_height(self, aspirate_volume):
-        volume_cylinder = self._actual_volume - self._volume_base
-        if volume_cylinder <= aspirate_volume:
-            height = self._min_height
-        else:
-            cross_section_area = (math.pi * self._diameter**2) / 4   
-            height = ((self._actual_volume - aspirate_volume - self._volume_base) / cross_section_area) + self._height_base
-            if height < self._min_height:
-                height = self._min_height
-
-        return height
+    def calc_height(self, aspirate_volume, submersion=0):
+        # Height at the level left by the aspiration, as the tubes were validated, or [submersion] mm below it
+        # (see library/protocols/liquid_level.py)
+        return float(self._container.pickup_height(self._actual_volume - aspirate_volume, submersion))
 
 
 class Reagent:
@@ -278,88 +278,19 @@ def finish_run():
             time.sleep(0.3)
     return finish_time
 
-def reset_tipcount(file_path = '/data/' + PROTOCOL_ID + '/tip_log.json'):
-    if os.path.isfile(file_path):
-        os.remove(file_path)
-
-def retrieve_tip_info(pip,tipracks,file_path = '/data/' + PROTOCOL_ID + '/tip_log.json'):
-    global tip_log
-    if not tip_log['count'] or pip not in tip_log['count']:
-        tip_log['count'][pip] = 0
-        if not robot.is_simulating():
-            folder_path = os.path.dirname(file_path)
-            if not os.path.isdir(folder_path):
-                os.mkdir(folder_path)
-            if os.path.isfile(file_path):
-                with open(file_path) as json_file:
-                    data = json.load(json_file)
-                    if "P1000" in str(pip):
-                        tip_log['count'][pip] = 0 if not 'tips1000' in data.keys() else data['tips1000']
-                    elif 'P300' in str(pip) and 'Single-Channel' in str(pip):
-                        tip_log['count'][pip] = 0 if not 'tips300' in data.keys() else data['tips300']
-                    elif 'P300' in str(pip) and '8-Channel' in str(pip):
-                        tip_log['count'][pip] = 0 if not 'tipsm300' in data.keys() else data['tipsm300']
-                    elif 'P20' in str(pip) and 'Single-Channel' in str(pip):
-                        tip_log['count'][pip] = 0 if not 'tips20' in data.keys() else data['tips20']
-                    elif 'P20' in str(pip) and '8-Channel' in str(pip):
-                        tip_log['count'][pip] = 0 if not 'tipsm20' in data.keys() else data['tipsm20']                        
-        if "8-Channel" in str(pip):
-            tip_log['tips'][pip] =  [tip for rack in tipracks for tip in rack.rows()[0]]
-        else:
-            tip_log['tips'][pip] = [tip for rack in tipracks for tip in rack.wells()]
-
-        tip_log['max'][pip] = len(tip_log['tips'][pip])
-
+def pick_up(pip,tiprack):
+    # Used tips are persisted by tip_state (see library/protocols/tip_store.py)
     if not tip_log['used'] or pip not in tip_log['used']:
         tip_log['used'][pip] = 0
-
-    return tip_log
-
-
-def save_tip_info(file_path = '/data/' + PROTOCOL_ID + '/tip_log.json'):
-    data = {}
-    if not robot.is_simulating():
-        if os.path.isfile(file_path):
-            with open(file_path) as json_file:
-                data = json.load(json_file)
-            os.rename(file_path,file_path + ".bak")
-        for pip in tip_log['count']:
-            if "P1000" in str(pip):
-                data['tips1000'] = tip_log['count'][pip]
-            elif 'P300' in str(pip) and 'Single-Channel' in str(pip):
-                data['tips300'] = tip_log['count'][pip]
-            elif 'P300' in str(pip) and '8-Channel' in str(pip):
-                data['tipsm300'] = tip_log['count'][pip]
-            elif 'P20' in str(pip) and 'Single-Channel' in str(pip):
-                data['tips20'] = tip_log['count'][pip]
-            elif 'P20' in str(pip) and '8-Channel' in str(pip):
-                data['tipsm20'] = tip_log['count'][pip]
-
-        with open(file_path, 'a+') as outfile:
-            json.dump(data, outfile)
-
-
-def pick_up(pip,tiprack):
-    ## retrieve tip_log
-    global tip_log
-    if not tip_log:
-        tip_log = {}
-    tip_log = retrieve_tip_info(pip,tiprack)
-    if tip_log['count'][pip] == tip_log['max'][pip]:
+    if all(rack.next_tip(pip.channels) is None for rack in tiprack):
         notification('replace_tipracks')
         robot.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
 resuming.')
         confirm_door_is_closed()
         pip.reset_tipracks()
-        tip_log['count'][pip] = 0
-    pip.pick_up_tip(tip_log['tips'][pip][tip_log['count'][pip]])
-    # Optional only to prevente cacelations
-    # save_tip_info()
-    tip_log['count'][pip] += 1
-    if "8-Channel" not in str(pip):
-        tip_log['used'][pip] += 1
-    else:
-        tip_log['used'][pip] += 8
+        tip_state.reset(tiprack)
+    pip.pick_up_tip()
+    tip_log['used'][pip] += pip.channels
 
 
 def drop(pip):
@@ -678,13 +609,11 @@ def run(ctx: protocol_api.ProtocolContext):
     # Initial data
     global robot
     global tip_log
+    global tip_state
 
     # Set robot as global var
     robot = ctx
-
-    # check if tipcount is being reset
-    if RESET_TIPCOUNT:
-        reset_tipcount()
+    tip_state = tip_store.TipStore(robot)
 
 
     # confirm door is close
@@ -701,34 +630,10 @@ def run(ctx: protocol_api.ProtocolContext):
     # #####################################################
     
     # -----------------------------------------------------
-    # Execute step
+    # Execute step (timed and logged, see library/protocols/instrumentation.py)
     # -----------------------------------------------------
-    def run_step(step):
-
-        robot.comment(' ')
-        robot.comment('###############################################')
-        robot.comment('Step ' + str(step) + ': ' + STEPS[step]['Description'])
-        robot.comment('===============================================')
-
-        # Execute step?
-        if STEPS[step]['Execute']:
-
-            # Execute function step
-            STEPS[step]['Function']()
-
-            # Wait
-            if STEPS[step].get('wait_time'):
-                robot.comment('===============================================')
-                wait = STEPS[step]['wait_time']
-                robot.delay(seconds = wait)           
-
-        # Dont execute step
-        else:
-            robot.comment('No ejecutado')
-
-        # End
-        robot.comment('###############################################')
-        robot.comment(' ')
+    steps = instrumentation.StepRecorder(robot, metadata['protocolName'], '/data/' + PROTOCOL_ID + '/step_log.jsonl')
+    report = run_report.RunReport(robot, metadata['protocolName'], NUM_SAMPLES)
 
     # #####################################################
     # 1. Start defining deck
@@ -760,9 +665,8 @@ def run(ctx: protocol_api.ProtocolContext):
     p1000 = robot.load_instrument('p1000_single_gen2', 'left', tip_racks = tips1000)
     m300 = robot.load_instrument('p300_multi_gen2', 'right', tip_racks = tips300)
     
-    ## retrieve tip_log
-    retrieve_tip_info(m300, tips300) 
-    retrieve_tip_info(p1000, tips1000) 
+    ## retrieve used tips (check if tipcount is being reset)
+    tip_state.attach(m300, p1000, reset=RESET_TIPCOUNT and not RESUME)
 
     # -----------------------------------------------------
     # Magnetic module + labware
@@ -777,8 +681,8 @@ def run(ctx: protocol_api.ProtocolContext):
     # -----------------------------------------------------
     tempdeck = robot.load_module('Temperature Module Gen2', '3')
     temp_rack = tempdeck.load_labware('gm_alum_96_wellplate_100ul')
-    # Set temperatur to 8º
-    tempdeck.set_temperature(8)
+    # Set temperatur to 8º (the ramp goes on while pipetting, final() waits for it)
+    common.start_temperature(tempdeck, 8)
     # -----------------------------------------------------
     # Initial labware
     # -----------------------------------------------------
@@ -912,9 +816,23 @@ def run(ctx: protocol_api.ProtocolContext):
     elut_src = reagents_rack['A4']
 
     eth_src = reagents_rack.columns()[4:12]
+
+    # Liquid moved per reagent in the run report (the multichannel aspirates from row A)
+    report.add_reagent('Beads', beads_src)
+    report.add_reagent('Isopropanol', [column[0] for column in isop_src])
+    report.add_reagent('Elution', elut_src)
+    report.add_reagent('Ethanol', [column[0] for column in eth_src])
     
     c_isop = 0    # Current isopropanol channel
     c_eth = 0     # Current ethanol channel
+
+    # Resume from the last completed step (see library/protocols/checkpoint.py)
+    tubes = {'beads': beads_tube, 'isop': isop_tube, 'eth': eth_tube, 'elut': elut_tube, 'sample': sample_tube,
+             'fpcr': fpcr_tube}
+    run_checkpoint = checkpoint.Checkpoint(robot, PROTOCOL_ID, resume=RESUME)
+    counters = run_checkpoint.restore(tubes, magnet=magdeck, magnet_height=10.5)
+    c_isop = counters.get('c_isop', c_isop)
+    c_eth = counters.get('c_eth', c_eth)
     
     x_offset_rs = 2
 
@@ -1210,6 +1128,8 @@ def run(ctx: protocol_api.ProtocolContext):
     # -----------------------------------------------------
     def final():
 
+        common.wait_temperature(tempdeck, 8)
+
         # Dispense elution to final plate
         for i in range(len(magnet_rack.columns()[0:NUM_SAMPLES // 8])):
 
@@ -1271,12 +1191,17 @@ def run(ctx: protocol_api.ProtocolContext):
     # #####################################################
     # 3. Execute every step!!
     # #####################################################
+    def step_done(step):
+        run_checkpoint.save(step, tubes, magnet=magdeck, extra={'c_isop': c_isop, 'c_eth': c_eth})
+
+    run_checkpoint.skip_completed(STEPS)
     for step in STEPS:
-        run_step(step)
+        steps.run_step(step, STEPS[step])
+        if STEPS[step]['Execute']:
+            step_done(step)
+    run_checkpoint.clear()
+    report.finish(steps.records)
    
-    # track final used tip
-    save_tip_info()
-
     # -----------------------------------------------------
     # Stats
     # -----------------------------------------------------
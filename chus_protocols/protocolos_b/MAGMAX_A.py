@@ -6,8 +6,18 @@ Created on Tue Jun 16 14:14:48 2020
 """
 from opentrons import protocol_api
 #from opentrons import simulate
+import copy
 import itertools
 import json
+import math
+import os
+import sys
+
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
 
 #protocol = simulate.get_protocol_api('2.4')
 
@@ -19,21 +29,26 @@ metadata = {
     'description': 'Protocolo Magmax ThermoFisher A',
     'lastModification': '07/07/2020, 14:00:00'
 }
-''' EJEMPLO DE CONFIGURACIÓN
-        configuracion = {
-            'numero_muestras' : 96,
-            'volumen_transferencia_muestras' : 200,
-            '10_primera_punta_TipRack_1000' : 'A1',
-            '11_primera_punta_TipRack_1000' : 'A1',
-            'primera_punta_TipRack_20' : 'A1',
-            'transferir_reactivos': True,
-            'transferir_muestras': True,
-            
-            'reactivos': [{'nombre':'MB', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A1', 'premezclado': True}, 
-                         {'nombre':'PK', 'volumen':500,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':5, 'posicion':'A2', 'premezclado': False},
-                         {'nombre':'CI', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A3', 'premezclado': False}]
-            }
-    }'''
+# CONFIGURACIÓN (parámetros de la ejecución, se pueden generar por lotes con library/protocols/batch.py)
+CONFIGURACION = {
+    'numero_muestras' : 96,
+    'volumen_transferencia_muestras' : 200,
+    '10_primera_punta_TipRack_1000' : 'A1',
+    '11_primera_punta_TipRack_1000' : 'A1',
+    'primera_punta_TipRack_20' : 'A1',
+    'transferir_reactivos': True,
+    'transferir_muestras': True,
+
+    'reactivos': [{'nombre':'MB', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A1', 'premezclado': True},
+                 {'nombre':'PK', 'volumen':500,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':5, 'posicion':'A2', 'premezclado': False},
+                 {'nombre':'CI', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A3', 'premezclado': False}],
+
+    # Premezcla: si todos los reactivos son combinables se mezclan con la p1000 en tubos libres del rack de reactivos
+    # y la p20 dispensa la mezcla en una sola pasada. Los reactivos con 'combinable': False se dispensan por separado,
+    # igual que si no queda volumen de reactivo para el volumen muerto de los tubos.
+    'premezcla': {'activa': True, 'posiciones': ['B1', 'B2', 'B3'], 'volumen_maximo': 1800, 'volumen_muerto': 20}
+}
+
 def run (protocol : protocol_api.ProtocolContext):
 
     #--------------CARGA DE LABWARE-----------------------------
@@ -67,7 +82,9 @@ def run (protocol : protocol_api.ProtocolContext):
     lista_muestras = get_lista_muestras(configuracion, [muestras_1,muestras_2,muestras_3, muestras_4])
     
     #----- PROCESO ----------------------------------------------------------------------------------------------------
-    if configuracion['transferir_reactivos']:
+    if configuracion['transferir_reactivos'] and configuracion['plan_premezcla']:
+        dispensar_premezcla(p20, p1000, configuracion, tubos_reactivos, lista_destinos)
+    elif configuracion['transferir_reactivos']:
         for configuracion_reactivo in configuracion['reactivos']:
             if configuracion_reactivo['premezclado']:
                 dispensar_reactivo_premezclado(p20, p1000, configuracion_reactivo, tubos_reactivos, lista_destinos)
@@ -79,34 +96,8 @@ def run (protocol : protocol_api.ProtocolContext):
    
 def get_configuracion(protocol, lista_tipRacks):
     
-    if not protocol.is_simulating():
-        configuracion = {
-            'numero_muestras' : 96,
-            'volumen_transferencia_muestras' : 200,
-            '10_primera_punta_TipRack_1000' : 'A1',
-            '11_primera_punta_TipRack_1000' : 'A1',
-            'primera_punta_TipRack_20' : 'A1',
-            'transferir_reactivos': True,
-            'transferir_muestras': True,
-            
-            'reactivos': [{'nombre':'MB', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A1', 'premezclado': True}, 
-                         {'nombre':'PK', 'volumen':500,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':5, 'posicion':'A2', 'premezclado': False},
-                         {'nombre':'CI', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A3', 'premezclado': False}]
-            }
-    else:
-        configuracion = {
-            'numero_muestras' : 96,
-            'volumen_transferencia_muestras' : 200,
-            '10_primera_punta_TipRack_1000' : 'A1',
-            '11_primera_punta_TipRack_1000' : 'A1',
-            'primera_punta_TipRack_20' : 'A1',
-            'transferir_reactivos': True,
-            'transferir_muestras': True,
-            
-            'reactivos': [{'nombre':'MB', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A1', 'premezclado': True}, 
-                         {'nombre':'PK', 'volumen':500,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':5, 'posicion':'A2', 'premezclado': False},
-                         {'nombre':'CI', 'volumen':1000,'velocidad_aspiracion' : 1.0, 'volumen_transferencia_reactivo':10, 'posicion':'A3', 'premezclado': False}]
-            }
+    # Copia, para no modificar la configuración del módulo entre simulaciones
+    configuracion = copy.deepcopy(CONFIGURACION)
     
     # Cálculo y configuracion del número de puntas en los tipRacks
     num_tips_1000 = 0
@@ -122,20 +113,32 @@ def get_configuracion(protocol, lista_tipRacks):
         else:
             raise ValueError('Error en la configuración de los tipRacks')
             
+    #Plan de la premezcla (None si los reactivos se dispensan por separado)
+    configuracion['plan_premezcla'] = get_plan_premezcla(configuracion)
+    plan = configuracion['plan_premezcla']
+    
     #Cálculo de las tips necesarias de 1000
     tips_1000_necesarias = 0
     tips_1000_necesarias += configuracion['numero_muestras'] # Es necesaria una punta de 1000 por cada muestra
     
-    for reactivo in configuracion['reactivos']: #Es necesaria una punta de 1000 por cada reactivo con premezclado
-        tips_1000_necesarias += reactivo['premezclado']
+    if plan: # Una punta de 1000 por reactivo para preparar la premezcla y una por tubo para mezclarla
+        tips_1000_necesarias += len(configuracion['reactivos']) + len(plan)
+    else:
+        for reactivo in configuracion['reactivos']: #Es necesaria una punta de 1000 por cada reactivo con premezclado
+            tips_1000_necesarias += reactivo['premezclado']
         
     #Cálculo de las tips necesarias de 20
     tips_20_necesarias = 0
-    tips_20_necesarias = len(configuracion['reactivos'])* int(configuracion['numero_muestras']/16) # Es necesaria 1 por cada reactivo.
+    if plan: # Una pasada por tubo de premezcla, una punta cada 2 columnas
+        tips_20_necesarias = sum(math.ceil(len(tubo['dests'])/16) for tubo in plan)
+    else:
+        tips_20_necesarias = len(configuracion['reactivos'])* int(configuracion['numero_muestras']/16) # Es necesaria 1 por cada reactivo.
     
     #Comprobación volumen reactivos.
     for reactivo in configuracion['reactivos']:
         volumen_necesario = configuracion['numero_muestras'] * reactivo['volumen_transferencia_reactivo']
+        if plan: # Incluye la parte de volumen muerto de los tubos de premezcla
+            volumen_necesario = sum(dict(tubo['additions'])[reactivo['nombre']] for tubo in plan)
         if reactivo['volumen']< volumen_necesario:
             cadena_error = 'Volumen insuficiente reactivo: '+reactivo['nombre']+' Volumen mínimo necesario: '+str(volumen_necesario)+' Volumen configurado: '+str(reactivo['volumen'])+'.'
             raise ValueError(cadena_error)
@@ -154,6 +157,30 @@ def get_configuracion(protocol, lista_tipRacks):
     
     return configuracion    
     
+def get_plan_premezcla(configuracion):  # Plan de la premezcla (ver common.plan_premix), None si no se puede premezclar
+    
+    premezcla = configuracion.get('premezcla', {})
+    reactivos = configuracion['reactivos']
+    
+    if not premezcla.get('activa') or len(reactivos) < 2:
+        return None
+    if not all(reactivo.get('combinable', True) for reactivo in reactivos):
+        return None
+    
+    posiciones_reactivos = [reactivo['posicion'] for reactivo in reactivos]
+    if any(posicion in posiciones_reactivos for posicion in premezcla['posiciones']):
+        raise ValueError('Las posiciones de la premezcla coinciden con las de los reactivos')
+    
+    # Los reactivos con premezclado (bolas magnéticas) se añaden los últimos, justo después de resuspenderlos
+    plan = common.plan_premix([{'name': reactivo['nombre'], 'vol': reactivo['volumen_transferencia_reactivo'], 'last': reactivo['premezclado']} for reactivo in reactivos],
+                              configuracion['numero_muestras'], premezcla['volumen_maximo'], premezcla['volumen_muerto'], max_tubes = len(premezcla['posiciones']))
+    
+    for reactivo in reactivos: # Sin volumen suficiente para la premezcla se dispensan por separado
+        if reactivo['volumen'] < sum(dict(tubo['additions'])[reactivo['nombre']] for tubo in plan):
+            return None
+    
+    return plan
+    
 def configurar_tipRack(tipRack, posicion_primera_punta):  # Quitamos puntas de del tipRack, objeto Labware. Para que la api se apañe con las puntas que tiene el tipRack.
     
     # !!! Esto es una guarrada, hay que cambiarlo. 
@@ -407,6 +434,102 @@ def dispensar_reactivo_premezclado(pipeta, pipeta_2, configuracion_reactivo, lab
     pipeta_2.drop_tip()
 
 
+def dispensar_premezcla(pipeta, pipeta_2, configuracion, labware_reactivos, lista_destinos):
+    
+    # Variables configuración.
+    profundidad_aspiracion_sobre_superficie = 2
+    
+    # Copiar valores del diccionario de configuración.
+    plan = configuracion['plan_premezcla']
+    reactivos = {reactivo['nombre']: reactivo for reactivo in configuracion['reactivos']}
+    tubos = [labware_reactivos.wells_by_name()[posicion] for posicion in configuracion['premezcla']['posiciones'][:len(plan)]]
+    volumenes_tubos = [0] * len(plan)
+    velocidad_aspiracion = min(reactivo['velocidad_aspiracion'] for reactivo in configuracion['reactivos'])
+    
+    #--- Preparación de la premezcla: una punta de 1000 por reactivo, en el orden del plan ---
+    for nombre, _ in plan[0]['additions']:
+        
+        reactivo = reactivos[nombre]
+        origen = labware_reactivos.wells_by_name()[reactivo['posicion']]
+        
+        pipeta_2.pick_up_tip()
+        
+        if reactivo['premezclado']: # Resuspender antes de añadirlo
+            volumen_mezclado = min(int(reactivo['volumen']/2), 800)
+            altura_mezclado = configuracion_altura_aspiracion(labware_reactivos, reactivo['volumen'],volumen_mezclado,profundidad_aspiracion_sobre_superficie)
+            mezclado(pipeta_2 , volumen_mezclado, origen, iteraciones = 10, velocidad_aspiracion = 3, velocidad_dispensacion = 8, altura_aspiracion = altura_mezclado, altura_dispensacion = 1)
+            pipeta_2.blow_out(origen.top(z=-10))
+        
+        for j, tubo_plan in enumerate(plan):
+            for volumen in common.divide_volume(dict(tubo_plan['additions'])[nombre], pipeta_2.max_volume):
+                
+                altura = configuracion_altura_aspiracion(labware_reactivos, reactivo['volumen'],volumen,profundidad_aspiracion_sobre_superficie)
+                
+                pipeta_2.aspirate(volumen, origen.bottom(z = altura), rate = reactivo['velocidad_aspiracion'])
+                
+                # Se dispensa desde arriba para no tocar la mezcla con una punta que vuelve al reactivo
+                pipeta_2.dispense(volumen, tubos[j].top(z = -5), rate = 5)
+                
+                pipeta_2.blow_out(tubos[j].top(z = -5))
+                
+                reactivo['volumen'] -= volumen
+                volumenes_tubos[j] += volumen
+        
+        pipeta_2.drop_tip()
+    
+    #--- Dispensación de la premezcla: una sola pasada de la p20 por tubo ---
+    for j, tubo_plan in enumerate(plan):
+        
+        origen = tubos[j]
+        
+        pipeta.pick_up_tip()
+        pipeta_2.pick_up_tip()
+        
+        for i, indice_destino in enumerate(tubo_plan['dests']):
+            
+            destino = lista_destinos[indice_destino]
+            
+            if (i%16 == 0) and (i > 0): # Una punta nueva de 20 por cada 2 columnas.
+                pipeta.drop_tip()
+                pipeta.pick_up_tip()
+            
+            #--- Mezclado cada columna (la primera vez completa la premezcla) ---
+            if (i%8 == 0):
+                
+                if i == 0:
+                    num_iteraciones = 10
+                else:
+                    num_iteraciones = 3
+                
+                volumen_mezclado = min(int(volumenes_tubos[j]/2), 800)
+                altura_mezclado = configuracion_altura_aspiracion(labware_reactivos, volumenes_tubos[j],volumen_mezclado,profundidad_aspiracion_sobre_superficie)
+                
+                mezclado(pipeta_2 , volumen_mezclado, origen, iteraciones = num_iteraciones, velocidad_aspiracion = 3, velocidad_dispensacion = 8, altura_aspiracion = altura_mezclado, altura_dispensacion = 1)
+                
+                pipeta_2.blow_out(origen.top(z=-10))
+            #-----------------------------
+            
+            # Si la premezcla no cabe en la punta se dispensa en varias veces
+            for volumen_aspiracion in common.divide_volume(tubo_plan['vol'], pipeta.max_volume):
+                
+                vol_sobredispensacion = max(15 - volumen_aspiracion, 0)
+                
+                altura = configuracion_altura_aspiracion(labware_reactivos, volumenes_tubos[j],volumen_aspiracion,profundidad_aspiracion_sobre_superficie)
+                
+                pipeta.aspirate(vol_sobredispensacion,origen.top(), rate = 10)
+                
+                pipeta.aspirate(volumen_aspiracion,origen.bottom(z = altura), rate = velocidad_aspiracion)
+                
+                pipeta.dispense(volumen_aspiracion + vol_sobredispensacion, destino, rate=10)
+                
+                pipeta.blow_out(destino.top(z=-5))
+                
+                volumenes_tubos[j] -= volumen_aspiracion
+        
+        pipeta.drop_tip()
+        pipeta_2.drop_tip()
+
+
 
 
 
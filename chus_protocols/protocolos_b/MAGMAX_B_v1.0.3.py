@@ -4,11 +4,22 @@ from opentrons import protocol_api
 #from opentrons.drivers.rpi_drivers import gpio
 #import json
 import subprocess
-from datetime import datetime
+import os
+import sys
 #from opentrons import simulate
 
 #ctx = simulate.get_protocol_api('2.4')
 
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import checkpoint
+from library.protocols import instrumentation
+from library.protocols import run_report
+from library.protocols import tip_store
+
 metadata = {
     'protocolName': 'Magmax Estacion B v1.0.1',
     'author': 'Andres Montes, Mario Moncada, Mercedes Perez, Sergio Perez',
@@ -24,12 +35,15 @@ NUM_SAMPLES     = 94
 sample_volume   = 200   # Sample volume received in station A
 set_temp_on     = True # Do you want to start temperature module?
 temperature     = 8    # Set temperature. It will be uesed if set_temp_on is set to True
+reset_tipcount  = False # Start the tipracks from A1 instead of the first tip left by the previous run
+resume          = False # Go on from the last completed step of a stopped run
 ################################################
 
 mag_height = 6 # Height needed for Cobas deepwell in magnetic deck
 num_samples_to_show = NUM_SAMPLES
 L_deepwell = 8.35 # Deepwell lenght (Cobas deepwell)
 multi_well_rack_area = 8 * 71 #Cross section of the 12 well reservoir
+min_pickup_height = 5 # Lowest calculated pickup height, below it calc_height aspirates at 1 mm from the bottom
 deepwell_cross_section_area = L_deepwell ** 2 # deepwell square cross secion area
 #Volumen de los reservorios de 12 canales
 multi_well_rack_vol = 13000
@@ -46,6 +60,8 @@ def run(ctx: protocol_api.ProtocolContext):
     #gpio.set_button_light(1,0,0)
 
     ctx.comment('Actual used columns: '+str(num_cols))
+    steps = instrumentation.StepRecorder(ctx, metadata['protocolName'])
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_samples_to_show)
     STEP = 0
     STEPS = { #Dictionary with STEP activation, description, and times
             1:{'Execute': False, 'description': 'Transfer lysis'},#
@@ -72,17 +88,11 @@ def run(ctx: protocol_api.ProtocolContext):
             22:{'Execute': True, 'description': 'Transfer to final elution plate'},
             }
 
-    """if not ctx.is_simulating():
-        folder_path='/data/log_times/'
-        if not os.path.isdir(folder_path):
-            os.mkdir(folder_path)
-        file_path=folder_path+'/time_log.json'"""
-
     #Define Reagents as objects with their properties
     class Reagent:
 
-        def __init__(self, name, num_samples, aspirate_max_volume_allowed, dead_vol, well_max_vol, reagent_volume, h_cono, v_fondo,  num_channels = 1, flow_rate_aspirate = 1, flow_rate_dispense = 1, flow_rate_aspirate_mix = 1, flow_rate_dispense_mix = 1,
-        air_gap_vol_bottom = 0, air_gap_vol_top = 0, disposal_volume = 1, repeat = 1):
+        def __init__(self, name, num_samples, aspirate_max_volume_allowed, well_max_vol, reagent_volume, h_cono, v_fondo,  num_channels = 1, flow_rate_aspirate = 1, flow_rate_dispense = 1, flow_rate_aspirate_mix = 1, flow_rate_dispense_mix = 1,
+        air_gap_vol_bottom = 0, air_gap_vol_top = 0, disposal_volume = 1, repeat = 1, max_wells = None):
             self.name = name
             self.__num_samples = num_samples
             self.num_channels = num_channels
@@ -97,46 +107,37 @@ def run(ctx: protocol_api.ProtocolContext):
             self.aspirate_max_volume_allowed = aspirate_max_volume_allowed 
             self.reagent_volume = reagent_volume
             self.well_max_vol = well_max_vol
-            
-            assert (dead_vol >= 0 and dead_vol <= 50), 'dead_vol debe ser un valor [0, 50]'
-            self.dead_vol = dead_vol * 0.01 + 1 # Convert to range [1.0, 1.5]
-            self.num_wells = math.ceil( (self.__num_samples * self.reagent_volume * self.dead_vol ) * self.repeat / self.well_max_vol)
                 
             self.col = 0
             self.vol_well = []
             self.h_cono = h_cono
             self.v_cono = v_fondo
-            self.vol_well_original =  self.__calculate_initial_reagent_wellVol()
-
-            
-            
-        def __calculate_initial_reagent_wellVol (self):
-            vol_per_well = []
+            # Volumen que queda en el pozo cuando calc_height llega a min_pickup_height: se pasa al siguiente pozo antes
+            self.min_level_vol = v_fondo + (min_pickup_height + 2.5 - h_cono) * multi_well_rack_area
+            # Pozo del reservorio de cada aspiración, planificado antes de empezar (ver common.plan_reservoir)
+            draws = self.__reservoir_draws()
+            self.vol_well_original, self.draw_wells = common.plan_reservoir(
+                draws, well_max_vol, dead_vol = v_fondo, max_wells = max_wells, min_level_vol = self.min_level_vol)
+            self.num_wells = len(self.vol_well_original)
+            # Volumen que queda en cada pozo tras su última aspiración
+            self.vol_left = [fill - sum(d for d, w in zip(draws, self.draw_wells) if w == i)
+                             for i, fill in enumerate(self.vol_well_original)]
+            self.next_draw = 0
+
+        def __reservoir_draws(self):
+            # Mismas aspiraciones que hacen los pasos: trips por columna, con el volumen de descarte, en cada repetición
+            trips = math.ceil(self.reagent_volume / self.aspirate_max_volume_allowed)
+            draw = (self.reagent_volume / trips + self.disposal_volume) * self.num_channels
             columnas = math.ceil(self.__num_samples / self.num_channels)
-            vol_col = self.reagent_volume * self.num_channels
-            vol_total = self.repeat * (vol_col * columnas * self.dead_vol) # EL volumen para todo un set de muestras se multiplica por el numero de iteraciones
-            num_wells = math.ceil((vol_total) / self.well_max_vol)
-        
-            vol_well = vol_total / num_wells
-            vol_well = vol_well - ( vol_well % 100) + 100 # volume is rounded 100 by 100 always upwards. I.E. 9110 ul is 9200ul as well as 9390ul is 9400ul 
-            if vol_well > self.well_max_vol:
-                vol_well = self.well_max_vol
-            # El volumen se reparte de manera equitativa entre todos los pozos, ya que es la mejor forma de aprovechar el volumen
-                
-            for i in range (num_wells):
-                    vol_per_well.append(vol_well)
-                
-            return vol_per_well
-            
-            
+            return [draw] * (trips * columnas * self.repeat)
 
 
     #Reagents and their characteristics
     Lysis = Reagent(name = 'Lysis',
+                    max_wells = 4,
                     num_samples = NUM_SAMPLES,
                     num_channels = 8,
                     reagent_volume = 265 * reagent_proportion, # reagent volume needed per sample. 200ul of sample needs 265ul of lysis
-                    dead_vol = 10, # 10% dead volume
                     well_max_vol = multi_well_rack_vol,
                     
                     flow_rate_aspirate = 1, # Original = 0.5
@@ -151,10 +152,10 @@ def run(ctx: protocol_api.ProtocolContext):
                     )
 
     VHB = Reagent(name = 'VHB',
+                    max_wells = 7,
                     num_samples = NUM_SAMPLES,
                     num_channels = 8,
                     reagent_volume = 500 * reagent_proportion,
-                    dead_vol = 7, # 7% dead volume
                     well_max_vol = multi_well_rack_vol,
                     
                     flow_rate_aspirate = 1.5,
@@ -169,11 +170,11 @@ def run(ctx: protocol_api.ProtocolContext):
                     )
 
     SPR = Reagent(name = 'SPR',
+                    max_wells = 12,
                     num_samples = NUM_SAMPLES,
                     num_channels = 8,
                     reagent_volume = 500 * reagent_proportion,
                     repeat = 2,
-                    dead_vol = 7,
                     well_max_vol = multi_well_rack_vol,
                     
                     flow_rate_aspirate = 1.5, # Original = 1
@@ -188,10 +189,10 @@ def run(ctx: protocol_api.ProtocolContext):
                     )
 
     Water = Reagent(name = 'Water',
+                    max_wells = 1,
                     num_samples = NUM_SAMPLES,
                     num_channels = 8,
                     reagent_volume = 60,
-                    dead_vol = 10,
                     well_max_vol = multi_well_rack_vol,
                     
                     flow_rate_aspirate = 2,
@@ -208,7 +209,6 @@ def run(ctx: protocol_api.ProtocolContext):
                     num_samples = NUM_SAMPLES,
                     num_channels = 8,
                     reagent_volume = 50,
-                    dead_vol = 10,
                     well_max_vol = multi_well_rack_vol,
                     
                     flow_rate_aspirate = 1.2, # Original 0.5
@@ -231,23 +231,24 @@ def run(ctx: protocol_api.ProtocolContext):
     ctx.comment(' ')
     ctx.comment('###############################################')
     ctx.comment('Volumenes para ' + str(num_samples_to_show) + ' MUESTRAS')
+    ctx.comment('Cada pozo guarda al menos ' + str(round(Lysis.min_level_vol)) + ' uL para no aspirar por debajo de ' + str(min_pickup_height) + ' mm')
     ctx.comment(' ')
     
     ctx.comment('Lysis: ' + str(Lysis.num_wells) + ' pozos a partir del 1er pozo en el reservorio 1 con volumenes: ')
     for i in range( len(Lysis.vol_well_original)):
-        ctx.comment('     POZO ' + str(i) + ':' + str(Lysis.vol_well_original[i]) + ' uL')
+        ctx.comment('     POZO ' + str(i) + ':' + str(Lysis.vol_well_original[i]) + ' uL (' + str(Lysis.draw_wells.count(i)) + ' aspiraciones, quedan ' + str(round(Lysis.vol_left[i])) + ' uL)')
         
     ctx.comment('VHB/WB1: ' + str(VHB.num_wells) + ' pozos a partir del 5º pozo en el reservorio 1 con volumenes: ')
     for i in range( len(VHB.vol_well_original)):
-        ctx.comment('     POZO ' + str(i) + ':' + str(VHB.vol_well_original[i]) + ' uL')
+        ctx.comment('     POZO ' + str(i) + ':' + str(VHB.vol_well_original[i]) + ' uL (' + str(VHB.draw_wells.count(i)) + ' aspiraciones, quedan ' + str(round(VHB.vol_left[i])) + ' uL)')
         
     ctx.comment('Agua: ' + str(Water.num_wells) + ' pozos a partir del 12º pozo en el reservorio 1 con volumenes: ')
     for i in range( len(Water.vol_well_original)):
-        ctx.comment('     POZO ' + str(i) + ':' + str(Water.vol_well_original[i]) + ' uL')
+        ctx.comment('     POZO ' + str(i) + ':' + str(Water.vol_well_original[i]) + ' uL (' + str(Water.draw_wells.count(i)) + ' aspiraciones, quedan ' + str(round(Water.vol_left[i])) + ' uL)')
         
     ctx.comment('SPR/WB2: ' + str(SPR.num_wells) + ' pozos a partir del 1er pozo en el reservorio 2 con volumenes ')
     for i in range( len(SPR.vol_well_original)):
-        ctx.comment('     POZO ' + str(i) + ':' + str(SPR.vol_well_original[i]) + ' uL')
+        ctx.comment('     POZO ' + str(i) + ':' + str(SPR.vol_well_original[i]) + ' uL (' + str(SPR.draw_wells.count(i)) + ' aspiraciones, quedan ' + str(round(SPR.vol_left[i])) + ' uL)')
         
     ctx.comment('###############################################')
     ctx.comment(' ')
@@ -270,27 +271,21 @@ def run(ctx: protocol_api.ProtocolContext):
 
     def calc_height(reagent, cross_section_area, aspirate_volume):
         nonlocal ctx
-        ctx.comment('Remaining volume ' + str(reagent.vol_well[reagent.col]) +
-                    '< needed volume ' + str(aspirate_volume) + '?')
-        if reagent.vol_well[reagent.col] < aspirate_volume:
-            ctx.comment('Next column should be picked')
-            ctx.comment('Previous to change: ' + str(reagent.col))
-            # column selector position; intialize to required number
-            reagent.col = reagent.col + 1
-            ctx.comment(str('After change: ' + str(reagent.col)))
-
-            ctx.comment('New volume:' + str(reagent.vol_well[reagent.col]))    
-    
-            col_change = True
-        else:
-            col_change = False
+        # Column planned for this aspiration, the last one if there are more aspirations than planned
+        col = reagent.draw_wells[min(reagent.next_draw, len(reagent.draw_wells) - 1)]
+        reagent.next_draw += 1
+        col_change = col != reagent.col
+        if col_change:
+            ctx.comment('Next column: ' + str(col) + ', previous: ' + str(reagent.col))
+            reagent.col = col
+            ctx.comment('New volume:' + str(reagent.vol_well[reagent.col]))
 
         height = (( (reagent.vol_well[reagent.col] - aspirate_volume - (reagent.v_cono)) / cross_section_area ) + reagent.h_cono) - 2.5
         reagent.vol_well[reagent.col] = reagent.vol_well[reagent.col] - aspirate_volume
         ctx.comment('Remaining volume:' + str(reagent.vol_well[reagent.col]))
         ctx.comment('Calculated height is ' + str(height))
 
-        if height < 5:
+        if height < min_pickup_height:
             height = 1
         ctx.comment('Used height is ' + str(height))
             
@@ -381,12 +376,6 @@ def run(ctx: protocol_api.ProtocolContext):
         else:
             working_tip_rack = tip_well_list.parent
             working_tip_rack.return_tips(tip_well_list , channels)
-    def print_step (step, description):
-        ctx.comment(' ')
-        ctx.comment('###############################################')
-        ctx.comment('Step '+str(step)+': '+description)
-        ctx.comment('###############################################')
-        ctx.comment(' ')
             
 ####################################
     # load labware and modules
@@ -397,6 +386,9 @@ def run(ctx: protocol_api.ProtocolContext):
 ############################################
     ########## tempdeck
     tempdeck = ctx.load_module('tempdeck', '1')
+    if set_temp_on == True:
+        # The ramp goes on while pipetting, the transfer to the elution plate waits for it
+        common.start_temperature(tempdeck, temperature)
 
 ##################################
     ####### Elution plate - final plate, goes to C
@@ -426,9 +418,11 @@ def run(ctx: protocol_api.ProtocolContext):
 ###############################################################################
     #Declare which reagents are in each reservoir as well as deepwell and elution plate
     Lysis.reagent_reservoir = reagent_res.rows()[0][:4] # 4 columns
-    VHB.reagent_reservoir   = reagent_res.rows()[0][4:8] # 4 columns
-    SPR.reagent_reservoir   = reagent_res_2.rows()[0][0:8] # 8 columns
+    VHB.reagent_reservoir   = reagent_res.rows()[0][4:11] # up to 7 columns
+    SPR.reagent_reservoir   = reagent_res_2.rows()[0] # up to 12 columns
     Water.reagent_reservoir = reagent_res.rows()[0][-1]
+    for reagent in (Lysis, VHB, SPR, Water):
+        report.add_reagent(reagent.name, reagent.reagent_reservoir)
     work_destinations       = deepwell_plate.rows()[0][:num_cols]
     final_destinations      = elution_plate.rows()[0][:num_cols]
     waste = waste_reservoir.wells()[0]# referenced as reservoir
@@ -436,12 +430,22 @@ def run(ctx: protocol_api.ProtocolContext):
     # pipettes. P1000 currently deactivated
     m300 = ctx.load_instrument('p300_multi_gen2', 'left', tip_racks=tips300) # Load multi pipette
 
+    # Go on from the first free tip left by the previous runs (see library/protocols/tip_store.py)
+    tip_state = tip_store.TipStore(ctx)
+    tip_state.attach(m300, reset=reset_tipcount and not resume)
+
     #### used tip counter and set maximum tips available
     tip_track = {
         'counts': {m300: 0},
         'maxes': {m300: 96 * len(m300.tip_racks)} #96 tips per tiprack * number or tipracks in the layout
         }
 
+    #### resume from the last completed step (see library/protocols/checkpoint.py)
+    reagents = {'Lysis': Lysis, 'VHB': VHB, 'SPR': SPR, 'Water': Water, 'Elution': Elution}
+    run_checkpoint = checkpoint.Checkpoint(ctx, metadata['protocolName'], resume=resume)
+    run_checkpoint.skip_completed(STEPS)
+    tip_track['counts'][m300] = run_checkpoint.restore(reagents, magnet=magdeck, magnet_height=mag_height).get('tips', 0)
+
 ###############################################################################
     
     ###############################################################################
@@ -450,8 +454,7 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute']==True:
     #Transfer lysis
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # aspirate_max_volume_allowed = 160 # Tips allow up to 200uL, but we only allow max_volume_allowed
         lysis_trips = math.ceil(Lysis.reagent_volume / Lysis.aspirate_max_volume_allowed)
@@ -473,6 +476,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                 m300.pick_up_tip()
                 
             for j,transfer_vol in enumerate(lysis_transfer_vol):
@@ -503,10 +507,8 @@ def run(ctx: protocol_api.ProtocolContext):
             tip_track['counts'][m300] += 8
 
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -515,15 +517,12 @@ def run(ctx: protocol_api.ProtocolContext):
     STEP += 1
     if STEPS[STEP]['Execute']==True:
     #Transfer magnetic beads
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubating for ' + format(STEPS[STEP]['wait_time']) + ' seconds.') # minutes=2
         ctx.comment(' ')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -531,17 +530,14 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         magdeck.engage(height=mag_height)
         ctx.comment(' ')
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubating ON magnet for ' + format(STEPS[STEP]['wait_time']) + ' seconds.') # minutes=2
         ctx.comment(' ')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -549,8 +545,7 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
         # remove supernatant -> height calculation can be omitted and referred to bottom!
 
         supernatant_trips = math.ceil((Lysis.reagent_volume + sample_volume) / Lysis.aspirate_max_volume_allowed)
@@ -570,6 +565,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                 m300.pick_up_tip()
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
@@ -586,10 +582,8 @@ def run(ctx: protocol_api.ProtocolContext):
             #Aumenta la cuenta de puntas usadas
             tip_track['counts'][m300] += 8
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -597,16 +591,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch off magnet
         magdeck.disengage()
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -614,8 +605,7 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         vhb_trips = math.ceil(VHB.reagent_volume / VHB.aspirate_max_volume_allowed)
         vhb_volume = VHB.reagent_volume / vhb_trips #136.66
@@ -644,6 +634,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                     if reuse_tip_list[-1] is None:
                         reuse_tip_list[-1] = find_next_tip(m300.tip_racks)
                 if i != 0:
@@ -676,11 +667,8 @@ def run(ctx: protocol_api.ProtocolContext):
         #Reseteamos las puntas usadas para reciclarlas en el lavado
         reset_tipWell_OnTipTracker (reuse_tip_list, m300.channels)
 
-        end = datetime.now()
-        time_taken = (end - start)        
-        
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -688,16 +676,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch on magnet
         magdeck.engage(mag_height)
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 5 minutes.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -705,8 +690,7 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         supernatant_trips = math.ceil(VHB.reagent_volume / VHB.aspirate_max_volume_allowed)
         supernatant_volume = VHB.aspirate_max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
@@ -724,7 +708,8 @@ def run(ctx: protocol_api.ProtocolContext):
                 if find_next_tip(m300.tip_racks) is None:
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
-                    m300.reset_tipracks() 
+                    m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                 m300.pick_up_tip()
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
@@ -741,10 +726,8 @@ def run(ctx: protocol_api.ProtocolContext):
             #Aumenta la cuenta de puntas usadas
             tip_track['counts'][m300] += 8
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -752,16 +735,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch off magnet
         magdeck.disengage()
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+ str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -769,8 +749,7 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
         
         spr_trips = math.ceil(SPR.reagent_volume / SPR.aspirate_max_volume_allowed)
         spr_volume = SPR.reagent_volume / spr_trips #136.66
@@ -796,6 +775,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                     if reuse_tip_list[-1] is None:
                         reuse_tip_list[-1] = find_next_tip(m300.tip_racks)
                 if i != 0:
@@ -828,10 +808,8 @@ def run(ctx: protocol_api.ProtocolContext):
         #Reseteamos las puntas usadas para reciclarlas en el lavado
         reset_tipWell_OnTipTracker (reuse_tip_list, m300.channels)
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -839,16 +817,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch on magnet
         magdeck.engage(mag_height)
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 5 minutes.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -857,8 +832,7 @@ def run(ctx: protocol_api.ProtocolContext):
     magdeck.engage(mag_height)
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         supernatant_trips = math.ceil(SPR.reagent_volume / SPR.aspirate_max_volume_allowed)
         supernatant_volume = SPR.aspirate_max_volume_allowed # We try to remove an exceeding amount of supernatant to make sure it is empty
@@ -876,7 +850,8 @@ def run(ctx: protocol_api.ProtocolContext):
                 if find_next_tip(m300.tip_racks) is None:
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
-                    m300.reset_tipracks()  
+                    m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                 m300.pick_up_tip()
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
@@ -893,10 +868,8 @@ def run(ctx: protocol_api.ProtocolContext):
             #Aumenta la cuenta de puntas usadas
             tip_track['counts'][m300] += 8
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -904,26 +877,21 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch off magnet
         magdeck.disengage()
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
     # STEP 14 SPR
     ########
-    SPR.col = 4
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         #aspirate_max_volume_allowed = 190
         spr_trips = math.ceil(SPR.reagent_volume / SPR.aspirate_max_volume_allowed)
@@ -949,6 +917,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                     if reuse_tip_list[-1] is None:
                         reuse_tip_list[-1] = find_next_tip(m300.tip_racks)
                 if i != 0:
@@ -978,10 +947,8 @@ def run(ctx: protocol_api.ProtocolContext):
         #Reseteamos las puntas usadas para reciclarlas en el lavado
         reset_tipWell_OnTipTracker (reuse_tip_list, m300.channels)
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -989,16 +956,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch on magnet
         magdeck.engage(mag_height)
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 30 seconds.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -1007,8 +971,7 @@ def run(ctx: protocol_api.ProtocolContext):
     magdeck.engage(mag_height)
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # remove supernatant -> height calculation can be omitted and referred to bottom!
         supernatant_trips = math.ceil(SPR.reagent_volume / SPR.aspirate_max_volume_allowed)
@@ -1028,6 +991,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                 m300.pick_up_tip()
             for transfer_vol in supernatant_transfer_vol:
                 #Pickup_height is fixed here
@@ -1050,6 +1014,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                 m300.pick_up_tip()
                 
             pickup_height = 0.2 # Original 0.5
@@ -1062,10 +1027,8 @@ def run(ctx: protocol_api.ProtocolContext):
             m300.return_tip()
             tip_track['counts'][m300] += 8
             
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: ' + str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -1073,15 +1036,12 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Incubating OFF magnet for ' + format(STEPS[STEP]['wait_time']) + ' seconds.') # minutes=2
         ctx.comment(' ')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: ' + str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -1089,16 +1049,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch off magnet
         magdeck.disengage()
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:'] = str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: ' + str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -1107,8 +1064,7 @@ def run(ctx: protocol_api.ProtocolContext):
     magdeck.disengage()
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         #Water elution
         water_trips = math.ceil(Water.reagent_volume / Water.aspirate_max_volume_allowed)
@@ -1131,7 +1087,8 @@ def run(ctx: protocol_api.ProtocolContext):
                         #subprocess.call('mpg123 ./var/lib/jupyter/notebooks/sonido_alarma_submarino.mp3', shell=True)
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
-                    m300.reset_tipracks()                
+                    m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                 m300.pick_up_tip()                  
                 
             for transfer_vol in water_wash_vol:
@@ -1155,10 +1112,8 @@ def run(ctx: protocol_api.ProtocolContext):
 
             m300.return_tip(home_after = False)
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -1166,14 +1121,11 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for ' + format(STEPS[STEP]['wait_time']) + ' seconds.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -1181,16 +1133,13 @@ def run(ctx: protocol_api.ProtocolContext):
     ########
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
 
         # switch on magnet
         magdeck.engage(mag_height)
         ctx.delay(seconds=STEPS[STEP]['wait_time'], msg='Wait for 5 minutes.')
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ###############################################################################
@@ -1199,8 +1148,9 @@ def run(ctx: protocol_api.ProtocolContext):
     magdeck.engage(mag_height)
     STEP += 1
     if STEPS[STEP]['Execute']==True:
-        start = datetime.now()
-        print_step (STEP, STEPS[STEP]['description'])
+        steps.start(STEP, STEPS[STEP]['description'])
+        if set_temp_on == True:
+            common.wait_temperature(tempdeck, temperature)
 
         elution_trips = math.ceil(Elution.reagent_volume / Elution.aspirate_max_volume_allowed)
         elution_volume = Elution.reagent_volume / elution_trips
@@ -1217,6 +1167,7 @@ def run(ctx: protocol_api.ProtocolContext):
                     ctx.pause('Reemplace los tipracks en los slots 6 y 7. Después pulse resume.')
                     ctx.comment("Tip_racks renovados")
                     m300.reset_tipracks()
+                    tip_state.reset(m300.tip_racks)
                     tip_track['counts'][m300] = 0
                 m300.pick_up_tip()
             for transfer_vol in elution_vol:
@@ -1233,10 +1184,8 @@ def run(ctx: protocol_api.ProtocolContext):
             #Aumenta la cuenta de puntas usadas
             tip_track['counts'][m300] += 8
 
-        end = datetime.now()
-        time_taken = (end - start)
-        ctx.comment('Step ' + str(STEP) + ': ' + STEPS[STEP]['description'] + ' took ' + str(time_taken))
-        STEPS[STEP]['Time:']=str(time_taken)
+        STEPS[STEP]['Time:'] = str(steps.finish())
+        run_checkpoint.save(STEP, reagents, magnet=magdeck, extra={'tips': tip_track['counts'][m300]})
         ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
 
     ############################################################################
@@ -1249,14 +1198,16 @@ def run(ctx: protocol_api.ProtocolContext):
     ctx.comment(' ')
     ctx.home()
     magdeck.disengage()
+    run_checkpoint.clear()
     if set_temp_on == True:
-        tempdeck.set_temperature(temperature)
+        common.wait_temperature(tempdeck, temperature)
 ###############################################################################
 
     ctx.comment('Terminado! \nMueva la placa qPCR del modulo de temperatura a la estación C para la preparación de PCR.')
     ctx.comment('Used tips in total: '+str(tip_track['counts'][m300]))
     ctx.comment('Used racks in total: '+str(tip_track['counts'][m300]/96))
     ctx.comment('Available tips: '+str(tip_track['maxes'][m300]))
+    report.finish(steps.records)
 
 #run(ctx)
 ''' CHANGELOG
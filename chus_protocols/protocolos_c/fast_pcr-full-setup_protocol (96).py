@@ -1,22 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 from opentrons.types import Point
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -66,7 +62,7 @@ tipo_de_tubo = 'eppendorf'                  # Tipo de tubo que contiene el ARN:
 # ------------------------
 # Other parameters
 # ------------------------
-_, _, _, _, pickup_height = lab_stuff.tubes(tipo_de_tubo)
+pickup_height = lab_stuff.tube(tipo_de_tubo).hpick
 master_mix_vol, arn_vol, doble_mix = lab_stuff.brands(brand_name)
 num_cols = math.ceil(numero_muestras / 8)
 x_offset = [0, 0]
@@ -90,7 +86,6 @@ master_mix = {
     'vol_well': 1500,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 rna_sample = {
@@ -107,7 +102,6 @@ rna_sample = {
     'vol_well': 200,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 
@@ -118,6 +112,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], numero_muestras)
+
     # Tip racks
     tips_20 = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['10']]
     tips_200 = [ctx.load_labware('opentrons_96_filtertiprack_200ul', slot, '200µl filter tiprack') for slot in ['11']]
@@ -187,4 +184,6 @@ def run(ctx: protocol_api.ProtocolContext):
                                          disp_height=-10, blow_out=True, touch_tip=True)
             p20.drop_tip()
 
+    report.finish()
+
         
\ No newline at end of file
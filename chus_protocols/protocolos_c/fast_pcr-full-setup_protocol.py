@@ -1,22 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
-from opentrons.types import Point
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -28,32 +23,6 @@ metadata = {
 }
 
 
-def fast_dispense(pipette, reagent, source, dests, vol_aspirate, vol_dispense, air_gap_vol, x_offset, pickup_height, disp_height,
-                          blow_out, touch_tip):
-    current_pipete_volume = 0
-    dests = list(reversed(dests))
-    while len(dests) > 0:
-        if current_pipete_volume < vol_dispense:
-            vol_aspirate = (len(dests) * vol_dispense) if (len(dests) * vol_dispense) <= vol_aspirate else vol_aspirate
-            # Source
-            s = source.bottom(pickup_height).move(Point(x=x_offset[0]))
-            pipette.aspirate(vol_aspirate, s, rate=1.2)
-            # If there is air_gap_vol, switch pipette to slow speed
-            if air_gap_vol != 0:
-                pipette.aspirate(air_gap_vol, source.top(z=-2), rate=reagent.get('flow_rate_aspirate'))
-            # Apply a delay, if there is any
-            delay = reagent.get('delay')
-            if delay:
-                ctx.delay(seconds=delay)
-            current_pipete_volume = vol_aspirate
-        # Go to destination
-        dest = dests.pop()
-        drop = dest.top(z=disp_height).move(Point(x=x_offset[1]))
-        pipette.dispense(vol_dispense, drop, rate=reagent.get('flow_rate_dispense'))
-        current_pipete_volume -= vol_dispense
-    pipette.drop_tip()
-
-
 # ------------------------
 # Protocol parameters
 # ------------------------
@@ -66,7 +35,7 @@ tipo_de_tubo = 'eppendorf'                  # Tipo de tubo que contiene el ARN:
 # ------------------------
 # Other parameters
 # ------------------------
-_, _, _, _, pickup_height = lab_stuff.tubes(tipo_de_tubo)
+pickup_height = lab_stuff.tube(tipo_de_tubo).hpick
 master_mix_vol, arn_vol, doble_mix = lab_stuff.brands(brand_name)
 num_cols = math.ceil(numero_muestras / 8)
 x_offset = [0, 0]
@@ -90,7 +59,6 @@ master_mix = {
     'vol_well': 1500,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 rna_sample = {
@@ -107,7 +75,6 @@ rna_sample = {
     'vol_well': 200,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 
@@ -118,6 +85,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], numero_muestras)
+
     # Tip racks
     tips_20 = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['10']]
     tips_200 = [ctx.load_labware('opentrons_96_filtertiprack_200ul', slot, '200µl filter tiprack') for slot in ['11']]
@@ -158,11 +128,11 @@ def run(ctx: protocol_api.ProtocolContext):
     for s, d in mastermix_mov:
         if not p300.hw_pipette['has_tip']:
             common.pick_up(p300)
-        vol_aspirate = (numero_muestras * master_mix_vol) if (numero_muestras * master_mix_vol) <= (10 * master_mix_vol) else (10 * master_mix_vol)
-        fast_dispense(p300, reagent=rna_sample, source=s, dests=d,
-                                         vol_aspirate=vol_aspirate, vol_dispense=master_mix_vol, air_gap_vol=air_gap_vol_source,
-                                         x_offset=x_offset, pickup_height=pickup_height,
-                                         disp_height=-10, blow_out=True, touch_tip=True)    
+        common.multi_dispense(ctx, p300, reagent=master_mix, source=s, dests=d,
+                              vol=master_mix_vol, air_gap_vol=air_gap_vol_source,
+                              x_offset=x_offset, pickup_height=pickup_height,
+                              disp_height=-10, disposal_vol=master_mix_vol)
+        p300.drop_tip()
 
     # Dispense RNA
     for i in range(0, numero_muestras):
@@ -186,4 +156,6 @@ def run(ctx: protocol_api.ProtocolContext):
                                          disp_height=-10, blow_out=True, touch_tip=True)
             p20.drop_tip()
 
+    report.finish()
+
         
\ No newline at end of file
@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -41,7 +37,7 @@ tipo_de_tubo = 'labturbo'                           # Tipo de tubo que contiene
 # ------------------------
 # Other parameters
 # ------------------------
-(_, _, _, _, pickup_height) = lab_stuff.tubes(tipo_de_tubo)
+pickup_height = lab_stuff.tube(tipo_de_tubo).hpick
 num_cols = math.ceil(numero_muestras / 8)
 x_offset = [0, 0]
 air_gap_vol_source = 2
@@ -64,7 +60,6 @@ master_mix = {
     'vol_well': 1500,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 rna_sample = {
@@ -81,7 +76,6 @@ rna_sample = {
     'vol_well': 200,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 
@@ -92,6 +86,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], numero_muestras)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['11']]
 
@@ -156,3 +153,5 @@ def run(ctx: protocol_api.ProtocolContext):
                                          x_offset=x_offset, pickup_height=pickup_height,
                                          disp_height=-10, blow_out=True, touch_tip=True)
             m20.drop_tip()
+
+    report.finish()
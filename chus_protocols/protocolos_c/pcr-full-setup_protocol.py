@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -41,7 +37,7 @@ tipo_de_tubo = 'labturbo'                           # Tipo de tubo que contiene
 # ------------------------
 # Other parameters
 # ------------------------
-(_, _, _, _, pickup_height) = lab_stuff.tubes(tipo_de_tubo)
+pickup_height = lab_stuff.tube(tipo_de_tubo).hpick
 num_cols = math.ceil(numero_muestras / 8)
 x_offset = [0, 0]
 air_gap_vol_source = 2
@@ -52,6 +48,7 @@ area_section_sample = (math.pi * diameter_sample**2) / 4
 # following volumes in ul
 master_mix = {
     'name': 'master mix',
+    'tip_policy': 'per-source',
     'flow_rate_aspirate': 1,
     'flow_rate_dispense': 1,
     'rinse': False,
@@ -64,11 +61,11 @@ master_mix = {
     'vol_well': 1500,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 rna_sample = {
     'name': 'RNA samples',
+    'tip_policy': 'per-source',
     'flow_rate_aspirate': 1,
     'flow_rate_dispense': 1,
     'rinse': False,
@@ -81,7 +78,6 @@ rna_sample = {
     'vol_well': 200,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 
@@ -92,6 +88,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], numero_muestras)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['11']]
 
@@ -113,49 +112,32 @@ def run(ctx: protocol_api.ProtocolContext):
     # Protocol
     # ------------------
     # Dispense master mix
+    tip_manager = common.TipManager(p20, policy='per-source')
+    mastermix_mov = [(source_master_mix[0], destinations[:numero_muestras + 2])]
+    if doble_mix:
+        mastermix_mov += [(source_master_mix[1], destinations[48:48 + numero_muestras + 2])]
+    for source, dests in mastermix_mov:
+        tip_manager.prepare(source, master_mix)
+        common.multi_dispense(ctx, p20, reagent=master_mix, source=source, dests=dests,
+                              vol=master_mix_vol, air_gap_vol=air_gap_vol_source,
+                              x_offset=x_offset, pickup_height=pickup_height,
+                              disp_height=-10, touch_tip=True)
+
+    # Dispense RNA: one aspiration serves both halves of the plate for one sample when it fits in the tip. A tip
+    # that touched a well with master mix never goes back into the RNA tube, every trip takes a new tip
     for i in range(0, numero_muestras + 2):
-        if not p20.hw_pipette['has_tip']:
-            common.pick_up(p20)
-
-        source = source_master_mix[0]
-        destination = destinations[i]
-        common.move_vol_multichannel(ctx, p20, reagent=master_mix, source=source, dest=destination,
-                                         vol=master_mix_vol, air_gap_vol=air_gap_vol_source,
-                                         x_offset=x_offset, pickup_height=pickup_height,
-                                         disp_height=-10, blow_out=True, touch_tip=True)
-        p20.drop_tip()
-        
-        if doble_mix:        
-            common.pick_up(p20)    
-            source = source_master_mix[1]
-            destination = destinations[48 + i]
-            common.move_vol_multichannel(ctx, p20, reagent=master_mix, source=source, dest=destination,
-                                         vol=master_mix_vol, air_gap_vol=air_gap_vol_source,
-                                         x_offset=x_offset, pickup_height=pickup_height,
-                                         disp_height=-10, blow_out=True, touch_tip=True)
-            p20.drop_tip()
-    
-
-    # Dispense RNA
-    for i in range(0, numero_muestras + 2):
-        if not p20.hw_pipette['has_tip']:
-            common.pick_up(p20)
-
         source = sources_rna[i]
-        destination = destinations[i]
-        common.move_vol_multichannel(ctx, p20, reagent=rna_sample, source=source, dest=destination,
-                                         vol=arn_vol, air_gap_vol=air_gap_vol_source,
-                                         x_offset=x_offset, pickup_height=pickup_height,
-                                         disp_height=-10, blow_out=True, touch_tip=True)
-        p20.drop_tip()
-
-        if doble_mix:
-            destination = destinations[48 + i]
-            common.pick_up(p20)
-            common.move_vol_multichannel(ctx, p20, reagent=rna_sample, source=source, dest=destination,
-                                         vol=arn_vol, air_gap_vol=air_gap_vol_source,
-                                         x_offset=x_offset, pickup_height=pickup_height,
-                                         disp_height=-10, blow_out=True, touch_tip=True)
-            p20.drop_tip()
-
-        
\ No newline at end of file
+        rna_dests = [destinations[i], destinations[48 + i]] if doble_mix else [destinations[i]]
+        for trip in common.plan_multi_dispense(len(rna_dests), arn_vol, p20.max_volume,
+                                               air_gap_vol=air_gap_vol_source):
+            tip_manager.release()
+            tip_manager.prepare(source, rna_sample)
+            common.multi_dispense(ctx, p20, reagent=rna_sample, source=source,
+                                  dests=[rna_dests[d] for d, _ in trip], vol=[v for _, v in trip],
+                                  air_gap_vol=air_gap_vol_source, x_offset=x_offset, pickup_height=pickup_height,
+                                  disp_height=-10, blow_out=False, touch_tip=True)
+            # Blow out the last drops into the well, not back into the RNA tube
+            p20.blow_out(rna_dests[trip[-1][0]].top(z=-2))
+    tip_manager.release()
+
+    report.finish()
@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -38,7 +34,6 @@ pickup_height = 3
 # ------------------------
 # Other parameters
 # ------------------------
-num_cols = math.ceil(NUM_SAMPLES / 8)
 x_offset = [0, 0]
 air_gap_vol_source = 2
 diameter_sample = 8.25
@@ -61,7 +56,6 @@ master_mix = {
     'vol_well': 1500,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 rna_sample = {
@@ -78,7 +72,6 @@ rna_sample = {
     'vol_well': 200,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 
@@ -89,28 +82,31 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
-    # Tip racks
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], NUM_SAMPLES)
+
+    # Tip racks (one per pipette: the single channel takes tips one by one and would leave the 8-channel with
+    # incomplete columns)
     tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['11']]
+    tips_multi = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack multi') for slot in ['10']]
 
     # Pipettes
     p20 = ctx.load_instrument('p20_single_gen2', 'right', tip_racks=tips)
-    m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks=tips)
+    m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks=tips_multi)
 
     # Source (master_mix in and deep-weel with NUM SAMPLES x RNA samples)
     source_master_mix = ctx.load_labware('opentrons_24_aluminumblock_generic_2ml_screwcap', '7', 'Bloque Aluminio opentrons 24 screwcaps 2000 µL')
     source_master_mix = source_master_mix.wells()
 
     source_rna_samples = ctx.load_labware('abgene_96_wellplate_800ul', '5', 'ABGENE 96 Well Plate 800 µL')
-    sources_rna = source_rna_samples.rows()[0][:num_cols]
-    if requires_double_master_mix:
-        sources_rna += source_rna_samples.rows()[0][:num_cols]
+    sources_rna = source_rna_samples.wells()[:NUM_SAMPLES + 2]
 
     # Destination (NUM SAMPLES x pcr plate)
     pcr_plate_destination = ctx.load_labware('abi_fast_qpcr_96_alum_opentrons_100ul', '1', 'chilled qPCR final plate')
     destinations = pcr_plate_destination.wells()
-    destinations_by_columns = pcr_plate_destination.rows()[0][:num_cols]
+    rna_transfers = list(zip(sources_rna, destinations[:NUM_SAMPLES + 2]))
     if requires_double_master_mix:
-        destinations_by_columns += pcr_plate_destination.rows()[0][6:(6 + num_cols)]
+        rna_transfers += list(zip(sources_rna, destinations[48:48 + NUM_SAMPLES + 2]))
 
 
     # ------------------
@@ -143,14 +139,16 @@ def run(ctx: protocol_api.ProtocolContext):
     p20.return_tip()
 
 
-    # Dispense RNA samples
-    for s, d in zip(sources_rna, destinations_by_columns):
-        if not m20.hw_pipette['has_tip']:
-            common.pick_up(m20)
+    # Dispense RNA samples (full columns with the 8-channel, the rest well by well)
+    for pipette, s, d, _ in common.promote_to_multichannel(rna_transfers, single=p20, multi=m20):
+        if not pipette.hw_pipette['has_tip']:
+            common.pick_up(pipette)
 
-        common.move_vol_multichannel(ctx, m20, reagent=rna_sample, source=s, dest=d,
+        common.move_vol_multichannel(ctx, pipette, reagent=rna_sample, source=s, dest=d,
                                      vol=arn, air_gap_vol=air_gap_vol_source,
                                      x_offset=x_offset, pickup_height=2, disp_height=-10,
                                      blow_out=True, touch_tip=True)
-        m20.drop_tip()
+        pipette.drop_tip()
+
+    report.finish()
 
@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -38,7 +34,8 @@ air_gap_vol_source = 1
 diameter_sample = 8.25
 area_section_sample = (math.pi * diameter_sample**2) / 4
 
-(brand_master_mix, arn) = lab_stuff.brands(brand_name)
+brand = lab_stuff.brand(brand_name)
+brand_master_mix, arn = brand.master_mix, brand.arn
 
 sample = {
     'name': 'RNA samples',
@@ -54,7 +51,6 @@ sample = {
     'vol_well': 20,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 # following volumes in ul
@@ -72,7 +68,6 @@ master_mix = {
     'vol_well': 1500,
     'unused': [],
     'col': 0,
-    'vol_well': 0
 }
 
 
@@ -83,6 +78,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], NUM_SAMPLES)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['11']]
 
@@ -117,3 +115,5 @@ def run(ctx: protocol_api.ProtocolContext):
                                      blow_out=True, touch_tip=True)
         # Drop pipette tip
         p20.drop_tip()
+
+    report.finish()
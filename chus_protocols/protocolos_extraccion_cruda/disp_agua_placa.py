@@ -1,22 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-
-# Load library
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -61,7 +56,7 @@ x_offset = [0, 0]
 # Main
 # ----------------------------
 (sample) = lab_stuff.buffer(reagent_name)
-(_, _, _, _, pickup_height) = lab_stuff.tubes(tube_type_source)
+pickup_height = lab_stuff.tube(tube_type_source).hpick
 #(_, _, _, dispense_height, _) = lab_stuff.tubes(tube_type_destination)
 dispense_height = -10
 num_botes_agua = round(num_destinations / 24) - 1
@@ -70,6 +65,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_destinations)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_200ul', slot, '200µl filter tiprack') for slot in ['11']]
 
@@ -110,5 +108,7 @@ def run(ctx: protocol_api.ProtocolContext):
     # Drop pipette tip
     p200.drop_tip()                                 
 
+    report.finish()
+
     # Notify users
     # common.notify_finish_process()
\ No newline at end of file
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+from opentrons import protocol_api
+
+
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import cherry_pick
+from library.protocols import lab_stuff
+from library.protocols import run_report
+
+
+metadata = {
+    'protocolName': 'Cherry picking desde csv',
+    'author': 'Luis Lorenzo Mosquera, Victor Soñora Pombo & Ismael Castiñeira Paz',
+    'source': 'Hospital Clínico Universitario de A Coruña (CHUAC)',
+    'apiLevel': '2.0',
+    'description': 'Transferencias arbitrarias (origen, pocillo, destino, pocillo, volumen) leidas de un csv'
+}
+
+
+# ------------------------
+# Sample specific parameters (INPUTS)
+# ------------------------
+csv_path = '/root/cherry_pick.csv'          # source,source_well,destination,destination_well,volume[,reagent,tip_policy]
+tip_policy = 'per-destination'              # tip policy of the rows without one (see common.TipManager)
+tube_type_source = 'eppendorf'              # Selected source tube for this protocol
+
+# Labware by slot, the slots are the source and destination of the csv
+labware = {
+    '1': 'opentrons_24_tuberack_generic_2ml_screwcap',
+    '2': 'opentrons_24_tuberack_generic_2ml_screwcap',
+    '4': 'opentrons_24_tuberack_generic_2ml_screwcap',
+    '5': 'opentrons_24_tuberack_generic_2ml_screwcap',
+    '3': 'abi_fast_qpcr_96_alum_opentrons_100ul',
+}
+
+# Each row goes to the smallest pipette that holds its volume (multichannel pipettes take whole columns)
+pipettes = [
+    {'name': 'p20_single_gen2', 'mount': 'right', 'tip_rack': 'opentrons_96_filtertiprack_20ul', 'tip_slots': ['10']},
+    {'name': 'p300_single_gen2', 'mount': 'left', 'tip_rack': 'opentrons_96_filtertiprack_200ul', 'tip_slots': ['11']},
+]
+
+
+# ------------------------
+# Protocol parameters (OUTPUTS)
+# ------------------------
+dispense_height = -10
+
+
+# ------------------------
+# Pipette parameters
+# ------------------------
+air_gap_vol_sample = 5
+x_offset = [0, 0]
+
+
+# ----------------------------
+# Main
+# ----------------------------
+pickup_height = lab_stuff.tube(tube_type_source).hpick
+
+
+def run(ctx: protocol_api.ProtocolContext):
+    picks = cherry_pick.read_picks(csv_path)
+
+    # ------------------------
+    # Load LabWare
+    # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], len(picks))
+
+    # Tip racks and pipettes
+    singles = []
+    multi = None
+    for pipette in pipettes:
+        tips = [ctx.load_labware(pipette['tip_rack'], slot) for slot in pipette['tip_slots']]
+        instrument = ctx.load_instrument(pipette['name'], pipette['mount'], tip_racks=tips)
+        if 'multi' in pipette['name']:
+            multi = instrument
+        else:
+            singles.append(instrument)
+
+    # Sources and destinations
+    loaded = {slot: ctx.load_labware(name, slot) for slot, name in labware.items()}
+
+    # ------------------
+    # Protocol
+    # ------------------
+    groups = cherry_pick.plan(cherry_pick.resolve(picks, loaded, tip_policy), singles or [multi],
+                              multi=multi if singles else None, air_gap_vol=air_gap_vol_sample)
+    tips = cherry_pick.execute(ctx, groups, air_gap_vol=air_gap_vol_sample, x_offset=x_offset,
+                               pickup_height=pickup_height, disp_height=dispense_height)
+    ctx.comment('{} picks in {} groups, {} tips'.format(len(picks), len(groups), tips))
+
+    report.finish()
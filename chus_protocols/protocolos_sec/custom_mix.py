@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                               "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 metadata = {
     'protocolName': 'C1',
@@ -37,15 +33,18 @@ NUM_OF_SOURCES_PER_RACK = 24
 # Buffer specific parameters (INPUTS)
 # ------------------------
 buffer_name = 'Lisis'                       # Selected buffer for this protocol
-sources = 5                                 # Number of sources
+component_volumes = [2, 2, 2, 2, 2]         # volume in uL per reaction of every source tube
+num_reactions = 5                           # reactions the mix is prepared for
 tube_type_source = 'criotubo'               # Selected source tube for this protocol
 
 
 # ------------------------
 # Protocol parameters (OUTPUTS)
 # ------------------------
-volume_to_be_moved = 10                     # volume in uL to be moved
 tube_type_dest = 'eppendorf'                # Selected destination tube for this protocol
+tube_max_vol = 2000                         # destination tube (2 ml screwcap)
+tube_dead_vol = 0                           # extra volume prepared for the dead volume of the tube
+mix_vol = 10                                # volume in uL of every mixing round
 
 
 # ------------------------
@@ -60,14 +59,23 @@ rounds = 20
 # Main
 # ----------------------------
 buffer = lab_stuff.buffer(buffer_name)
-_, _, _, _, pickup_height = lab_stuff.tubes(tube_type_source)
-_, _, _, dispense_height, _ = lab_stuff.tubes(tube_type_dest)
+pickup_height = lab_stuff.tube(tube_type_source).hpick
+dispense_height = lab_stuff.tube(tube_type_dest).hdisp
+sources = len(component_volumes)
+
+# Volume of every source, with its share of the dead volume (see common.plan_mastermix)
+mix_tube = common.plan_mastermix([sum(component_volumes) * num_reactions],
+                                 [{'name': str(i + 1), 'vol': v} for i, v in enumerate(component_volumes)],
+                                 tube_max_vol, tube_dead_vol, max_tubes=1)[0]
 
 
 def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], sources)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_200ul', slot, '200µl filter tiprack') for slot in ['11']]
 
@@ -85,14 +93,15 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------
     # Protocol
     # ------------------
-    for s in source_racks:
+    for s, (_, volume_to_be_moved) in zip(source_racks, mix_tube['additions']):
         if not p300.hw_pipette['has_tip']:
             common.pick_up(p300)
 
-        common.move_vol_multichannel(ctx, p300, reagent=buffer, source=s, dest=dest_rack,
-                                     vol=volume_to_be_moved, air_gap_vol=air_gap_vol_sample,
-                                     pickup_height=pickup_height, disp_height=dispense_height,
-                                     x_offset=x_offset, blow_out=True, touch_tip=True)
+        for vol in common.divide_volume(volume_to_be_moved, p300.max_volume - air_gap_vol_sample):
+            common.move_vol_multichannel(ctx, p300, reagent=buffer, source=s, dest=dest_rack,
+                                         vol=vol, air_gap_vol=air_gap_vol_sample,
+                                         pickup_height=pickup_height, disp_height=dispense_height,
+                                         x_offset=x_offset, blow_out=True, touch_tip=True)
 
         # Drop pipette tip
         p300.drop_tip()
@@ -100,7 +109,9 @@ def run(ctx: protocol_api.ProtocolContext):
     if not p300.hw_pipette['has_tip']:
         common.pick_up(p300)
 
-    common.custom_mix(p300, reagent=buffer, location=dest_rack, vol=volume_to_be_moved,
+    common.custom_mix(p300, reagent=buffer, location=dest_rack, vol=mix_vol,
                       rounds=rounds, blow_out=True, mix_height=dispense_height, x_offset=x_offset, source_height=dispense_height)
 
     p300.drop_tip()
+
+    report.finish()
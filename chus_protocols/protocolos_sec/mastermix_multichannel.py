@@ -1,22 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-
-# Load library
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 
 metadata = {
@@ -40,15 +35,16 @@ NUM_OF_SOURCES_PER_RACK = 24
 # Sample specific parameters (INPUTS)
 # ------------------------
 reagent_name = 'Sample'                         # Selected buffer for this protocol
-tube_type_source = 'eppendorf'                  # Selected destination tube for this protocol
-
+brand_name = 'vircell'                          # Selected brand, gives the master mix volume per well
+num_destinations = 96                           # wells of the final plate, by columns
 
 
 # ------------------------
 # Protocol parameters (OUTPUTS)
 # ------------------------
-volume_to_be_transfered = 10                   # volume in uL to be moved
-num_destinations = 96
+strip_dead_vol = 5                              # volume left in each well of the intermediate strip
+tube_max_vol = 2000                             # master mix tube (2 ml screwcap)
+tube_dead_vol = 20                              # volume left in each master mix tube
 
 
 # ------------------------
@@ -61,64 +57,88 @@ x_offset = [0, 0]
 # ----------------------------
 # Main
 # ----------------------------
-
-_, _, _, _, pickup_height = lab_stuff.tubes(tube_type_source)
 sample = lab_stuff.buffer(reagent_name)
+mastermix_vol, _, _ = lab_stuff.brands(brand_name)
 
-num_cols = math.ceil(num_destinations / 8)
-num_rows = math.ceil(num_destinations / 12)
-final_vol = (volume_to_be_transfered * 10) / 12
 
 def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
 
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_destinations)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, 'Tiprack') for slot in ['11']]
+    # The 8-channel has its own rack, the single channel would leave it incomplete columns
+    tips_multi = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, 'Tiprack multi') for slot in ['10']]
 
     # Pipettes
     p20 = ctx.load_instrument('p20_single_gen2', 'right', tip_racks=tips)
-    m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks=tips)
+    m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks=tips_multi)
 
-    # Source
+    # Source (master mix tubes)
     source_plate = ctx.load_labware('opentrons_24_tuberack_generic_2ml_screwcap', '7', 'Tuberack')
-    source_1 = source_plate.wells()[0]
 
-    # Destination 1 (and source for the 2nd destination)
+    # Intermediate strips (columns of 'dest_plate1', source for the 2nd destination)
     dest_plate1 = ctx.load_labware('abi_fast_qpcr_96_alum_opentrons_100ul', '4', 'PCR plate')
-    dest_1 = dest_plate1.columns()[0][:num_rows]
-    source_2 = dest_plate1.wells()[0]
 
     # Destination 2 (destination of 'dest_plate1')
     dest_plate2 = ctx.load_labware('abi_fast_qpcr_96_alum_opentrons_100ul', '1', 'PCR plate')
-    dest_2 = dest_plate2.rows()[0][:num_cols]
 
     # ------------------
-    # Protocol
+    # Plan (strip volumes, multichannel trips and master mix tubes)
     # ------------------
+    fan_out = common.plan_fan_out(num_destinations, mastermix_vol, strip_max_vol=dest_plate1.wells()[0].max_volume,
+                                  strip_dead_vol=strip_dead_vol, multi_max_vol=m20.max_volume,
+                                  air_gap_vol=air_gap_vol_sample, max_strips=len(dest_plate1.columns()))
+    # Wells filled from the master mix tubes: the strips, then the destinations served without a strip
+    fill_wells = [w for column in dest_plate1.columns()[:len(fan_out['strips'])] for w in column] + \
+        [dest_plate2.wells()[d] for d in fan_out['direct']]
+    fills = [v for strip in fan_out['strips'] for v in strip['fill']] + [mastermix_vol] * len(fan_out['direct'])
+    tubes = common.plan_mastermix(fills, [{'name': 'Master mix', 'vol': mastermix_vol}], tube_max_vol,
+                                  tube_dead_vol, max_tubes=len(source_plate.wells()))
+    for tube, well in zip(tubes, source_plate.wells()):
+        ctx.comment('Master mix {}: {} µl'.format(well, tube['total']))
+    ctx.comment('{} strips, {} µl, {} multichannel trips'.format(len(fan_out['strips']), fan_out['total'],
+                                                                 fan_out['trips']))
 
-    if not p20.hw_pipette['has_tip']:
-        common.pick_up(p20)
-
-    for d in dest_1:
-        common.move_vol_multichannel(ctx, p20, reagent=sample, source=source_1, dest=d,
-                                     vol=volume_to_be_transfered, air_gap_vol=air_gap_vol_sample,
-                                     x_offset=x_offset, pickup_height=1, disp_height=-10,
-                                     blow_out=True, touch_tip=False)
-
-    p20.return_tip()
-
-    if not m20.hw_pipette['has_tip']:
+    # ------------------
+    # Protocol
+    # ------------------
+    # Fill the strips (and the destinations served without a strip) from the master mix tubes
+    common.pick_up(p20)
+    for tube, source in zip(tubes, source_plate.wells()):
+        common.multi_dispense(ctx, p20, reagent=sample, source=source,
+                              dests=[fill_wells[i] for i in tube['wells']], vol=[fills[i] for i in tube['wells']],
+                              air_gap_vol=air_gap_vol_sample, x_offset=x_offset, pickup_height=1, disp_height=-10,
+                              blow_out=True, touch_tip=False)
+    p20.drop_tip()
+
+    # Whole columns with the multichannel, one tip per strip
+    for s, strip in enumerate(fan_out['strips']):
+        if not strip['columns']:
+            continue
         common.pick_up(m20)
-
-    for d in dest_2:
-        common.move_vol_multichannel(ctx, m20, reagent=sample, source=source_2, dest=d,
-                                     vol=final_vol, air_gap_vol=air_gap_vol_sample,
-                                     x_offset=x_offset, pickup_height=1, disp_height=-10,
-                                     blow_out=True, touch_tip=True)
-
-    m20.drop_tip()
+        common.multi_dispense(ctx, m20, reagent=sample, source=dest_plate1.columns()[s][0],
+                              dests=[dest_plate2.columns()[c][0] for c in strip['columns']], vol=mastermix_vol,
+                              air_gap_vol=air_gap_vol_sample, x_offset=x_offset, pickup_height=1, disp_height=-10,
+                              blow_out=True, touch_tip=True)
+        m20.drop_tip()
+
+    # Wells of an incomplete last column with the single channel, from the strip well of their row
+    for s, strip in enumerate(fan_out['strips']):
+        for d in strip['single']:
+            common.pick_up(p20)
+            for vol in common.divide_volume(mastermix_vol, p20.max_volume - air_gap_vol_sample):
+                common.move_vol_multichannel(ctx, p20, reagent=sample, source=dest_plate1.columns()[s][d % 8],
+                                             dest=dest_plate2.wells()[d], vol=vol,
+                                             air_gap_vol=air_gap_vol_sample, x_offset=x_offset, pickup_height=1,
+                                             disp_height=-10, blow_out=True, touch_tip=True)
+            p20.drop_tip()
+
+    report.finish()
 
     # Notify users
-    # common.notify_finish_process()
\ No newline at end of file
+    # common.notify_finish_process()
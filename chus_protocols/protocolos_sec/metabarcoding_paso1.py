@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                               "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 metadata = {
     'protocolName': 'C1',
@@ -63,8 +59,8 @@ rounds = 20
 # Main
 # ----------------------------
 buffer = lab_stuff.buffer(buffer_name)
-_, _, _, _, pickup_height = lab_stuff.tubes(tube_type_mastermix)
-_, _, _, dispense_height, _ = lab_stuff.tubes(tube_type_sample)
+pickup_height = lab_stuff.tube(tube_type_mastermix).hpick
+dispense_height = lab_stuff.tube(tube_type_sample).hdisp
 
 num_cols = math.ceil(num_destinations / 8)
 num_rows = math.ceil(num_destinations / 12)
@@ -74,6 +70,9 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_destinations)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['10', '11']]
 
@@ -171,3 +170,5 @@ def run(ctx: protocol_api.ProtocolContext):
                                      x_offset=x_offset, pickup_height=1, disp_height=-10,
                                      blow_out=True, touch_tip=True)
         p20.drop_tip()
+
+    report.finish()
@@ -1,21 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import math
-import importlib
+import os
+import sys
 from opentrons import protocol_api
 
-# Load library
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                               "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import run_report
 
 metadata = {
     'protocolName': 'C1',
@@ -46,11 +42,20 @@ tube_type_sample = 'eppendorf'              # Selected sample tube for this prot
 # Protocol parameters (OUTPUTS)
 # ------------------------
 vol_to_mix = 10                             # Vol to mix in mastermix
-mastermix_vol_to_move = 272.82              # volume to move from mastermix tube to pcr tubes
 sample_vol_to_move = 5                      # volume to move from pcr samples to the pcr plate
 num_destinations = 96                       # Num of destinations from pcr plate
 pcr_index_vol_to_move = 10                  # PCR Index vol to move
 
+# Componentes de la mastermix (volumen por reaccion, en los primeros tubos del bloque de aluminio)
+mastermix_components = [
+    {'name': 'Reactivo 1', 'vol': 12.5},
+    {'name': 'Reactivo 2', 'vol': 5.05},
+    {'name': 'Reactivo 3', 'vol': 5.05},
+]
+strip_dead_vol = 5                          # volumen muerto de cada pocillo de la tira intermedia
+tube_max_vol = 2000                         # tubo de mastermix (2 ml)
+tube_dead_vol = 20                          # volumen muerto de cada tubo de mastermix
+
 
 # ------------------------
 # Pipette parameters
@@ -64,44 +69,45 @@ rounds = 3
 # Main
 # ----------------------------
 buffer = lab_stuff.buffer(buffer_name)
-_, _, _, _, pickup_height = lab_stuff.tubes(tube_type_mastermix)
-_, _, _, dispense_height, _ = lab_stuff.tubes(tube_type_sample)
+pickup_height = lab_stuff.tube(tube_type_mastermix).hpick
+dispense_height = lab_stuff.tube(tube_type_sample).hdisp
 
 num_cols = math.ceil(num_destinations / 8)
 num_rows = math.ceil(num_destinations / 12)
-pcr_final_vol = mastermix_vol_to_move / 12
+mastermix_vol = sum(c['vol'] for c in mastermix_components)
 
 def run(ctx: protocol_api.ProtocolContext):
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_destinations)
+
     # Tip racks
     tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['10', '11']]
+    # La multicanal tiene su propia caja, la p20 le dejaría columnas incompletas
+    tips_multi = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack multi') for slot in ['7']]
 
     # Pipette
     p20 = ctx.load_instrument('p20_single_gen2', 'right', tip_racks=tips)
-    m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks=tips)
+    m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks=tips_multi)
 
     # Modules
     tempdeck = ctx.load_module('temperature module gen2', '1')
-    tempdeck.set_temperature(4)
+    common.start_temperature(tempdeck, 4)
 
-    # Mastermix source
+    # Mastermix source (components and then the mastermix tubes)
     mastermix = tempdeck.load_labware('opentrons_24_aluminumblock_generic_2ml_screwcap')
-    mastermix_sources = mastermix.wells()[:2]
-    mastermix_volumes = [1200, 485, 485]
-    mastermix_sources = zip(mastermix_sources, mastermix_volumes)
-    mastermix_tube = mastermix.wells()[2]
+    component_sources = mastermix.wells()[:len(mastermix_components)]
+    mastermix_tubes = mastermix.wells()[len(mastermix_components):]
 
     # PCR Index source
     source_plate = ctx.load_labware('opentrons_24_tuberack_generic_2ml_screwcap', '5', 'Tuberack')
     source_1 = source_plate.wells()[:8]
     source_2 = source_plate.wells()[8:20]
 
-    # Mastermix destination 1
+    # Mastermix destination 1 (intermediate strips)
     dest_plate1 = ctx.load_labware('abi_fast_qpcr_96_alum_opentrons_100ul', '2', 'PCR plate')
-    dest_1 = dest_plate1.columns()[0][:num_rows]
-    source_3 = dest_plate1.wells()[0]
 
     # Mastermix and PCR Index destination
     dest_plate2 = ctx.load_labware('abi_fast_qpcr_96_alum_opentrons_100ul', '3', 'PCR plate')
@@ -117,6 +123,21 @@ def run(ctx: protocol_api.ProtocolContext):
     dest_4 = source_plate4.rows()[0][:num_cols]
 
 
+    # ------------------
+    # Plan (strip volumes, multichannel trips and mastermix tubes)
+    # ------------------
+    fan_out = common.plan_fan_out(num_destinations, mastermix_vol, strip_max_vol=dest_plate1.wells()[0].max_volume,
+                                  strip_dead_vol=strip_dead_vol, multi_max_vol=m20.max_volume,
+                                  air_gap_vol=air_gap_vol_sample, max_strips=len(dest_plate1.columns()))
+    # Pocillos que se llenan desde los tubos de mastermix: las tiras y los destinos servidos sin tira
+    fill_wells = [w for column in dest_plate1.columns()[:len(fan_out['strips'])] for w in column] + \
+        [dest_plate2.wells()[d] for d in fan_out['direct']]
+    fills = [v for strip in fan_out['strips'] for v in strip['fill']] + [mastermix_vol] * len(fan_out['direct'])
+    tubes = common.plan_mastermix(fills, mastermix_components, tube_max_vol, tube_dead_vol,
+                                  max_tubes=len(mastermix_tubes))
+    ctx.comment('{} tubos de mastermix, {} tiras, {} µl, {} viajes de la multicanal'.format(
+        len(tubes), len(fan_out['strips']), fan_out['total'], fan_out['trips']))
+
     # ------------------
     # Protocol
     # ------------------
@@ -124,49 +145,68 @@ def run(ctx: protocol_api.ProtocolContext):
     # ------------------
     # Hacemos la mastermix
     # ------------------
+    common.wait_temperature(tempdeck, 4)
 
-    for s, v in mastermix_sources:
+    for c, s in enumerate(component_sources):
         if not p20.hw_pipette['has_tip']:
             common.pick_up(p20)
 
-        common.move_vol_multichannel(ctx, p20, reagent=buffer, source=s, dest=mastermix_tube,
-                                     vol=v, air_gap_vol=air_gap_vol_sample,
-                                     pickup_height=pickup_height, disp_height=dispense_height,
-                                     x_offset=x_offset, blow_out=True, touch_tip=True)
+        for tube, mastermix_tube in zip(tubes, mastermix_tubes):
+            name, vol = tube['additions'][c]
+            ctx.comment('{}: {} µl a {}'.format(name, vol, mastermix_tube))
+            for v in common.divide_volume(vol, p20.max_volume - air_gap_vol_sample):
+                common.move_vol_multichannel(ctx, p20, reagent=buffer, source=s, dest=mastermix_tube,
+                                             vol=v, air_gap_vol=air_gap_vol_sample,
+                                             pickup_height=pickup_height, disp_height=dispense_height,
+                                             x_offset=x_offset, blow_out=True, touch_tip=True)
 
         # Drop pipette tip
         p20.drop_tip()  # TODO: preguntar si hace falta tirar la punta o no
 
-    if not p20.hw_pipette['has_tip']:
-        common.pick_up(p20)
+    for mastermix_tube in mastermix_tubes[:len(tubes)]:
+        if not p20.hw_pipette['has_tip']:
+            common.pick_up(p20)
 
-    common.custom_mix(p20, reagent=buffer, location=mastermix_tube, vol=vol_to_mix,
-                      rounds=rounds, blow_out=True, mix_height=dispense_height, x_offset=x_offset, source_height=dispense_height)
+        common.custom_mix(p20, reagent=buffer, location=mastermix_tube, vol=vol_to_mix,
+                          rounds=rounds, blow_out=True, mix_height=dispense_height, x_offset=x_offset, source_height=dispense_height)
 
     # ------------------
-    # Dispensamos mastermix en tira de pcr y con la multi lo propagamos en la placa pcr del slot 3
+    # Dispensamos mastermix en tiras de pcr y con la multi lo propagamos en la placa pcr del slot 3
     # ------------------
 
     if not p20.hw_pipette['has_tip']:
         common.pick_up(p20)
 
-    for d in dest_1:
-        common.move_vol_multichannel(ctx, p20, reagent=buffer, source=mastermix_tube, dest=d,
-                                     vol=mastermix_vol_to_move, air_gap_vol=air_gap_vol_sample,
-                                     x_offset=x_offset, pickup_height=1, disp_height=-10,
-                                     blow_out=True, touch_tip=False)
+    for tube, mastermix_tube in zip(tubes, mastermix_tubes):
+        common.multi_dispense(ctx, p20, reagent=buffer, source=mastermix_tube,
+                              dests=[fill_wells[i] for i in tube['wells']], vol=[fills[i] for i in tube['wells']],
+                              air_gap_vol=air_gap_vol_sample, x_offset=x_offset, pickup_height=1, disp_height=-10,
+                              blow_out=True, touch_tip=False)
 
     p20.drop_tip()
 
-    if not m20.hw_pipette['has_tip']:
-        common.pick_up(m20)
-
-    for d in dest_2:
-        common.move_vol_multichannel(ctx, m20, reagent=buffer, source=source_3, dest=d,
-                                     vol=pcr_final_vol, air_gap_vol=air_gap_vol_sample,
-                                     x_offset=x_offset, pickup_height=1, disp_height=-10,
-                                     blow_out=True, touch_tip=True)
-    m20.drop_tip()
+    for s, strip in enumerate(fan_out['strips']):
+        if not strip['columns']:
+            continue
+        if not m20.hw_pipette['has_tip']:
+            common.pick_up(m20)
+        common.multi_dispense(ctx, m20, reagent=buffer, source=dest_plate1.columns()[s][0],
+                              dests=[dest_plate2.columns()[c][0] for c in strip['columns']], vol=mastermix_vol,
+                              air_gap_vol=air_gap_vol_sample, x_offset=x_offset, pickup_height=1, disp_height=-10,
+                              blow_out=True, touch_tip=True)
+        m20.drop_tip()
+
+    # Pocillos de una ultima columna incompleta con la p20, desde el pocillo de la tira de su fila
+    for s, strip in enumerate(fan_out['strips']):
+        for d in strip['single']:
+            if not p20.hw_pipette['has_tip']:
+                common.pick_up(p20)
+            for v in common.divide_volume(mastermix_vol, p20.max_volume - air_gap_vol_sample):
+                common.move_vol_multichannel(ctx, p20, reagent=buffer, source=dest_plate1.columns()[s][d % 8],
+                                             dest=dest_plate2.wells()[d], vol=v, air_gap_vol=air_gap_vol_sample,
+                                             x_offset=x_offset, pickup_height=1, disp_height=-10,
+                                             blow_out=True, touch_tip=True)
+            p20.drop_tip()
 
     # ------------------
     # PCR Index
@@ -215,6 +255,8 @@ def run(ctx: protocol_api.ProtocolContext):
                                      blow_out=True, touch_tip=True)
     m20.drop_tip()
 
+    report.finish()
+
 
     # Notify users
     # common.notify_finish_process()
@@ -1,25 +1,20 @@
 # -*- coding: utf-8 -*-
 
-import pandas as pd
-import importlib
 import math
+import os
+import sys
 
 from opentrons import protocol_api
 
 
-LIBRARY_PATH = '/root/ot2-covid19/library/'
-
-# Load library
-spec = importlib.util.spec_from_file_location("library.protocols.common_functions",
-                                              "{}protocols/common_functions.py".format(LIBRARY_PATH))
-common = importlib.util.module_from_spec(spec)
-spec.loader.exec_module(common)
-
-# Load Brands & other stuff
-spec2 = importlib.util.spec_from_file_location("library.protocols.lab_stuff",
-                                              "{}protocols/lab_stuff.py".format(LIBRARY_PATH))
-lab_stuff = importlib.util.module_from_spec(spec2)
-spec2.loader.exec_module(lab_stuff)
+# Load library (LIBRARY_PATH is the folder containing library/ or a zipped bundle, see library/loader.py)
+LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+if LIBRARY_PATH not in sys.path:
+    sys.path.insert(0, LIBRARY_PATH)
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import normalization
+from library.protocols import run_report
 
 
 metadata = {
@@ -42,16 +37,17 @@ NUM_OF_SOURCES_PER_RACK = 24
 # Sample specific parameters (INPUTS)
 # ------------------------
 reagent_name = 'Sample'                     # Selected buffer for this protocol
-num_samples = 96                            # total number of samples
 tube_type_source = 'eppendorf'              # Selected source tube for this protocol
+csv_path = '/root/prepare_pcr.csv'          # concentration table uploaded with subir_excel.sh (ID,Ci,Cf,Vf)
+plate = 1                                   # plate of the table to prepare (Plate column, or rows 96 by 96)
+skip_invalid_rows = False                   # True: rows that cannot be prepared are skipped instead of stopping
 
 
 # ------------------------
 # Protocol parameters (OUTPUTS)
 # ------------------------
-num_destinations = 96                       # total number of destinations
-volume_to_be_transferred = 200              # volume in uL to be moved from 1 source to 1 destination
 dispense_height = -10
+pickup_height_buffer = 60                   # mm from the bottom of the falcon (at least 30 ml of buffer)
 
 
 # ------------------------
@@ -61,97 +57,93 @@ air_gap_vol_sample = 5
 x_offset = [0, 0]
 
 # ----------------------------
-# Read csv and compute vols
+# Volumes
 # ----------------------------
-
-data = pd.read_csv("prepare_pcr.csv")
-
 # Ci = Concentracion inicial
 # Cf = Concentracion final
 # Vf = Volumen final
-# Vi = Volumen incognita
-# Vt = Volumen tampon
-
-def calculate_vi(row):
-    return (row['Cf'] * row['Vf']) / row['Ci']
-
-
-def calculate_vt(row):
-    return row['vi'] - row['Vf']
-
-
-data['vi'] = data.apply(calculate_vi, axis=1)
-data['vt'] = data.apply(calculate_vt, axis=1)
-
-vi = list(data['vi'].fillna(0)).reverse()
-vt = list(data['vt'].fillna(0)).reverse()
+# Vi = Volumen muestra = Cf * Vf / Ci
+# Vt = Volumen tampon = Vf - Vi
+# (calculados en run() con library/protocols/normalization.py)
 
 
 # ----------------------------
 # Main
 # ----------------------------
 sample = lab_stuff.buffer(reagent_name)
-_, _, _, _, pickup_height = lab_stuff.tubes(tube_type_source)
+pickup_height = lab_stuff.tube(tube_type_source).hpick
 
 
 def run(ctx: protocol_api.ProtocolContext):
+    # ------------------------
+    # Volumes
+    # ------------------------
+    table = normalization.select_plate(normalization.read_table(csv_path), plate)
+    volumes = normalization.normalize(table, min_vol=1)
+    for well_id, reason in volumes['errors']:
+        ctx.comment('{}: {}'.format(well_id, reason))
+    if volumes['errors'] and not skip_invalid_rows:
+        raise ValueError('{} rows of {} cannot be prepared: {}'.format(
+            len(volumes['errors']), csv_path, ', '.join(well_id for well_id, _ in volumes['errors'])))
+    num_rows = len(table['ID'])
+    if num_rows > MAX_NUM_OF_SOURCES:
+        raise ValueError('Plate {} has {} rows, the deck holds {} samples'.format(plate, num_rows, MAX_NUM_OF_SOURCES))
+    num_samples = int(volumes['valid'].sum())
+
     # ------------------------
     # Load LabWare
     # ------------------------
+    # Run report (see library/protocols/run_report.py)
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_samples)
+
     # Tip racks
-    tips = [ctx.load_labware('opentrons_96_filtertiprack_1000ul', slot, '1000µl filter tiprack') for slot in ['10', '11']]
+    tips = [ctx.load_labware('opentrons_96_filtertiprack_20ul', slot, '20µl filter tiprack') for slot in ['10', '11']]
 
     # Pipette
     p20 = ctx.load_instrument('p20_single_gen2', 'right', tip_racks=tips)
 
-    # Source Samples
-    rack_num = math.ceil(num_samples / NUM_OF_SOURCES_PER_RACK) if num_samples < MAX_NUM_OF_SOURCES else MIN_NUM_OF_SOURCES
+    # Source Samples (row i of the table is the tube i of the racks)
+    rack_num = math.ceil(num_rows / NUM_OF_SOURCES_PER_RACK)
     source_racks = [ctx.load_labware(
         'opentrons_24_tuberack_generic_2ml_screwcap', slot,
         'source tuberack with screwcap' + str(i + 1)) for i, slot in enumerate(['1', '2', '4', '5'][:rack_num])
     ]
-    sample_sources_full = common.generate_source_table(source_racks)
-    sample_sources = sample_sources_full[:num_samples]
+    sample_sources = common.generate_source_table(source_racks)[:num_rows]
 
     # Source TRIS
     tris = ctx.load_labware('opentrons_6_tuberack_falcon_50ml_conical', '6', 'Buffer tuberack in Falcon tube')
     tris_phalcon = tris.wells()[0]
+    report.add_reagent('TRIS', tris_phalcon)
 
-    # Destination (in this case 96 well plate)
+    # Destination (in this case 96 well plate), by the ID of every row or in the order of the table
     dest_plate = ctx.load_labware('abi_fast_qpcr_96_alum_opentrons_100ul', '3', 'PCR final plate')
-    destinations = dest_plate.wells()[:num_destinations]
+    positions = normalization.well_positions(table['ID'], list(dest_plate.wells_by_name()))
+    destinations = [dest_plate.wells()[i] for i in positions]
 
     # ------------------
     # Protocol
     # ------------------
-    if not p20.hw_pipette['has_tip']:
-        common.pick_up(p20)
+    plan = normalization.plan_transfers(volumes, p20.max_volume - air_gap_vol_sample)
 
-    # Dispense 4mM of sample in PCR plate
-    for s, d in zip(sample_sources, destinations):
-        if not p20.hw_pipette['has_tip']:
-            common.pick_up(p20)
-
-        sample_volume_to_be_transferred = vi.pop()
-
-        # Calculate pickup_height based on remaining volume and shape of container
-        common.move_vol_multichannel(ctx, p20, reagent=sample, source=s, dest=d,
-                                     vol=sample_volume_to_be_transferred, air_gap_vol=air_gap_vol_sample,
-                                     pickup_height=pickup_height, disp_height=dispense_height,
-                                     x_offset=x_offset, blow_out=True, touch_tip=True)
-        # Drop pipette tip
+    # Dispense TRIS to every well with one tip (from the top, the tip never touches the liquid)
+    if plan['buffer']:
+        common.pick_up(p20)
+        common.multi_dispense(ctx, p20, reagent=sample, source=tris_phalcon,
+                              dests=[destinations[i] for i, _ in plan['buffer']],
+                              vol=[v for _, v in plan['buffer']], air_gap_vol=air_gap_vol_sample,
+                              pickup_height=pickup_height_buffer, disp_height=dispense_height,
+                              x_offset=x_offset, blow_out=True, touch_tip=False)
         p20.drop_tip()
 
-    # Dispense rest volume of TRIS in each sample of PCR
-    for d in destinations:
-
-        if not p20.hw_pipette['has_tip']:
-            common.pick_up(p20)
-
-        tris_volume_to_be_transferred = vt.pop()
-        common.move_vol_multichannel(ctx, p20, reagent=sample, source=tris_phalcon, dest=d,
-                                     vol=tris_volume_to_be_transferred, air_gap_vol=air_gap_vol_sample,
-                                     pickup_height=pickup_height, disp_height=dispense_height,
-                                     x_offset=x_offset, blow_out=True, touch_tip=True)
+    # Dispense the sample volume of every well, one tip per sample
+    for i, parts in plan['samples']:
+        common.pick_up(p20)
+        for vol in parts:
+            common.move_vol_multichannel(ctx, p20, reagent=sample, source=sample_sources[i], dest=destinations[i],
+                                         vol=vol, air_gap_vol=air_gap_vol_sample,
+                                         pickup_height=pickup_height, disp_height=dispense_height,
+                                         x_offset=x_offset, blow_out=True, touch_tip=True)
         # Drop pipette tip
         p20.drop_tip()
+
+    report.finish()
@@ -0,0 +1,3 @@
+"""
+Common library for the ot2-covid19 protocols.
+"""
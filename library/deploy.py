@@ -0,0 +1,351 @@
+"""
+Fleet deployment of the library (and protocols) to the robots.
+
+Only the files whose content changed are sent. Every robot keeps a manifest with the SHA-256 of the deployed files
+(<remote path>/.deploy_manifest.json); it is compared with the local hashes, the changed files are sent in a single
+tar stream, files removed from the library are deleted and the hashes on the robot are checked before the new
+manifest is written. All the robots of a group are updated at the same time.
+
+Only the files in the scope of a deploy (library/ and the protocol folders or files given) are deleted or replaced
+in the manifest: a library deploy keeps the protocols sent by an earlier --protocols deploy.
+
+    python -m library.deploy a                       # library to the A robots
+    python -m library.deploy c --protocols           # library and chus_protocols/protocolos_c
+    python -m library.deploy --site coruna b
+    python -m library.deploy all --local /tmp/fleet  # robots are folders /tmp/fleet/<ip>, for testing
+
+SSH uses the key given with --key. If the SSHPASS environment variable is set the commands go through sshpass -e,
+like the old update-all-robots-library scripts.
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+
+from library.loader import ROOT, bundle_files
+
+
+MANIFEST_NAME = '.deploy_manifest.json'
+DEFAULT_REMOTE_PATH = '/root/ot2-covid19'
+DEFAULT_USER = 'root'
+DEFAULT_KEY_PATH = '~/ot-ssh-key'
+LIBRARY_SCOPE = 'library/'
+
+FLEETS = {
+    'santiago': {
+        'a': ['192.168.167.51', '192.168.167.52'],
+        'b': ['192.168.167.54', '192.168.167.55', '192.168.167.56'],
+        'c': ['192.168.167.58', '192.168.167.59'],
+    },
+    'coruna': {
+        'a': ['69.101.94.150', '69.101.94.157'],
+        'b': ['69.101.94.151', '69.101.94.152', '69.101.94.156'],
+        'c': ['69.101.94.153', '69.101.94.155'],
+        's': ['69.101.94.154'],
+    },
+}
+
+GROUP_PROTOCOLS = {
+    'a': ['chus_protocols/protocolos_a'],
+    'b': ['chus_protocols/protocolos_b'],
+    'c': ['chus_protocols/protocolos_c', 'chus_protocols/protocolos_extraccion_cruda'],
+    's': ['chus_protocols/protocolos_sec'],
+}
+
+
+class DeployError(Exception):
+    pass
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def protocol_files(paths, root=ROOT):
+    """
+    Python files of the given protocol files, folders or glob patterns, relative to [root]
+    """
+    files = []
+    for path in paths:
+        for match in sorted(glob.glob(os.path.join(root, path))):
+            if os.path.isdir(match):
+                files += sorted(os.path.join(match, f) for f in os.listdir(match) if f.endswith('.py'))
+            elif match.endswith('.py'):
+                files.append(match)
+    return [os.path.relpath(f, root) for f in files]
+
+
+def protocol_scope(paths, root=ROOT):
+    """
+    Scope of the given protocol files, folders or glob patterns: 'folder/' for folders, the path for files
+    """
+    scope = []
+    for path in paths:
+        for match in sorted(glob.glob(os.path.join(root, path))):
+            name = os.path.relpath(match, root).replace(os.sep, '/')
+            scope.append(name.rstrip('/') + '/' if os.path.isdir(match) else name)
+    return scope
+
+
+def in_scope(name, scope):
+    return any(name == s or (s.endswith('/') and name.startswith(s)) for s in scope)
+
+
+def local_manifest(files, root=ROOT):
+    """
+    {relative path: sha256} of the files to deploy
+    """
+    return {name.replace(os.sep, '/'): file_hash(os.path.join(root, name)) for name in files}
+
+
+def changes(local, remote, scope=(LIBRARY_SCOPE,)):
+    """
+    Files to send (new or different content) and files to delete (deployed before within [scope], no longer in the
+    local set)
+
+    :param local: manifest of the local files
+    :param remote: manifest found in the robot ({} if there is none)
+    :param scope: paths ('folder/' or files) this deploy is responsible for
+    """
+    send = sorted(name for name, digest in local.items() if remote.get(name) != digest)
+    delete = sorted(name for name in remote if name not in local and in_scope(name, scope))
+    return send, delete
+
+
+def merge_manifest(local, remote, scope=(LIBRARY_SCOPE,)):
+    """
+    Manifest of the robot after a deploy: the local files plus the deployed files out of [scope]
+    """
+    merged = {name: digest for name, digest in remote.items() if not in_scope(name, scope)}
+    merged.update(local)
+    return merged
+
+
+def tar_stream(files, root=ROOT):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name in files:
+            tar.add(os.path.join(root, name), arcname=name)
+    return buffer.getvalue()
+
+
+class LocalTarget:
+    """
+    Robot stand-in: a local folder playing the role of the remote path
+    """
+
+    def __init__(self, host, path):
+        self.host = host
+        self.path = path
+
+    def read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def send(self, files, root=ROOT):
+        with tarfile.open(fileobj=io.BytesIO(tar_stream(files, root))) as tar:
+            tar.extractall(self.path)
+
+    def delete(self, files):
+        for name in files:
+            if os.path.isfile(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+
+    def hashes(self, files):
+        return {name: file_hash(os.path.join(self.path, name))
+                for name in files if os.path.isfile(os.path.join(self.path, name))}
+
+    def write_manifest(self, manifest):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+class SSHTarget(LocalTarget):
+    """
+    Robot reached through ssh. Every operation is a single ssh command
+
+    :param key_path: private key of the robots
+    :param timeout: seconds before a command is given up
+    """
+
+    def __init__(self, host, path, user=DEFAULT_USER, key_path=DEFAULT_KEY_PATH, timeout=60):
+        super().__init__(host, path)
+        self.user = user
+        self.key_path = os.path.expanduser(key_path)
+        self.timeout = timeout
+
+    def run(self, command, data=None):
+        args = ['ssh', '-i', self.key_path, '-o', 'ConnectTimeout=10', '-o', 'StrictHostKeyChecking=accept-new',
+                '{}@{}'.format(self.user, self.host), command]
+        if os.environ.get('SSHPASS'):
+            args = ['sshpass', '-e'] + args
+        result = subprocess.run(args, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                timeout=self.timeout)
+        if result.returncode != 0:
+            raise DeployError('{}: {} failed: {}'.format(
+                self.host, command.split()[0], result.stderr.decode(errors='replace').strip()))
+        return result.stdout.decode()
+
+    def read_manifest(self):
+        output = self.run('cat {} 2>/dev/null || true'.format(shlex.quote(self.path + '/' + MANIFEST_NAME)))
+        try:
+            return json.loads(output) if output.strip() else {}
+        except ValueError:
+            return {}
+
+    def send(self, files, root=ROOT):
+        quoted = shlex.quote(self.path)
+        self.run('mkdir -p {0} && tar -xf - -C {0}'.format(quoted), data=tar_stream(files, root))
+
+    def delete(self, files):
+        if files:
+            self.run('cd {} && rm -f {}'.format(shlex.quote(self.path), ' '.join(shlex.quote(f) for f in files)))
+
+    def hashes(self, files):
+        if not files:
+            return {}
+        output = self.run('cd {} && sha256sum {} 2>/dev/null || true'.format(
+            shlex.quote(self.path), ' '.join(shlex.quote(f) for f in files)))
+        result = {}
+        for line in output.splitlines():
+            digest, _, name = line.partition('  ')
+            result[name] = digest
+        return result
+
+    def write_manifest(self, manifest):
+        data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+        target = shlex.quote(self.path + '/' + MANIFEST_NAME)
+        self.run('cat > {0}.tmp && mv {0}.tmp {0}'.format(target), data=data)
+
+
+def verify(target, manifest):
+    """
+    Files of the manifest missing or with a different content in the robot
+    """
+    remote = target.hashes(sorted(manifest))
+    return sorted(name for name, digest in manifest.items() if remote.get(name) != digest)
+
+
+def deploy(target, manifest, root=ROOT, dry_run=False, scope=(LIBRARY_SCOPE,)):
+    """
+    Bring one robot up to date with the local files
+
+    :param target: LocalTarget or SSHTarget
+    :param manifest: local manifest, see local_manifest
+    :param scope: paths ('folder/' or files) this deploy is responsible for, nothing else is deleted
+    :return: {'host', 'sent', 'deleted', 'error'}
+    """
+    report = {'host': target.host, 'sent': [], 'deleted': [], 'error': None}
+    try:
+        remote = target.read_manifest()
+        send, delete = changes(manifest, remote, scope)
+        # Nothing out of the scope is ever sent or deleted, also checked on a dry run
+        outside = [name for name in sorted(manifest) + delete if not in_scope(name, scope)]
+        if outside:
+            raise DeployError('{}: files out of the deploy scope {}: {}'.format(
+                target.host, ', '.join(scope), ', '.join(outside)))
+        report['sent'], report['deleted'] = send, delete
+        if dry_run:
+            return report
+        if send:
+            target.send(send, root)
+        target.delete(delete)
+        # Check every deployed file, not only the sent ones, so files edited by hand in the robot are sent again
+        wrong = verify(target, manifest)
+        if wrong:
+            target.send(wrong, root)
+            report['sent'] = sorted(set(send) | set(wrong))
+            wrong = verify(target, manifest)
+        if wrong:
+            raise DeployError('{}: verification failed for {}'.format(target.host, ', '.join(wrong)))
+        if report['sent'] or delete:
+            target.write_manifest(merge_manifest(manifest, remote, scope))
+    except (DeployError, OSError, subprocess.SubprocessError) as e:
+        report['error'] = str(e)
+    return report
+
+
+def deploy_fleet(targets, manifest, root=ROOT, dry_run=False, jobs=None, scope=(LIBRARY_SCOPE,)):
+    """
+    Deploy to every target at the same time
+
+    :return: list of reports, in the order of targets
+    """
+    if not targets:
+        return []
+    with ThreadPoolExecutor(max_workers=jobs or len(targets)) as executor:
+        return list(executor.map(lambda t: deploy(t, manifest, root, dry_run, scope), targets))
+
+
+def fleet_hosts(site, group):
+    groups = FLEETS[site]
+    if group == 'all':
+        return [host for name in sorted(groups) for host in groups[name]]
+    if group not in groups:
+        raise DeployError('Site {} has no {} robots, available: {}'.format(site, group, ', '.join(sorted(groups))))
+    return list(groups[group])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Deploy the ot2 library to a group of robots')
+    parser.add_argument('group', nargs='?', default='all', help='a, b, c, s or all (default)')
+    parser.add_argument('--site', choices=sorted(FLEETS), default='santiago')
+    parser.add_argument('--hosts', nargs='+', help='deploy to these hosts instead of the group')
+    parser.add_argument('--protocols', nargs='*',
+                        help='protocol files, folders or patterns to deploy too. Without values the folders of '
+                             'the group')
+    parser.add_argument('--remote-path', default=DEFAULT_REMOTE_PATH)
+    parser.add_argument('--user', default=DEFAULT_USER)
+    parser.add_argument('--key', default=DEFAULT_KEY_PATH, help='ssh private key')
+    parser.add_argument('--local', help='deploy to <LOCAL>/<host> folders instead of ssh')
+    parser.add_argument('--jobs', type=int, help='robots updated at the same time (default all)')
+    parser.add_argument('--dry-run', action='store_true', help='only show what would be sent')
+    args = parser.parse_args()
+
+    try:
+        hosts = args.hosts or fleet_hosts(args.site, args.group)
+    except (DeployError, KeyError) as e:
+        parser.error(str(e))
+    files = bundle_files()
+    scope = [LIBRARY_SCOPE]
+    if args.protocols is not None:
+        group_folders = [f for name in sorted(GROUP_PROTOCOLS) if args.group in (name, 'all')
+                         for f in GROUP_PROTOCOLS[name]]
+        files += protocol_files(args.protocols or group_folders)
+        scope += protocol_scope(args.protocols or group_folders)
+    manifest = local_manifest(files)
+
+    if args.local:
+        targets = [LocalTarget(host, os.path.join(args.local, host)) for host in hosts]
+    else:
+        if shutil.which('ssh') is None:
+            parser.error('ssh not found')
+        targets = [SSHTarget(host, args.remote_path, args.user, args.key) for host in hosts]
+
+    print('Deploying {} files to {}'.format(len(manifest), ', '.join(hosts)))
+    failed = 0
+    for report in deploy_fleet(targets, manifest, dry_run=args.dry_run, jobs=args.jobs, scope=scope):
+        if report['error']:
+            failed += 1
+            print('{:<16} ERROR {}'.format(report['host'], report['error']))
+        else:
+            print('{:<16} {} sent, {} deleted{}'.format(
+                report['host'], len(report['sent']), len(report['deleted']),
+                ''.join('\n    ' + name for name in report['sent'])))
+    if failed:
+        raise SystemExit(1)
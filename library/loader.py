@@ -0,0 +1,76 @@
+"""
+Library loader.
+
+Protocols only add the folder containing library/ (or a zipped bundle built with this module) to sys.path and
+import the modules they need:
+
+    LIBRARY_PATH = os.environ.get('OT2_LIBRARY_PATH', '/root/ot2-covid19/')
+    if LIBRARY_PATH not in sys.path:
+        sys.path.insert(0, LIBRARY_PATH)
+    from library.protocols import common_functions as common
+
+Imported modules are cached in sys.modules, so every simulation or analysis done by the same robot server
+process reuses them instead of executing the library again. Restart the robot server after updating the library.
+
+Build a single file to upload to the robots with:
+
+    python -m library.loader bundle ot2-library.zip
+"""
+import argparse
+import importlib
+import os
+import sys
+import zipfile
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_LIBRARY_PATH = '/root/ot2-covid19/'
+BUNDLE_PACKAGES = ['library', 'library/protocols']
+
+
+def load(name, library_path=DEFAULT_LIBRARY_PATH):
+    """
+    Import library.protocols.[name] from [library_path] (a folder or a zipped bundle), cached in sys.modules
+    """
+    if library_path not in sys.path:
+        sys.path.insert(0, library_path)
+    return importlib.import_module('library.protocols.{}'.format(name))
+
+
+def bundle_files(root=ROOT):
+    """
+    Python and data files of the library packages, relative to [root]
+    """
+    files = []
+    for package in BUNDLE_PACKAGES:
+        folder = os.path.join(root, package)
+        files += sorted(os.path.join(package, f) for f in os.listdir(folder) if f.endswith(('.py', '.json')))
+    return files
+
+
+def build_bundle(output, root=ROOT):
+    """
+    Write every library module into a single zip that can be added to sys.path
+
+    :return: list of files in the bundle
+    """
+    files = bundle_files(root)
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as bundle:
+        for name in files:
+            # Fixed timestamps so the same library always produces the same bundle
+            info = zipfile.ZipInfo(name, date_time=(2020, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(os.path.join(root, name), 'rb') as source:
+                bundle.writestr(info, source.read())
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ot2 library loader')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bundle_parser = subparsers.add_parser('bundle', help='build a zipped bundle of the library')
+    bundle_parser.add_argument('output', help='zip file to write')
+    args = parser.parse_args()
+
+    for f in build_bundle(args.output):
+        print(f)
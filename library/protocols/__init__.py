@@ -0,0 +1,3 @@
+"""
+Functions and helpers shared by the station protocols.
+"""
@@ -0,0 +1,227 @@
+"""
+Batch generation of protocols from a parameter file.
+
+Every run of the queue is a protocol plus the parameters to set in it (top level assignments such as
+numero_muestras, brand_name or tipo_de_tubo). A key of a dict parameter is set with a dotted name, e.g.
+CONFIGURACION.numero_muestras or CONFIGURACION.reactivos.0.volumen for MAGMAX_A. For every run a protocol file
+ready to upload is written once it is validated:
+    * every parameter exists in the protocol and keeps the type of its current value
+    * brands, tubes and buffers exist in the catalog
+    * the protocol is simulated with opentrons (when installed) without errors
+
+Simulation results are cached by the content of the generated protocol and of the library, so a parameter set
+already analysed (the same run every day) is not simulated again.
+
+The parameter file is a JSON list of objects or a CSV with one row per run (empty cells are not set):
+
+    protocol,name,numero_muestras,brand_name,tipo_de_tubo
+    chus_protocols/protocolos_c/pcr-full-setup_protocol.py,morning,94,vircell,labturbo
+
+    python -m library.protocols.batch runs.csv --output queue/
+"""
+import argparse
+import ast
+import csv
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import sys
+
+from library.loader import ROOT, bundle_files
+from library.protocols import catalog
+from library.protocols.benchmark import simulate
+from library.protocols.run_time_estimator import format_time, override_parameters
+from library.protocols.tip_store import read_json, write_json
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.ot2_batch_cache.json')
+RESERVED_COLUMNS = ['protocol', 'name']
+
+# Parameters whose value must be a catalog entry: name pattern -> catalog section
+CATALOG_PARAMETERS = [
+    (r'brand_name$', 'brands'),
+    (r'(tipo_de_tubo|tube_type\w*)$', 'tubes'),
+    (r'(buffer_name|reagent_name)$', 'buffers'),
+]
+
+
+class BatchError(Exception):
+    pass
+
+
+def parse_value(text):
+    """
+    Python literal of a CSV cell ('94' -> 94, 'True' -> True), the text itself if it is not one
+    """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def read_runs(path):
+    """
+    Runs of a parameter file: list of dicts with 'protocol', optional 'name' and the parameters
+    """
+    with open(path, encoding='utf-8') as runs_file:
+        if path.endswith('.json'):
+            return json.load(runs_file)
+        return [{k.strip(): parse_value(v.strip()) for k, v in row.items() if v is not None and v.strip()}
+                for row in csv.DictReader(runs_file)]
+
+
+def protocol_parameters(source):
+    """
+    {name: value} of the top level assignments of a protocol whose value is a literal
+    """
+    parameters = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            if name in parameters:
+                continue
+            try:
+                parameters[name] = ast.literal_eval(node.value)
+            except ValueError:
+                parameters[name] = None
+    return parameters
+
+
+def _same_type(old, new):
+    if old is None or new is None:
+        return True
+    if isinstance(old, bool) or isinstance(new, bool):
+        return isinstance(old, bool) and isinstance(new, bool)
+    if isinstance(old, (int, float)) and isinstance(new, (int, float)):
+        return isinstance(old, float) or isinstance(new, int)
+    return type(old) == type(new)
+
+
+def resolve_parameters(source, params):
+    """
+    Merge the dotted parameters (NAME.key.0.key) into the value of their top level parameter and check every
+    parameter against the protocol
+
+    :return: {top level name: value} ready for override_parameters
+    :raises BatchError: with every problem found
+    """
+    current = protocol_parameters(source)
+    resolved = {}
+    errors = []
+    for name, value in params.items():
+        base, *path = name.split('.')
+        if base not in current:
+            errors.append('unknown parameter {}'.format(base))
+            continue
+        if not path:
+            old = current[base]
+            resolved[base] = value
+        else:
+            target = resolved.setdefault(base, json.loads(json.dumps(current[base])))
+            try:
+                for key in path[:-1]:
+                    target = target[int(key) if isinstance(target, list) else key]
+                key = int(path[-1]) if isinstance(target, list) else path[-1]
+                old = target[key]
+                target[key] = value
+            except (KeyError, IndexError, TypeError, ValueError):
+                errors.append('unknown parameter {}'.format(name))
+                continue
+        if not _same_type(old, value):
+            errors.append('{} must be {} like {!r}, not {!r}'.format(name, type(old).__name__, old, value))
+        for pattern, section in CATALOG_PARAMETERS:
+            if re.search(pattern, path[-1] if path else base) and value not in catalog.load()[section]:
+                errors.append('{} {!r} is not in the catalog {}'.format(name, value, section))
+    if errors:
+        raise BatchError(', '.join(errors))
+    return resolved
+
+
+def library_hash(root=ROOT):
+    sha = hashlib.sha256()
+    for name in bundle_files(root):
+        with open(os.path.join(root, name), 'rb') as library_file:
+            sha.update(name.encode() + library_file.read())
+    return sha.hexdigest()
+
+
+def output_name(index, run):
+    stem = os.path.splitext(os.path.basename(run['protocol']))[0]
+    name = '{:02d}_{}'.format(index, run['name']) if run.get('name') else '{:02d}_{}'.format(index, stem)
+    return re.sub(r'[^\w.-]+', '_', name) + '.py'
+
+
+def generate(runs, output, cache_path=DEFAULT_CACHE_PATH, analyse=True, out=sys.stdout):
+    """
+    Write a validated protocol for every run
+
+    :param runs: list of dicts, see read_runs
+    :param output: folder for the generated protocols
+    :param cache_path: JSON file with the analysis of previous parameter sets, None to disable the cache
+    :param analyse: simulate the generated protocols
+    :return: list of dicts {'file', 'protocol', 'error', 'estimated_seconds', 'cached'}, in the order of runs
+    """
+    # Simulations must load this library, not the one installed on the robot
+    os.environ['OT2_LIBRARY_PATH'] = ROOT
+    if analyse and importlib.util.find_spec('opentrons') is None:
+        out.write('opentrons is not installed, the protocols are not simulated\n')
+        analyse = False
+    cache = (read_json(cache_path) if cache_path else None) or {}
+    library = library_hash()
+    os.makedirs(output, exist_ok=True)
+    results = []
+    for index, run in enumerate(runs, 1):
+        params = {k: v for k, v in run.items() if k not in RESERVED_COLUMNS}
+        result = {'file': None, 'protocol': run.get('protocol'), 'error': None, 'estimated_seconds': None,
+                  'cached': False}
+        results.append(result)
+        try:
+            path = run['protocol'] if os.path.isfile(run['protocol']) else os.path.join(ROOT, run['protocol'])
+            with open(path, encoding='utf-8') as protocol_file:
+                source = protocol_file.read()
+            source = override_parameters(source, resolve_parameters(source, params))
+            compile(source, path, 'exec')
+        except (BatchError, KeyError, OSError, SyntaxError, ValueError) as e:
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+            continue
+
+        file_path = os.path.join(output, output_name(index, run))
+        with open(file_path, 'w', encoding='utf-8') as generated_file:
+            generated_file.write(source)
+        if analyse:
+            key = hashlib.sha256((library + source).encode()).hexdigest()
+            result['cached'] = key in cache
+            if not result['cached']:
+                cache[key] = simulate(file_path)
+            if 'error' in cache[key]:
+                result['error'] = cache[key]['error']
+                os.remove(file_path)
+                continue
+            result['estimated_seconds'] = cache[key]['estimated_seconds']
+        result['file'] = file_path
+
+    if analyse and cache_path:
+        write_json(cache_path, cache)
+    for index, result in enumerate(results, 1):
+        if result['error']:
+            out.write('ERROR run {} ({}): {}\n'.format(index, result['protocol'], result['error']))
+        else:
+            out.write('{:<50} {:>8}{}\n'.format(
+                os.path.basename(result['file']),
+                format_time(result['estimated_seconds']) if result['estimated_seconds'] is not None else '',
+                ' (cached)' if result['cached'] else ''))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the protocols of a queue of runs from a parameter file')
+    parser.add_argument('runs', help='JSON or CSV parameter file, one run per row')
+    parser.add_argument('--output', required=True, help='folder for the generated protocols')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH, help='analysis cache (default ~/.ot2_batch_cache.json)')
+    parser.add_argument('--no-simulate', action='store_true', help='only validate the parameters')
+    args = parser.parse_args()
+
+    generated = generate(read_runs(args.runs), args.output, args.cache, analyse=not args.no_simulate)
+    sys.exit(1 if any(r['error'] for r in generated) else 0)
@@ -0,0 +1,158 @@
+"""
+Benchmark every protocol in the opentrons simulator.
+
+Each protocol is simulated at the standard sample counts (the first sample parameter found in the protocol is
+overridden) recording the simulation wall time, the number of aspirate/dispense/move/tip commands and the run time
+estimated by run_time_estimator. Results are written as a JSON baseline; comparing a new run against it reports
+the protocols whose estimated time or command counts went up. Usage:
+
+    python -m library.protocols.benchmark chus_protocols --output baseline.json
+    python -m library.protocols.benchmark chus_protocols --compare baseline.json
+"""
+import argparse
+import ast
+import glob
+import json
+import os
+import sys
+import time
+
+from library.protocols.run_time_estimator import RunTimeEstimator, format_time, load_protocol
+
+
+SAMPLE_COUNTS = [8, 24, 48, 94, 96]
+
+# Names used by the protocols for the number of samples, the first one found is overridden
+SAMPLE_PARAMETERS = ['NUM_SAMPLES', 'numero_muestras', 'num_samples', 'num_destinations', 'num_sources', 'sources']
+
+# Metrics compared against the baseline
+COMMAND_GROUPS = {
+    'aspirate': ['ASPIRATE'],
+    'dispense': ['DISPENSE'],
+    'move': ['MOVE_TO'],
+    'tips': ['PICK_UP_TIP', 'DROP_TIP', 'RETURN_TIP'],
+}
+METRICS = ['estimated_seconds', 'commands'] + sorted(COMMAND_GROUPS)
+
+
+def find_protocols(folder):
+    """
+    Protocol files (with a top level run function) below folder, sorted
+    """
+    protocols = []
+    for path in sorted(glob.glob(os.path.join(folder, '**', '*.py'), recursive=True)):
+        with open(path, encoding='utf-8') as protocol_file:
+            tree = ast.parse(protocol_file.read(), path)
+        if any(isinstance(node, ast.FunctionDef) and node.name == 'run' for node in tree.body):
+            protocols.append(path)
+    return protocols
+
+
+def sample_parameter(path):
+    """
+    Name of the parameter holding the number of samples of a protocol, None if it has none
+    """
+    with open(path, encoding='utf-8') as protocol_file:
+        tree = ast.parse(protocol_file.read(), path)
+    names = {node.targets[0].id for node in tree.body
+             if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)}
+    for name in SAMPLE_PARAMETERS:
+        if name in names:
+            return name
+    return None
+
+
+def simulate(path, params=None, model=None):
+    """
+    Simulate a protocol once
+
+    :return: dict with the wall time, command counts and estimated time, or the error raised by the protocol
+    """
+    start = time.perf_counter()
+    try:
+        estimator = RunTimeEstimator(model).run(load_protocol(path, params))
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+    result = {
+        'wall_seconds': round(time.perf_counter() - start, 3),
+        'estimated_seconds': round(estimator.total, 1),
+        'commands': sum(c['count'] for c in estimator.commands.values()),
+    }
+    for group, names in COMMAND_GROUPS.items():
+        result[group] = sum(estimator.commands.get(name, {}).get('count', 0) for name in names)
+    return result
+
+
+def run_benchmark(folder, sample_counts=SAMPLE_COUNTS, model=None, out=sys.stdout):
+    """
+    Simulate every protocol below folder at every sample count
+
+    :return: {protocol path relative to folder: {sample count or 'default': result}}
+    """
+    # Protocols must load this library, not the one installed on the robot
+    os.environ['OT2_LIBRARY_PATH'] = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    results = {}
+    for path in find_protocols(folder):
+        name = os.path.relpath(path, folder)
+        parameter = sample_parameter(path)
+        runs = [(str(n), {parameter: n}) for n in sample_counts] if parameter else [('default', None)]
+        results[name] = {}
+        for key, params in runs:
+            result = simulate(path, params, model)
+            results[name][key] = result
+            if 'error' in result:
+                out.write('{:<60} {:>8} {}\n'.format(name[:60], key, result['error']))
+            else:
+                out.write('{:<60} {:>8} {:>8} commands {:>10}\n'.format(
+                    name[:60], key, result['commands'], format_time(result['estimated_seconds'])))
+    return results
+
+
+def compare(results, baseline, tolerance=0.02):
+    """
+    Regressions of results against a baseline
+
+    :param tolerance: relative increase allowed before a metric counts as a regression
+    :return: list of (protocol, sample count, metric, baseline value, new value)
+    """
+    regressions = []
+    for name, runs in sorted(results.items()):
+        for key, result in runs.items():
+            old = baseline.get(name, {}).get(key)
+            if not old or 'error' in old:
+                continue
+            if 'error' in result:
+                regressions.append((name, key, 'error', None, result['error']))
+                continue
+            for metric in METRICS:
+                if result[metric] > old[metric] * (1 + tolerance):
+                    regressions.append((name, key, metric, old[metric], result[metric]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate every protocol and record a performance baseline')
+    parser.add_argument('folder', help='folder with the protocols, e.g. chus_protocols')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', help='baseline json to compare with, exits with 1 on regressions')
+    parser.add_argument('--samples', type=int, nargs='+', default=SAMPLE_COUNTS, help='sample counts to simulate')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='relative increase allowed (default 0.02)')
+    parser.add_argument('--model', help='json file overriding the default kinematics and flow-rate model')
+    args = parser.parse_args()
+
+    user_model = None
+    if args.model:
+        with open(args.model) as model_file:
+            user_model = json.load(model_file)
+    benchmark = run_benchmark(args.folder, args.samples, user_model)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(benchmark, output_file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            found = compare(benchmark, json.load(baseline_file), args.tolerance)
+        for protocol, samples, metric, before, after in found:
+            print('REGRESSION {} ({} samples) {}: {} -> {}'.format(protocol, samples, metric, before, after))
+        sys.exit(1 if found else 0)
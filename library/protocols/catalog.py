@@ -0,0 +1,78 @@
+"""
+Catalog of PCR kit brands, tubes, buffers and labware names.
+
+The data lives in catalog.json next to this module and is loaded once per robot server process. A site can add or
+change entries without editing code with a JSON file of the same shape at OT2_CATALOG_PATH (default
+/data/catalog.json): its entries are merged over the shipped ones.
+
+Brands and tubes are returned as immutable records with the derived geometry already computed. Buffers are
+returned as new dicts on every call because protocols update them while running (e.g. 'vol_well'). Buffer fields:
+    tip_policy: when tips must be changed (see common_functions.TipManager)
+    flow_rate_aspirate, flow_rate_dispense: multipliers of the pipette flow rate
+    delay: seconds to wait after aspirate, to allow drops to fall before moving the pipette
+    vol_well: initial volume of the source well
+"""
+import json
+import math
+import os
+import pkgutil
+from collections import namedtuple
+from functools import lru_cache
+
+
+SITE_CATALOG_PATH = os.environ.get('OT2_CATALOG_PATH', '/data/catalog.json')
+
+Brand = namedtuple('Brand', ['name', 'master_mix', 'arn', 'split_pcr'])
+Tube = namedtuple('Tube', ['name', 'diameter', 'area', 'vcono', 'hcono', 'hdisp', 'hpick'])
+
+
+@lru_cache(maxsize=None)
+def load(site_path=SITE_CATALOG_PATH):
+    """
+    Shipped catalog merged with the site one (if any): {'brands': {...}, 'tubes': {...}, 'buffers': {...},
+    'labware': {...}}
+    """
+    data = json.loads(pkgutil.get_data(__name__, 'catalog.json').decode('utf-8'))
+    if site_path and os.path.isfile(site_path):
+        with open(site_path) as site_file:
+            for section, entries in json.load(site_file).items():
+                data.setdefault(section, {}).update(entries)
+    return data
+
+
+def _entry(section, name):
+    try:
+        return load()[section][name]
+    except KeyError:
+        raise KeyError('Unknown {} {!r}, available: {}'.format(
+            section[:-1], name, ', '.join(sorted(load()[section])))) from None
+
+
+@lru_cache(maxsize=None)
+def brand(name):
+    entry = _entry('brands', name)
+    return Brand(name, entry['master_mix'], entry['arn'], entry.get('split_pcr'))
+
+
+@lru_cache(maxsize=None)
+def tube(name):
+    entry = _entry('tubes', name)
+    diameter = entry['diameter']
+    hcono = entry['hcono']
+    area = (math.pi * diameter**2) / 4
+    if entry.get('bottom') == 'cone':
+        vcono = 1 / 3 * hcono * area
+    else:
+        vcono = 4 * area * diameter * 0.5 / 3
+    return Tube(name, diameter, area, vcono, hcono, entry.get('hdisp'), entry.get('hpick'))
+
+
+def buffer(name):
+    return dict(_entry('buffers', name))
+
+
+def labware(name):
+    """
+    Opentrons load name of a labware by its catalog name (e.g. 'pcr_plate')
+    """
+    return _entry('labware', name)
@@ -0,0 +1,118 @@
+"""
+Resume long protocols from the last completed step.
+
+After every step the protocol saves a checkpoint with the completed steps, the volume left in the reagents
+('vol_well', 'col', 'actual_volume', 'next_draw'), any extra counters and the magnet state. With resume enabled the completed
+steps are marked 'Execute': False and the reagents get their volumes back, so liquid heights are computed from
+what is really left. Tip positions are persisted on every pick up by tip_store (attach it without reset when
+resuming).
+
+Usage:
+    checkpoint = Checkpoint(ctx, metadata['protocolName'], resume=RESUME)
+    checkpoint.skip_completed(STEPS)
+    extra = checkpoint.restore({'Lysis': Lysis}, magnet=magdeck, magnet_height=mag_height)
+    ...
+    checkpoint.save(STEP, {'Lysis': Lysis}, magnet=magdeck)
+"""
+import os
+from datetime import datetime
+
+from library.protocols.tip_store import read_json, write_json
+
+
+DEFAULT_CHECKPOINT_FOLDER = '/data/checkpoints'
+REAGENT_FIELDS = ['vol_well', 'col', 'actual_volume', 'next_draw']
+
+
+def reagent_state(reagent):
+    """
+    Volume related fields of a reagent (object or dict)
+    """
+    if isinstance(reagent, dict):
+        return {k: reagent[k] for k in REAGENT_FIELDS if k in reagent}
+    return {k: getattr(reagent, k) for k in REAGENT_FIELDS if hasattr(reagent, k)}
+
+
+def restore_reagent(reagent, state):
+    for k, v in state.items():
+        if isinstance(reagent, dict):
+            reagent[k] = v
+        else:
+            setattr(reagent, k, v)
+
+
+class Checkpoint:
+    """
+    Checkpoints of a protocol, one JSON file per protocol written atomically after every step
+
+    :param ctx: protocol context. Nothing is read nor written while simulating
+    :param protocol_name: name of the protocol, used as file name
+    :param resume: go on from the last checkpoint. If False the previous checkpoint is discarded
+    :param path: checkpoint file, by default /data/checkpoints/<protocol_name>.json
+    """
+
+    def __init__(self, ctx, protocol_name, resume=False, path=None):
+        self.ctx = ctx
+        self.protocol_name = protocol_name
+        self.path = path or os.path.join(DEFAULT_CHECKPOINT_FOLDER, protocol_name.replace(' ', '_') + '.json')
+        self.persistent = not ctx.is_simulating()
+        self.data = None
+        if self.persistent and resume:
+            self.data = read_json(self.path)
+        if not self.data:
+            self.data = {'protocol': protocol_name, 'completed': [], 'reagents': {}, 'extra': {}, 'magnet': None}
+        elif self.data['completed']:
+            ctx.comment('Resuming ' + protocol_name + ' after step ' + str(self.data['completed'][-1]))
+
+    @property
+    def completed(self):
+        return self.data['completed']
+
+    def skip_completed(self, steps):
+        """
+        Set 'Execute': False on the completed steps of a STEPS dict
+        """
+        for number in self.completed:
+            if number in steps:
+                steps[number]['Execute'] = False
+
+    def restore(self, reagents, magnet=None, magnet_height=None):
+        """
+        Give the reagents their saved volumes back and engage the magnet if it was engaged
+
+        :param reagents: {name: reagent object or dict}
+        :return: the extra values saved with the last checkpoint
+        """
+        for name, state in self.data['reagents'].items():
+            if name in reagents:
+                restore_reagent(reagents[name], state)
+        if magnet is not None and self.data['magnet']:
+            if magnet_height is None:
+                magnet.engage()
+            else:
+                magnet.engage(height=magnet_height)
+        return dict(self.data['extra'])
+
+    def save(self, step, reagents=None, magnet=None, extra=None):
+        """
+        Record step as completed together with the current reagent volumes, magnet state and extra values
+        """
+        if step not in self.completed:
+            self.completed.append(step)
+        for name, reagent in (reagents or {}).items():
+            self.data['reagents'][name] = reagent_state(reagent)
+        if magnet is not None:
+            self.data['magnet'] = magnet.status == 'engaged'
+        if extra:
+            self.data['extra'].update(extra)
+        self.data['time'] = datetime.now().isoformat()
+        if self.persistent:
+            write_json(self.path, self.data)
+
+    def clear(self):
+        """
+        Remove the checkpoint once the protocol finished
+        """
+        for path in (self.path, self.path + '.bak'):
+            if self.persistent and os.path.isfile(path):
+                os.remove(path)
@@ -0,0 +1,172 @@
+"""
+Cherry picking: arbitrary transfers listed in a CSV (or a list of dicts) instead of a well mapping in the protocol.
+
+    source,source_well,destination,destination_well,volume,reagent,tip_policy
+    1,A1,3,B7,10,Sample,per-destination
+
+source and destination are keys of the labware loaded by the protocol (slots or names), reagent is a buffer of the
+catalog (default 'Sample') and tip_policy one of common_functions.TIP_POLICIES (default the one of the run). Empty
+cells take the default.
+
+plan() assigns every pick to the smallest pipette that holds its volume, promotes whole columns to the 8-channel
+pipette when there is one, groups the picks by pipette, reagent and tip policy and, in the groups that keep the tip
+between picks, sorts the picks to minimize the travel of the gantry (picks sharing a tip keep their source
+together). Groups that change the tip on every pick keep the order of the CSV: the gantry goes to the trash and the
+tip rack between picks and the order does not shorten it. execute() runs the plan.
+"""
+import csv
+
+from library.protocols import common_functions as common
+from library.protocols import lab_stuff
+from library.protocols import travel_planner
+
+
+COLUMNS = ['source', 'source_well', 'destination', 'destination_well', 'volume']
+DEFAULT_REAGENT = 'Sample'
+# Groups larger than this are only sorted by nearest neighbour, each 2-opt pass grows with the square of the picks
+TWO_OPT_MAX_PICKS = 384
+
+
+def read_picks(path):
+    """
+    Picks of a CSV file: list of dicts with the COLUMNS and, when given, 'reagent' and 'tip_policy'
+    """
+    with open(path, encoding='utf-8-sig', newline='') as picks_file:
+        rows = list(csv.DictReader(picks_file))
+    missing = [column for column in COLUMNS if rows and column not in rows[0]]
+    if missing:
+        raise ValueError('{} has no column {}'.format(path, ', '.join(missing)))
+    return [{k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()} for row in rows]
+
+
+def resolve(picks, labware, tip_policy='per-destination'):
+    """
+    Wells, volume, reagent and tip policy of every pick
+
+    :param labware: {key used in the picks: loaded labware}, keys are compared as text
+    :param tip_policy: policy of the picks without one
+    :return: list of dicts {'source', 'destination' (wells), 'volume', 'reagent', 'tip_policy', 'row'}
+    :raises ValueError: with every pick that cannot be resolved
+    """
+    labware = {str(k): v for k, v in labware.items()}
+    resolved = []
+    errors = []
+    for n, pick in enumerate(picks, 1):
+        try:
+            source = labware[str(pick['source'])].wells_by_name()[pick['source_well']]
+            destination = labware[str(pick['destination'])].wells_by_name()[pick['destination_well']]
+            volume = float(str(pick['volume']).replace(',', '.'))
+            policy = pick.get('tip_policy', tip_policy)
+            if policy not in common.TIP_POLICIES:
+                raise ValueError('unknown tip policy {}'.format(policy))
+            if volume <= 0:
+                raise ValueError('volume must be positive')
+        except KeyError as e:
+            errors.append('row {}: unknown {}'.format(n, e))
+            continue
+        except ValueError as e:
+            errors.append('row {}: {}'.format(n, e))
+            continue
+        reagent_name = pick.get('reagent', DEFAULT_REAGENT)
+        resolved.append({'source': source, 'destination': destination, 'volume': volume,
+                         'reagent': dict(lab_stuff.buffer(reagent_name), name=reagent_name),
+                         'tip_policy': policy, 'row': n})
+    if errors:
+        raise ValueError('Picks that cannot be done: {}'.format(', '.join(errors)))
+    return resolved
+
+
+def choose_pipette(volume, pipettes, air_gap_vol=0):
+    """
+    Smallest pipette that holds [volume] plus the air gap in one aspiration, the largest one if none does
+    """
+    by_size = sorted(pipettes, key=lambda p: p.max_volume)
+    for pipette in by_size:
+        if volume + air_gap_vol <= pipette.max_volume:
+            return pipette
+    return by_size[-1]
+
+
+def plan(picks, pipettes, multi=None, air_gap_vol=0):
+    """
+    Groups of picks in the order they have to be done
+
+    :param picks: resolved picks (see resolve)
+    :param pipettes: loaded single channel pipettes
+    :param multi: loaded 8-channel pipette for whole column picks, if any
+    :return: list of groups in order of first appearance, each one a dict {'pipette', 'reagent', 'tip_policy',
+             'transfers'} where transfers is a list of (source, destination, volume)
+    """
+    groups = {}
+    for pick in picks:
+        pipette = choose_pipette(pick['volume'], pipettes, air_gap_vol)
+        key = (id(pipette), pick['reagent']['name'], pick['tip_policy'])
+        groups.setdefault(key, {'pipette': pipette, 'reagent': pick['reagent'], 'tip_policy': pick['tip_policy'],
+                                'transfers': []})
+        groups[key]['transfers'].append((pick['source'], pick['destination'], pick['volume']))
+
+    if multi is not None:
+        promoted = {}
+        for key, group in groups.items():
+            if group['pipette'].max_volume > multi.max_volume:
+                continue
+            moves = common.promote_to_multichannel(group['transfers'], single=group['pipette'], multi=multi)
+            group['transfers'] = [(s, d, v) for pipette, s, d, v in moves if pipette is not multi]
+            promoted.setdefault((id(multi),) + key[1:], dict(group, pipette=multi, transfers=[]))['transfers'] += \
+                [(s, d, v) for pipette, s, d, v in moves if pipette is multi]
+        groups.update({k: v for k, v in promoted.items() if v['transfers']})
+
+    ordered = []
+    for group in groups.values():
+        if group['transfers']:
+            # The reagent may require a stricter tip policy than the group (see common_functions.TipManager)
+            policy = max(group['tip_policy'], group['reagent'].get('tip_policy', 'never'), key=common.TIP_POLICIES.index)
+            group['transfers'] = sort_transfers(group['transfers'], policy)
+            ordered.append(group)
+    return ordered
+
+
+def sort_transfers(transfers, tip_policy):
+    """
+    Reorder (source, destination, volume) transfers to minimize the travel. When the tip is kept between
+    transfers of the same source (per-source, per-n, never) those transfers stay together. With a new tip for every
+    transfer (per-destination) the order is kept
+    """
+    if tip_policy == 'per-destination':
+        return list(transfers)
+    pairs = [(s, d) for s, d, _ in transfers]
+    volumes = {id(pair): v for pair, (_, _, v) in zip(pairs, transfers)}
+    first = {}
+    for s, _ in pairs:
+        first.setdefault(id(s), len(first))
+
+    def same_source(pair):
+        return first[id(pair[0])]
+
+    ordered, _, _ = travel_planner.plan_transfers(
+        pairs, priority=same_source, max_passes=3 if len(pairs) <= TWO_OPT_MAX_PICKS else 0)
+    return [pair + (volumes[id(pair)],) for pair in ordered]
+
+
+def execute(ctx, groups, air_gap_vol, x_offset, pickup_height, disp_height, blow_out=True, touch_tip=True):
+    """
+    Do the transfers of every group with its pipette and tip policy. Volumes that do not fit in the tip are split
+
+    :param groups: see plan
+    :return: number of tips used
+    """
+    tip_managers = {}
+    for group in groups:
+        pipette = group['pipette']
+        tip_manager = tip_managers.setdefault(id(pipette), common.TipManager(pipette))
+        tip_manager.policy = group['tip_policy']
+        for source, destination, volume in group['transfers']:
+            tip_manager.prepare(source, group['reagent'])
+            for vol in common.divide_volume(volume, pipette.max_volume - air_gap_vol):
+                common.move_vol_multichannel(ctx, pipette, reagent=group['reagent'], source=source, dest=destination,
+                                             vol=vol, air_gap_vol=air_gap_vol, x_offset=x_offset,
+                                             pickup_height=pickup_height, disp_height=disp_height,
+                                             blow_out=blow_out, touch_tip=touch_tip)
+    for tip_manager in tip_managers.values():
+        tip_manager.release()
+    return sum(tip_manager.tips_used for tip_manager in tip_managers.values())
@@ -1,3 +1,5 @@
+import bisect
+import math
 import time
 
 from opentrons.drivers.rpi_drivers import gpio
@@ -47,6 +49,260 @@ def move_vol_multichannel(ctx, pipette, reagent, source, dest, vol, air_gap_vol,
         pipette.touch_tip(speed=20, v_offset=-5)
 
 
+def plan_multi_dispense(num_dests, vol, max_volume, disposal_vol=0, air_gap_vol=0):
+    """
+    Group [num_dests] dispenses of [vol] into aspirations that fit in the tip.
+
+    :param num_dests: number of destinations to serve
+    :param vol: volume to dispense in each destination, or a list with the volume of every destination
+    :param max_volume: maximum volume the pipette/tip can hold
+    :param disposal_vol: extra volume aspirated on each trip and discarded at the end
+    :param air_gap_vol: volume of air to pick after aspirate
+
+    :return: list of trips, each one a list of (destination index, volume). When [vol] does not fit in
+             the tip each destination is served in several single-destination trips.
+    """
+    usable_vol = max_volume - disposal_vol - air_gap_vol
+    if usable_vol <= 0:
+        raise ValueError('Disposal and air gap volumes do not fit in a {} µl tip'.format(max_volume))
+    if isinstance(vol, (list, tuple)):
+        # Different volumes: consecutive destinations while they fit in the tip
+        trips = []
+        for i, v in enumerate(vol[:num_dests]):
+            if v > usable_vol:
+                trips += [[(i, part)] for part in divide_volume(v, usable_vol)]
+            elif trips and sum(part for _, part in trips[-1]) + v <= usable_vol:
+                trips[-1].append((i, v))
+            else:
+                trips.append([(i, v)])
+        return trips
+    dests_per_asp = int(usable_vol // vol)
+    if dests_per_asp == 0:
+        return [[(i, v)] for i in range(num_dests) for v in divide_volume(vol, usable_vol)]
+    return [[(i, vol) for i in range(start, min(start + dests_per_asp, num_dests))]
+            for start in range(0, num_dests, dests_per_asp)]
+
+
+def divide_volume(vol, max_vol):
+    """
+    Split [vol] in the minimum number of similar volumes not greater than [max_vol]
+    """
+    num_transfers = math.ceil(vol / max_vol)
+    vol_roundup = vol / num_transfers
+    return [vol_roundup] * num_transfers
+
+
+def plan_reservoir(draws, well_max_vol, dead_vol, max_wells=None, round_to=10, min_level_vol=0):
+    """
+    Assign the aspirations of a reagent to reservoir wells before the run: the minimum number of wells is used,
+    the draws are split in consecutive groups of similar volume and every well keeps [dead_vol] at the end, or
+    [min_level_vol] when it is greater, so the tips never aspirate from a nearly empty well.
+
+    :param draws: volumes aspirated from the reservoir, in execution order
+    :param well_max_vol: maximum volume of a reservoir well
+    :param dead_vol: volume left in each well after its last draw (e.g. the volume of the bottom cone)
+    :param max_wells: number of wells available for the reagent
+    :param round_to: fill volumes are rounded up to a multiple of it
+    :param min_level_vol: volume each well must still hold after every draw, e.g. the volume at the lowest
+                          height the aspiration height is calculated for. The next well is used before that
+
+    :return: (fill, wells) fill: volume to pour in each well, wells: well index of each draw
+    """
+    dead_vol = max(dead_vol, min_level_vol)
+    usable_vol = well_max_vol - dead_vol
+    if draws and max(draws) > usable_vol:
+        raise ValueError('A draw of {} µl does not fit in a {} µl well'.format(max(draws), well_max_vol))
+    total = sum(draws)
+    num_wells = max(1, math.ceil(total / usable_vol))
+    while True:
+        target = total / num_wells
+        wells, loads = [], [0]
+        done = 0
+        for draw in draws:
+            # next well when this one is full or already got its share
+            if loads[-1] and (loads[-1] + draw > usable_vol or
+                              (done + draw / 2 > target * len(loads) and len(loads) < num_wells)):
+                loads.append(0)
+            loads[-1] += draw
+            done += draw
+            wells.append(len(loads) - 1)
+        if len(loads) <= num_wells:
+            break
+        num_wells += 1
+    if max_wells is not None and len(loads) > max_wells:
+        raise ValueError('{} µl need {} wells, only {} available'.format(total, len(loads), max_wells))
+    fill = [min(well_max_vol, math.ceil((load + dead_vol) / round_to) * round_to) for load in loads]
+    return fill, wells
+
+
+def plan_premix(reagents, num_dests, tube_max_vol, dead_vol, max_tubes=None):
+    """
+    Plan an on-deck premix of reagents that go to the same destinations, so they are dispensed together in a
+    single pass instead of one pass per reagent. When the premix does not fit in one tube the destinations are
+    split in consecutive groups of similar size, one premix tube each.
+
+    :param reagents: list of dicts {'name', 'vol': volume per destination, 'last': True for reagents that must be
+                     added at the end (e.g. beads, resuspended just before)}
+    :param num_dests: number of destinations
+    :param tube_max_vol: maximum volume of a premix tube
+    :param dead_vol: volume left in each premix tube after the last destination
+
+    :return: list of tubes, each one a dict {'dests': range of destination indexes, 'vol': premix volume per
+             destination, 'total': premix volume in the tube, 'additions': [(name, volume)] in mixing order}
+    """
+    vol = sum(r['vol'] for r in reagents)
+    dests_per_tube = int((tube_max_vol - dead_vol) // vol) if vol else 0
+    if dests_per_tube == 0:
+        raise ValueError('{} µl per destination do not fit in a {} µl tube'.format(vol, tube_max_vol))
+    num_tubes = math.ceil(num_dests / dests_per_tube)
+    if max_tubes is not None and num_tubes > max_tubes:
+        raise ValueError('The premix needs {} tubes, only {} available'.format(num_tubes, max_tubes))
+    order = sorted(reagents, key=lambda r: bool(r.get('last')))
+    tubes = []
+    start = 0
+    for i in range(num_tubes):
+        size = num_dests // num_tubes + (1 if i < num_dests % num_tubes else 0)
+        # Each reagent adds its share of the dead volume, rounded up to whole µl
+        additions = [(r['name'], math.ceil(r['vol'] * (size + dead_vol / vol))) for r in order]
+        tubes.append({'dests': range(start, start + size), 'vol': vol, 'total': sum(v for _, v in additions),
+                      'additions': additions})
+        start += size
+    return tubes
+
+
+def plan_fan_out(num_dests, vol, strip_max_vol, strip_dead_vol, multi_max_vol, air_gap_vol=0, disposal_vol=0,
+                 max_strips=None):
+    """
+    Plan a two stage distribution of [vol] to the first [num_dests] wells of a 96-well plate (by columns): the
+    single channel fills an intermediate strip (a column of 8 wells, one per row) and the multichannel dispenses
+    from the strip to whole columns. The wells of an incomplete last column are served from the strip by the single
+    channel. The fewest strips are used (each one keeps its dead volume at the end) and the columns are split among
+    them so the multichannel needs the fewest trips. A strip that would only serve the incomplete column is not used:
+    the single channel dispenses those wells straight from the source, as every well when there is no whole column.
+
+    :param num_dests: number of destination wells
+    :param vol: volume to dispense in each destination
+    :param strip_max_vol: maximum volume of a strip well
+    :param strip_dead_vol: volume left in each strip well after the last trip
+    :param multi_max_vol: maximum volume of the multichannel tips
+    :param air_gap_vol: volume of air the multichannel picks after aspirate
+    :param disposal_vol: extra volume aspirated on each multichannel trip and blown out back into the strip
+    :param max_strips: number of strips available
+
+    :return: dict {'strips': list of dicts {'fill': volume of each of the 8 strip wells, 'columns': range of
+             destination columns served by the multichannel, 'single': destination indexes served by the single
+             channel}, 'direct': destination indexes served straight from the source by the single channel,
+             'trips': multichannel trips, 'total': volume of all the strips}
+    """
+    full_columns, rest = divmod(num_dests, 8)
+    if full_columns == 0:
+        return {'strips': [], 'direct': list(range(num_dests)), 'trips': 0, 'total': 0}
+    units = full_columns + (1 if rest else 0)
+    per_strip = int((strip_max_vol - strip_dead_vol - disposal_vol) // vol) if vol else 0
+    if per_strip == 0:
+        raise ValueError('{} µl do not fit in a {} µl strip well'.format(vol + strip_dead_vol, strip_max_vol))
+    num_strips = math.ceil(units / per_strip)
+    if max_strips is not None and num_strips > max_strips:
+        raise ValueError('The fan out needs {} strips, only {} available'.format(num_strips, max_strips))
+
+    def multi_trips(sizes):
+        columns = [size - (1 if rest and i == len(sizes) - 1 else 0) for i, size in enumerate(sizes)]
+        return sum(len(plan_multi_dispense(c, vol, multi_max_vol, disposal_vol, air_gap_vol)) for c in columns if c)
+
+    # Columns per strip: as even as possible, or whole multichannel trips in every strip but the last one
+    balanced = [units // num_strips + (1 if i < units % num_strips else 0) for i in range(num_strips)]
+    per_trip = len(plan_multi_dispense(per_strip, vol, multi_max_vol, disposal_vol, air_gap_vol)[0])
+    step = per_strip - per_strip % per_trip if per_strip >= per_trip else per_strip
+    packed = [step] * (units // step) + ([units % step] if units % step else [])
+    sizes = packed if len(packed) == num_strips and multi_trips(packed) < multi_trips(balanced) else balanced
+
+    strips = []
+    direct = []
+    start = 0
+    for i, size in enumerate(sizes):
+        columns = range(start, start + size - (1 if rest and i == num_strips - 1 else 0))
+        single = list(range(full_columns * 8, num_dests)) if rest and i == num_strips - 1 else []
+        start += size
+        if not columns:
+            direct = single
+            continue
+        # Every row of a strip with whole columns is drawn by the multichannel
+        fill = [round(vol * (len(columns) + (1 if r < len(single) else 0)) + strip_dead_vol + disposal_vol, 2)
+                for r in range(8)]
+        strips.append({'fill': fill, 'columns': columns, 'single': single})
+    return {'strips': strips, 'direct': direct, 'trips': multi_trips(sizes),
+            'total': round(sum(sum(s['fill']) for s in strips), 2)}
+
+
+def plan_mastermix(fills, components, tube_max_vol, dead_vol, max_tubes=None):
+    """
+    Master mix tubes to prepare for the strip wells of plan_fan_out
+
+    :param fills: volume of every strip well, in filling order
+    :param components: list of dicts {'name', 'vol': volume per reaction}, the master mix keeps their proportions
+    :param tube_max_vol: maximum volume of a master mix tube
+    :param dead_vol: volume left in each tube after the last strip well
+
+    :return: list of tubes, each one a dict {'wells': indexes of the fills served by the tube, 'total': volume
+             in the tube, 'additions': [(name, volume)] rounded up to whole µl}
+    """
+    tube_fill, tube_of = plan_reservoir(fills, tube_max_vol, dead_vol, max_tubes, round_to=1)
+    vol = sum(c['vol'] for c in components)
+    tubes = []
+    for t, total in enumerate(tube_fill):
+        additions = [(c['name'], math.ceil(total * c['vol'] / vol)) for c in components]
+        tubes.append({'wells': [i for i, tube in enumerate(tube_of) if tube == t],
+                      'total': sum(v for _, v in additions), 'additions': additions})
+    return tubes
+
+
+def multi_dispense(ctx, pipette, reagent, source, dests, vol, air_gap_vol, x_offset, pickup_height, disp_height,
+                   disposal_vol=0, max_volume=None, blow_out=True, touch_tip=False):
+    """
+    Distribute [vol] from [source] to every well of [dests] aspirating once for as many destinations as
+    the tip allows. The pipette must have a tip attached.
+
+    :param ctx: protocol context
+    :param pipette: labware object for pipette
+    :param reagent: parameters for this specific reagent
+    :param source: labware object from which the reagent is picked
+    :param dests: list of labware objects to where the reagent is dispensed
+    :param vol: volume of reagent to dispense in each dest, or a list with the volume of every dest
+    :param air_gap_vol: volume of air to pick after aspirate, released in the first dispense of each trip
+    :param x_offset: 2 positions in x axis for the pippete: pos 0 to aspirate, pos 1 to dispense
+    :param pickup_height: height for the pipette to aspirate
+    :param disp_height: height for the pipette to dispense (from the top of the well)
+    :param disposal_vol: extra volume aspirated on each trip so every dispense is accurate
+    :param max_volume: maximum volume to hold in the tip, by default pipette's max volume
+    :param blow_out: if True the remaining volume will be blown out into the source after each trip
+    :param touch_tip: if True they will be done after each dispense
+
+    :return: number of aspirations done
+    """
+    dests = list(dests)
+    trips = plan_multi_dispense(len(dests), vol, max_volume or pipette.max_volume, disposal_vol, air_gap_vol)
+    for trip in trips:
+        # Source
+        s = source.bottom(pickup_height).move(Point(x=x_offset[0]))
+        pipette.aspirate(sum(v for _, v in trip) + disposal_vol, s, rate=reagent.get('flow_rate_aspirate'))
+        if air_gap_vol != 0:
+            pipette.aspirate(air_gap_vol, source.top(z=-2), rate=reagent.get('flow_rate_aspirate'))
+        # Apply a delay, if there is any
+        delay = reagent.get('delay')
+        if delay:
+            ctx.delay(seconds=delay)
+        # Go to destinations
+        for n, (i, v) in enumerate(trip):
+            drop = dests[i].top(z=disp_height).move(Point(x=x_offset[1]))
+            pipette.dispense(v + (air_gap_vol if n == 0 else 0), drop, rate=reagent.get('flow_rate_dispense'))
+            if touch_tip:
+                pipette.touch_tip(speed=20, v_offset=-5)
+        # Discard disposal volume back to source
+        if blow_out:
+            pipette.blow_out(source.top(z=-2))
+    return len(trips)
+
+
 def custom_mix(pipette, reagent, location, vol, rounds, blow_out, mix_height, x_offset, source_height=3):
     """
     Function for mixing a given [vol] in the same [location] a x number of [rounds].
@@ -75,55 +331,229 @@ def custom_mix(pipette, reagent, location, vol, rounds, blow_out, mix_height, x_
         pipette.blow_out(location.top(z=-2))
 
 
-def calc_height(ctx, reagent, tube_physical_description, cross_section_area, aspirate_volume, min_height=0.5):
+def _column_positions(labware, cache):
     """
-    Calculate pickup_height based on remaining volume and shape of container
+    Map every well of [labware] to its (column, row), None if the labware has not 8 rows
+    """
+    key = id(labware)
+    if key not in cache:
+        columns = labware.columns()
+        if not columns or len(columns[0]) != 8:
+            cache[key] = None
+        else:
+            cache[key] = {id(well): (c, r) for c, column in enumerate(columns) for r, well in enumerate(column)}
+    return cache[key]
 
-    :param reagent:
-    :param tube_physical_description:
-    :param cross_section_area:
-    :param aspirate_volume:
-    :param min_height:
 
-    :return:
+def promote_to_multichannel(transfers, single, multi=None):
     """
-    if not(reagent.get('vol_well_original')):
-        reagent['vol_well_original'] = reagent.get('vol_well')
-    if not (reagent.get('unused')):
-        reagent['unused'] = []
-    if not (reagent.get('col')):
-        reagent['col'] = 0
-    if reagent.get('vol_well') < aspirate_volume:
-        reagent.get('unused').append(reagent.get('vol_well'))
-        reagent['col'] = reagent.get('col') + 1
-        reagent['vol_well'] = reagent.get('vol_well_original')
-        height = (reagent.get('vol_well') - aspirate_volume - tube_physical_description.get('v_cono')) / cross_section_area
-        reagent['vol_well'] = reagent.get('vol_well') - aspirate_volume
-        if height < min_height:
-            height = min_height
-        col_change = True
-    else:
-        height = (reagent.get('vol_well') - aspirate_volume - tube_physical_description.get('v_cono')) / cross_section_area
-        reagent['vol_well'] = reagent.get('vol_well') - aspirate_volume
-        if height < min_height:
-            height = min_height
-        col_change = False
-    return height, col_change
+    Rewrite single-well transfers into 8-channel column moves when a whole column of a 96-well labware goes, row by
+    row, to a whole column of another 96-well labware.
+
+    :param transfers: list of (source well, destination well) or (source well, destination well, volume)
+    :param single: single-channel pipette for the transfers that can not be promoted
+    :param multi: loaded 8-channel pipette, if None nothing is promoted
+
+    :return: list of (pipette, source, destination, volume) in the order of the original transfers. Column moves
+             use the first well of each column as the multichannel does
+    """
+    transfers = [tuple(t) + (None,) * (3 - len(t)) for t in transfers]
+    if multi is None or getattr(multi, 'channels', 8) != 8:
+        return [(single, s, d, v) for s, d, v in transfers]
+
+    cache = {}
+    groups = {}
+    for n, (s, d, v) in enumerate(transfers):
+        src_pos = _column_positions(s.parent, cache)
+        dst_pos = _column_positions(d.parent, cache)
+        if src_pos is None or dst_pos is None:
+            continue
+        (src_col, src_row), (dst_col, dst_row) = src_pos[id(s)], dst_pos[id(d)]
+        if src_row == dst_row:
+            groups.setdefault((id(s.parent), src_col, id(d.parent), dst_col, v), []).append(n)
+
+    promoted = {}
+    for indexes in groups.values():
+        by_row = {_column_positions(transfers[n][0].parent, cache)[id(transfers[n][0])][1]: n for n in indexes}
+        if len(indexes) == 8 and sorted(by_row) == list(range(8)):
+            for n in indexes:
+                promoted[n] = (min(indexes), by_row[0])
+
+    moves = []
+    for n, (s, d, v) in enumerate(transfers):
+        if n not in promoted:
+            moves.append((single, s, d, v))
+        elif promoted[n][0] == n:
+            top = transfers[promoted[n][1]]
+            moves.append((multi, top[0], top[1], v))
+    return moves
+
+
+class WellTable:
+    """
+    Lazy, indexable and sliceable view of the wells of several racks, one rack after another.
+
+    Within each rack wells are ordered by columns (as labware.wells()) or by rows (as labware.rows()).
+    Slicing returns another view, no list of wells is built until a well is accessed.
+    """
+
+    def __init__(self, racks, order='columns', indexes=None, _cache=None):
+        if order not in ('columns', 'rows'):
+            raise ValueError('Unknown order {}, choose columns or rows'.format(order))
+        self.racks = list(racks)
+        self.order = order
+        self._cache = _cache if _cache is not None else {}
+        self._sizes = self._cache.setdefault('sizes', [len(rack.wells()) for rack in self.racks])
+        self._offsets = self._cache.setdefault('offsets', [sum(self._sizes[:i]) for i in range(len(self.racks))])
+        self._uniform = len(set(self._sizes)) <= 1
+        self._indexes = indexes if indexes is not None else range(sum(self._sizes))
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __iter__(self):
+        for i in self._indexes:
+            yield self._well(i)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return WellTable(self.racks, self.order, self._indexes[key], self._cache)
+        return self._well(self._indexes[key])
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def locate(self, key):
+        """
+        (rack index, well index within the rack) of the [key]-th well of the view
+        """
+        return self._position(self._indexes[key])
+
+    def _position(self, i):
+        if self._uniform:
+            return divmod(i, self._sizes[0])
+        rack = bisect.bisect_right(self._offsets, i) - 1
+        return rack, i - self._offsets[rack]
+
+    def _rack_wells(self, rack):
+        key = (self.order, rack)
+        if key not in self._cache:
+            labware = self.racks[rack]
+            self._cache[key] = [w for row in labware.rows() for w in row] if self.order == 'rows' else labware.wells()
+        return self._cache[key]
+
+    def _well(self, i):
+        rack, position = self._position(i)
+        return self._rack_wells(rack)[position]
 
 
-def generate_source_table(source):
+def generate_source_table(source, order='columns'):
     """
-    Concatenate the wells from the different origin racks
+    Concatenate the wells from the different origin racks (see WellTable)
     """
-    for rack_number in range(len(source)):
-        s = source[rack_number].wells() if rack_number == 0 else s + source[rack_number].wells()
-    return s
+    return WellTable(source, order)
 
 
 def pick_up(pip):
     pip.pick_up_tip()
 
 
+# Tip policies sorted from the least to the most strict
+TIP_POLICIES = ['never', 'per-n', 'per-source', 'per-destination']
+
+
+class TipManager:
+    """
+    Decide when a pipette has to pick up or drop a tip before each transfer.
+
+    Policies:
+        never: keep the same tip for every transfer
+        per-n: change tip every [every_n] transfers
+        per-source: change tip when the source (or the reagent) changes
+        per-destination: change tip on every transfer
+
+    Each reagent may define its own 'tip_policy' (see lab_stuff.buffer), the strictest of both is applied.
+    A tip is always changed when the reagent changes.
+    """
+
+    def __init__(self, pipette, policy='per-destination', every_n=1):
+        if policy not in TIP_POLICIES:
+            raise ValueError('Unknown tip policy {}, choose one of {}'.format(policy, TIP_POLICIES))
+        self.pipette = pipette
+        self.policy = policy
+        self.every_n = every_n
+        self.tips_used = 0
+        self._source = None
+        self._reagent = None
+        self._transfers = 0
+
+    def effective_policy(self, reagent=None):
+        reagent_policy = (reagent or {}).get('tip_policy', 'never')
+        return max(self.policy, reagent_policy, key=TIP_POLICIES.index)
+
+    def requires_new_tip(self, source, reagent=None):
+        if not self.pipette.hw_pipette['has_tip']:
+            return True
+        reagent_name = (reagent or {}).get('name')
+        if reagent_name != self._reagent:
+            return True
+        policy = self.effective_policy(reagent)
+        if policy == 'per-destination':
+            return True
+        if policy == 'per-source':
+            return source is not self._source
+        if policy == 'per-n':
+            return self._transfers >= self.every_n
+        return False
+
+    def prepare(self, source, reagent=None):
+        """
+        Ensure the pipette holds a suitable tip to aspirate [reagent] from [source]
+        """
+        if self.requires_new_tip(source, reagent):
+            self.release()
+            pick_up(self.pipette)
+            self.tips_used += 1
+            self._transfers = 0
+        self._source = source
+        self._reagent = (reagent or {}).get('name')
+        self._transfers += 1
+
+    def release(self):
+        """
+        Drop the tip if there is any attached
+        """
+        if self.pipette.hw_pipette['has_tip']:
+            self.pipette.drop_tip()
+        self._source = None
+        self._reagent = None
+
+
+def start_temperature(module, celsius):
+    """
+    Start the temperature ramp of a temperature module and return without waiting for it, so pipetting can go on
+    while the block cools. Call wait_temperature before the first step that needs the block at temperature.
+
+    Before apiLevel 2.3 there is no non-blocking call, so it waits here as set_temperature does.
+
+    :param module: temperature module context
+    :param celsius: target temperature
+    """
+    if tuple(module.api_version) >= (2, 3):
+        module.start_set_temperature(celsius)
+    else:
+        module.set_temperature(celsius)
+
+
+def wait_temperature(module, celsius):
+    """
+    Wait until a temperature module started with start_temperature reaches its target. It returns at once if
+    the temperature is already reached.
+    """
+    if tuple(module.api_version) >= (2, 3):
+        module.await_temperature(celsius)
+
+
 def notify_finish_process():
     for i in range(3):
         gpio.set_rail_lights(False)
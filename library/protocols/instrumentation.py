@@ -0,0 +1,202 @@
+"""
+Step instrumentation for long protocols.
+
+StepRecorder measures every step of a run: wall time, number of robot commands, tips used and liquid moved. Each
+finished step is appended as a JSON line to a log under /data (only when the robot is not simulating), so the
+bottleneck steps can be compared across runs.
+
+The robot commands are counted by a single CommandCounter per protocol context (see command_counter), shared with
+run_report.RunReport.
+"""
+import json
+import os
+import weakref
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+DEFAULT_LOG_PATH = '/data/log_times/step_log.jsonl'
+STEP_COUNTERS = ['commands', 'tips', 'volume']
+
+_counters = weakref.WeakKeyDictionary()
+
+
+def command_counter(ctx):
+    """
+    The CommandCounter of [ctx], subscribed to its commands the first time it is requested
+    """
+    if ctx not in _counters:
+        _counters[ctx] = CommandCounter(ctx)
+    return _counters[ctx]
+
+
+class CommandCounter:
+    """
+    Running totals of the robot commands of a protocol context: commands, tips picked up, volume aspirated (also
+    per source well in [liquid]), user pauses and delays. Use command_counter(ctx) to share it
+
+    Totals only grow, users keep a snapshot() at their start and subtract it.
+    """
+
+    def __init__(self, ctx):
+        self.totals = {'commands': 0, 'tips': 0, 'volume': 0.0, 'pauses': 0, 'pause_seconds': 0.0, 'delays': 0,
+                       'delay_seconds': 0.0}
+        self.liquid = defaultdict(float)
+        self._paused_at = None
+        try:
+            from opentrons.commands import types as command_types
+        except ImportError:
+            return
+        ctx.broker.subscribe(command_types.COMMAND, self._count)
+
+    def snapshot(self):
+        """
+        Copy of the totals and of the liquid per source well
+        """
+        self.close_pause()
+        return dict(self.totals), dict(self.liquid)
+
+    def close_pause(self):
+        """
+        Add the time of a pause still waiting for the user (the next command closes it otherwise)
+        """
+        if self._paused_at is not None:
+            now = datetime.now()
+            self.totals['pause_seconds'] += (now - self._paused_at).total_seconds()
+            self._paused_at = now
+
+    def _count(self, message):
+        if message.get('$') != 'before':
+            return
+        name = message['name']
+        payload = message.get('payload', {})
+        # A pause holds the next command until the user resumes
+        self.close_pause()
+        self._paused_at = None
+        channels = getattr(payload.get('instrument'), 'channels', 1)
+        self.totals['commands'] += 1
+        if name == 'command.PICK_UP_TIP':
+            self.totals['tips'] += channels
+        elif name == 'command.ASPIRATE':
+            volume = payload.get('volume', 0) * channels
+            self.totals['volume'] += volume
+            self.liquid[str(_source_well(payload.get('location')))] += volume
+        elif name == 'command.PAUSE':
+            self.totals['pauses'] += 1
+            self._paused_at = datetime.now()
+        elif name == 'command.DELAY':
+            self.totals['delays'] += 1
+            self.totals['delay_seconds'] += (payload.get('minutes') or 0) * 60 + (payload.get('seconds') or 0)
+
+
+def _source_well(location):
+    # Aspirate locations are wells or Locations whose labware is a well (wrapped in LabwareLike in newer APIs)
+    location = getattr(location, 'labware', location)
+    return getattr(location, 'object', location)
+
+
+class StepRecorder:
+    """
+    Record per-step metrics of a protocol run.
+
+    Usage:
+        steps = StepRecorder(ctx, metadata['protocolName'])
+        with steps.step(1, 'Transfer lysis'):
+            ...
+
+    or, for steps defined as a dict with 'Execute', 'description', 'Function' and 'wait_time':
+        steps.run_step(1, STEPS[1])
+    """
+
+    def __init__(self, ctx, protocol_name, log_path=DEFAULT_LOG_PATH):
+        self.ctx = ctx
+        self.protocol_name = protocol_name
+        self.log_path = log_path
+        self.run_id = datetime.now().strftime('%Y%m%d%H%M%S')
+        self.records = []
+        self.counter = command_counter(ctx)
+        self._current = None
+
+    # ------------------------
+    # Steps
+    # ------------------------
+    def start(self, number, description):
+        """
+        Mark the beginning of a step
+        """
+        self.ctx.comment(' ')
+        self.ctx.comment('###############################################')
+        self.ctx.comment('Step ' + str(number) + ': ' + description)
+        self.ctx.comment('###############################################')
+        self.ctx.comment(' ')
+        self._current = {'number': number, 'description': description, 'start': datetime.now(),
+                         'counters': dict(self.counter.totals)}
+
+    def finish(self, failed=False):
+        """
+        Mark the end of the current step, log it and return the time it took
+
+        :param failed: True when the step ended with an error, the record is marked with 'failed'
+        """
+        current = self._current
+        end = datetime.now()
+        time_taken = end - current['start']
+        record = {
+            'protocol': self.protocol_name,
+            'run': self.run_id,
+            'step': current['number'],
+            'description': current['description'],
+            'start': current['start'].isoformat(),
+            'seconds': time_taken.total_seconds(),
+        }
+        record.update((k, self.counter.totals[k] - current['counters'][k]) for k in STEP_COUNTERS)
+        if failed:
+            record['failed'] = True
+        self.records.append(record)
+        self._current = None
+        self.ctx.comment('Step ' + str(record['step']) + ': ' + record['description'] +
+                         (' failed after ' if failed else ' took ') + str(time_taken))
+        self._append(record)
+        return time_taken
+
+    @contextmanager
+    def step(self, number, description):
+        self.start(number, description)
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.finish(failed)
+
+    def run_step(self, number, step):
+        """
+        Execute a step defined as dict: {'Execute': bool, 'description': str, 'Function': callable, 'wait_time': s}
+        """
+        description = step.get('description', step.get('Description', ''))
+        if not step.get('Execute', True):
+            self.ctx.comment('Step ' + str(number) + ': ' + description + ' (skipped)')
+            return
+        self.start(number, description)
+        failed = True
+        try:
+            if step.get('Function'):
+                step['Function']()
+            if step.get('wait_time'):
+                self.ctx.delay(seconds=step['wait_time'], msg='Wait for ' + str(step['wait_time']) + ' seconds.')
+            failed = False
+        finally:
+            step['Time:'] = str(self.finish(failed))
+
+    # ------------------------
+    # Log
+    # ------------------------
+    def _append(self, record):
+        if self.ctx.is_simulating() or not self.log_path:
+            return
+        folder_path = os.path.dirname(self.log_path)
+        if folder_path and not os.path.isdir(folder_path):
+            os.makedirs(folder_path)
+        with open(self.log_path, 'a') as log_file:
+            log_file.write(json.dumps(record) + '\n')
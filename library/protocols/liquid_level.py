@@ -0,0 +1,126 @@
+"""
+Liquid-level model shared by all stations.
+
+A Container describes the geometry of a tube, well or reservoir. Given the initial volume and the full sequence of
+planned withdrawals, pickup_heights() returns every aspiration height in one call. Heights are taken [submersion]
+mm below the liquid level left by each aspiration, so the tip is still in the liquid when it ends.
+"""
+import math
+
+import numpy as np
+
+
+BOTTOM_SHAPES = ['flat', 'cone', 'hemisphere']
+# Depth of the tip below the liquid surface (mm), as the -2.5 margin of the MAGMAX stations
+DEFAULT_SUBMERSION = 2.5
+
+
+class Container:
+    """
+    Geometry of a container: a cylinder (diameter) or a prismatic reservoir (length x width) over a flat, conical
+    or hemispherical bottom.
+
+    :param diameter: inner diameter of a round container (mm)
+    :param bottom: 'flat', 'cone' or 'hemisphere'
+    :param bottom_height: height of the conical bottom (mm), hemispheres use diameter / 2
+    :param length: inner length of a prismatic reservoir well (mm)
+    :param width: inner width of a prismatic reservoir well (mm)
+    :param max_height: height of the container, only used to build the lookup table (mm)
+    :param min_height: minimum height to aspirate from (mm)
+    """
+
+    def __init__(self, diameter=None, bottom='flat', bottom_height=0, length=None, width=None, max_height=120,
+                 min_height=0.5, resolution=0.05):
+        if bottom not in BOTTOM_SHAPES:
+            raise ValueError('Unknown bottom shape {}, choose one of {}'.format(bottom, BOTTOM_SHAPES))
+        if diameter is None and (length is None or width is None):
+            raise ValueError('A container requires a diameter or a length and a width')
+        self.min_height = min_height
+        if length is not None and width is not None:
+            self.area = length * width
+            # A prismatic reservoir with a conical bottom is modeled as an inverted pyramid
+            diameter = 2 * math.sqrt(self.area / math.pi) if diameter is None else diameter
+        else:
+            self.area = math.pi * diameter ** 2 / 4
+        if bottom == 'hemisphere':
+            bottom_height = diameter / 2
+        elif bottom == 'flat':
+            bottom_height = 0
+        self.bottom = bottom
+        self.bottom_height = bottom_height
+
+        # Lookup table volume(height), monotonic so it can be inverted with np.interp
+        self._heights = np.arange(0, max_height + resolution, resolution)
+        self._volumes = self.volume_at(self._heights)
+
+    @property
+    def bottom_volume(self):
+        return float(self.volume_at(np.array([self.bottom_height]))[0])
+
+    def volume_at(self, heights):
+        """
+        Volume (µl) contained up to each of [heights] (mm)
+        """
+        h = np.asarray(heights, dtype=float)
+        hb = self.bottom_height
+        in_bottom = np.minimum(h, hb)
+        if self.bottom == 'cone' and hb > 0:
+            # Volume of a cone of height h with the same aperture
+            bottom = self.area * in_bottom ** 3 / (3 * hb ** 2)
+        elif self.bottom == 'hemisphere':
+            # Spherical cap of height h, scaled to the cross-section of the container
+            r = hb
+            bottom = math.pi * in_bottom ** 2 * (3 * r - in_bottom) / 3 * self.area / (math.pi * r ** 2)
+        else:
+            bottom = np.zeros_like(h)
+        return bottom + self.area * np.maximum(h - hb, 0)
+
+    def height_at(self, volumes):
+        """
+        Liquid height (mm) for each of [volumes] (µl), never lower than min_height
+        """
+        heights = np.interp(np.asarray(volumes, dtype=float), self._volumes, self._heights)
+        return np.maximum(heights, self.min_height)
+
+    def pickup_height(self, volumes, submersion=DEFAULT_SUBMERSION):
+        """
+        Aspiration height (mm) that leaves the tip [submersion] mm below the level of each of [volumes] (µl), the
+        volume left after the aspiration. Never lower than min_height
+        """
+        return np.maximum(self.height_at(volumes) - submersion, self.min_height)
+
+
+def pickup_heights(container, well_volume, withdrawals, num_wells=1, submersion=DEFAULT_SUBMERSION):
+    """
+    Heights to aspirate every one of [withdrawals] in order.
+
+    The first well is used until it can not serve a withdrawal, then the next one. Heights are [submersion] mm
+    below the liquid level after each aspiration.
+
+    :param container: Container of every well
+    :param well_volume: initial volume in each well (µl), a number or a list with one value per well
+    :param withdrawals: list of volumes to aspirate (µl)
+    :param num_wells: number of wells with the same liquid
+    :param submersion: depth of the tip below the liquid surface (mm)
+
+    :return: (numpy array of heights, numpy array of well indexes)
+    :raises ValueError: when the wells do not contain enough liquid for every withdrawal
+    """
+    withdrawals = np.asarray(withdrawals, dtype=float)
+    volumes = np.broadcast_to(np.asarray(well_volume, dtype=float), (num_wells,)).copy()
+    wells = np.empty(len(withdrawals), dtype=int)
+    remaining = np.empty(len(withdrawals), dtype=float)
+
+    # Well assignment is sequential, but each well is filled with a whole run of withdrawals at once
+    start, well = 0, 0
+    while start < len(withdrawals):
+        if well >= num_wells:
+            raise ValueError('Not enough liquid: {} µl more are required'.format(withdrawals[start:].sum()))
+        used = np.cumsum(withdrawals[start:])
+        fits = int(np.searchsorted(used, volumes[well] + 1e-9, side='right'))
+        wells[start:start + fits] = well
+        remaining[start:start + fits] = volumes[well] - used[:fits]
+        start += fits
+        well += 1
+
+    return container.pickup_height(remaining, submersion), wells
@@ -0,0 +1,170 @@
+"""
+Normalization of samples to a final concentration.
+
+The concentration table is a CSV with one row per destination well (see chus_protocols/protocolos_sec/foo.csv):
+
+    ID,Ci,Cf,Vf
+    A1,5.94,4,20
+
+    Ci = initial concentration of the sample, Cf = final concentration, Vf = final volume (µl)
+    Vi = Cf * Vf / Ci, volume of sample
+    Vt = Vf - Vi, volume of buffer
+
+Volumes are computed for the whole table at once with numpy. Empty rows (wells without sample) are skipped and
+the rows that cannot be prepared are reported: missing values, concentrations or volumes not positive, final
+concentration above the initial one and volumes below the minimum of the pipette.
+
+A sheet with more than one plate has a Plate column or, without it, its rows are taken 96 by 96 in order. A row
+with an empty Plate cell belongs to the plate of the previous row. The transfer plan of a plate dispenses the
+buffer first to every well with a single tip and then every sample with its own tip.
+
+The rows go to the wells named by their ID when every ID is a well name, otherwise to the wells in the order of the
+table (see well_positions).
+"""
+import csv
+
+import numpy as np
+
+
+COLUMNS = ['ID', 'Ci', 'Cf', 'Vf']
+PLATE_COLUMN = 'Plate'
+WELLS_PER_PLATE = 96
+
+
+def _number(text):
+    text = (text or '').strip().replace(',', '.')
+    return float(text) if text else np.nan
+
+
+def read_table(path):
+    """
+    Concentration table of a CSV file
+
+    :return: dict with the numpy arrays 'ID' (str), 'Ci', 'Cf', 'Vf' and 'Plate' (int) in the order of the file
+    """
+    with open(path, encoding='utf-8-sig', newline='') as table_file:
+        sample = table_file.read(2048)
+        table_file.seek(0)
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t') if sample else csv.excel
+        rows = list(csv.DictReader(table_file, dialect=dialect))
+    missing = [column for column in COLUMNS if rows and column not in rows[0]]
+    if missing:
+        raise ValueError('{} has no column {}'.format(path, ', '.join(missing)))
+    table = {'ID': np.array([(row['ID'] or '').strip() for row in rows], dtype=str)}
+    for column in COLUMNS[1:]:
+        table[column] = np.array([_number(row[column]) for row in rows], dtype=float)
+    if rows and PLATE_COLUMN in rows[0]:
+        plate = 1
+        numbers = []
+        for row in rows:
+            value = _number(row[PLATE_COLUMN])
+            plate = plate if np.isnan(value) else int(value)
+            numbers.append(plate)
+        table[PLATE_COLUMN] = np.array(numbers, dtype=int)
+    else:
+        table[PLATE_COLUMN] = np.arange(len(rows)) // WELLS_PER_PLATE + 1
+    return table
+
+
+def plates(table):
+    """
+    Plate numbers of a table, sorted
+    """
+    return sorted(set(table[PLATE_COLUMN].tolist()))
+
+
+def select_plate(table, plate):
+    """
+    Rows of [table] that belong to [plate]
+    """
+    rows = table[PLATE_COLUMN] == plate
+    if not rows.any():
+        raise ValueError('There is no plate {} in the table, plates: {}'.format(plate, plates(table)))
+    return {column: values[rows] for column, values in table.items()}
+
+
+def well_positions(ids, well_names):
+    """
+    Position of the well of every row: the well named by its ID when every ID is one of [well_names], the row
+    number otherwise. IDs and positions are never mixed
+
+    :param ids: IDs of the rows of a plate
+    :param well_names: names of the wells of the plate in order (e.g. list(plate.wells_by_name()))
+    :return: list of indexes of [well_names]
+    :raises ValueError: when there are more rows than wells or two rows name the same well
+    """
+    ids = [str(well_id) for well_id in ids]
+    if len(ids) > len(well_names):
+        raise ValueError('{} rows do not fit in a plate of {} wells'.format(len(ids), len(well_names)))
+    index = {name: i for i, name in enumerate(well_names)}
+    if not ids or not all(well_id in index for well_id in ids):
+        return list(range(len(ids)))
+    repeated = sorted({well_id for well_id in ids if ids.count(well_id) > 1}, key=index.get)
+    if repeated:
+        raise ValueError('Wells used by more than one row: {}'.format(', '.join(repeated)))
+    return [index[well_id] for well_id in ids]
+
+
+def normalize(table, min_vol=1):
+    """
+    Sample and buffer volumes of every row of [table]
+
+    :param min_vol: minimum volume the pipette can transfer (µl)
+    :return: dict with the arrays of [table] plus 'Vi' and 'Vt' (rounded to 0.01 µl, 0 for the rows not valid),
+             'empty' and 'valid' (bool) and 'errors', a list of (ID, reason)
+    """
+    ci, cf, vf = table['Ci'], table['Cf'], table['Vf']
+    values = np.stack([ci, cf, vf])
+    empty = np.isnan(values).all(axis=0)
+    incomplete = np.isnan(values).any(axis=0) & ~empty
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vi = np.round(cf * vf / ci, 2)
+    vt = np.round(vf - vi, 2)
+
+    checks = [
+        (incomplete, 'missing values'),
+        ((ci <= 0) | (cf <= 0) | (vf <= 0), 'concentrations and final volume must be positive'),
+        (cf > ci, 'final concentration above the initial one'),
+        (vi < min_vol, 'sample volume below {} µl'.format(min_vol)),
+        ((vt > 0) & (vt < min_vol), 'buffer volume below {} µl'.format(min_vol)),
+    ]
+    valid = ~empty
+    errors = {}
+    for failed, reason in checks:
+        failed = failed & valid
+        for i in np.flatnonzero(failed):
+            errors[i] = reason
+        valid &= ~failed
+
+    result = dict(table)
+    result.update({
+        'Vi': np.where(valid, vi, 0),
+        'Vt': np.where(valid, np.maximum(vt, 0), 0),
+        'empty': empty,
+        'valid': valid,
+        'errors': [(str(table['ID'][i]) or 'row {}'.format(i + 1), reason) for i, reason in sorted(errors.items())],
+    })
+    return result
+
+
+def plan_transfers(normalized, max_vol):
+    """
+    Ordered transfers of a normalized plate: the buffer of every well first, then the samples
+
+    :param max_vol: maximum volume per aspiration (tip volume minus the air gap)
+    :return: dict with 'buffer', a list of (row index, volume) to dispense with one tip, and 'samples', a list of
+             (row index, [volumes]) with the sample volume split in aspirations that fit in the tip
+    """
+    rows = np.flatnonzero(normalized['valid'])
+    return {
+        'buffer': [(int(i), float(normalized['Vt'][i])) for i in rows if normalized['Vt'][i] > 0],
+        'samples': [(int(i), _split_volume(float(normalized['Vi'][i]), max_vol)) for i in rows],
+    }
+
+
+def _split_volume(vol, max_vol):
+    """
+    Split [vol] in the minimum number of equal volumes not greater than [max_vol], rounded to 0.01 µl
+    """
+    parts = int(np.ceil(vol / max_vol))
+    return [round(vol / parts, 2)] * parts
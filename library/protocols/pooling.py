@@ -0,0 +1,189 @@
+"""
+Pooling plans and pool maps.
+
+Samples (indexes in the order of the source table) are grouped in pools:
+    * plan_pools: consecutive pools of a fixed size, or of the sizes of a list (variable pools). optimal_pool_size
+      gives the size that needs the fewest tests per sample for a prevalence (Dorfman pooling).
+    * plan_matrix: 2D matrix pooling. The samples are laid out in matrices of rows x columns and every sample goes
+      to the pool of its row and to the pool of its column, so a positive sample is found as the crossing of a
+      positive row and a positive column without retesting. An incomplete last matrix is reshaped to its samples so
+      no pool has a single sample.
+
+Every pool gets the same final volume, split among its samples (check_sample_volumes checks what each sample tube
+has to give). The pool map (which samples went to each pool and
+where the pool is) is saved as JSON next to the run so the results can be deconvolved:
+
+    python -m library.protocols.pooling pool_map.json --positive M1-R2 M1-C5
+"""
+import argparse
+import json
+import math
+import os
+from datetime import datetime
+
+
+DEFAULT_POOL_MAP_FOLDER = '/data/pool_maps'
+
+
+def plan_pools(num_samples, pool_size):
+    """
+    Consecutive pools
+
+    :param pool_size: samples per pool, or a list of pool sizes (the last one is repeated for the remaining samples)
+    :return: list of pools, each one a dict {'name': 'P1', 'samples': [sample indexes]}
+    """
+    sizes = list(pool_size) if isinstance(pool_size, (list, tuple)) else [pool_size]
+    if not sizes or min(sizes) < 1:
+        raise ValueError('Pool sizes must be at least 1: {}'.format(pool_size))
+    pools = []
+    start = 0
+    while start < num_samples:
+        size = sizes[min(len(pools), len(sizes) - 1)]
+        pools.append({'name': 'P{}'.format(len(pools) + 1), 'samples': list(range(start, min(start + size,
+                                                                                             num_samples)))})
+        start += size
+    return pools
+
+
+def optimal_pool_size(prevalence, max_size=32):
+    """
+    Pool size with the fewest expected tests per sample (one test per pool plus retesting every sample of the
+    positive pools) for the given prevalence, 1 when pooling does not pay off
+    """
+    def tests_per_sample(k):
+        return 1 if k == 1 else 1 / k + 1 - (1 - prevalence) ** k
+    return min(range(1, max_size + 1), key=tests_per_sample)
+
+
+def _matrix_pools(samples, rows, cols, matrix):
+    pools = []
+    for r in range(rows):
+        row = samples[r * cols:(r + 1) * cols]
+        if row:
+            pools.append({'name': 'M{}-R{}'.format(matrix, r + 1), 'samples': row})
+    for c in range(cols):
+        col = samples[c::cols]
+        if col:
+            pools.append({'name': 'M{}-C{}'.format(matrix, c + 1), 'samples': col})
+    return pools
+
+
+def matrix_shape(num_samples, rows, cols):
+    """
+    Shape of a matrix for [num_samples] (at most rows x cols) with the fewest pools and at least 2 samples in every
+    row and column pool, so every sample is found by the crossing of 2 real pools
+
+    :raises ValueError: when there is no such shape (less than 4 samples)
+    """
+    shapes = sorted(((r, c) for r in range(2, rows + 1) for c in range(2, cols + 1) if r * c >= num_samples),
+                    key=lambda shape: (shape[0] + shape[1], abs(shape[0] - shape[1])))
+    for r, c in shapes:
+        if min(len(pool['samples']) for pool in _matrix_pools(list(range(num_samples)), r, c, 1)) >= 2:
+            return r, c
+    raise ValueError('{} samples are too few for a matrix of pools'.format(num_samples))
+
+
+def plan_matrix(num_samples, rows, cols):
+    """
+    2D matrix pools: sample i goes to the row and to the column pools of its matrix. Samples fill every matrix by
+    rows. The last matrix, when it is not full, is reshaped to its samples (see matrix_shape) so it has no pools of
+    a single sample.
+
+    :return: list of pools, each one a dict {'name': 'M1-R1' or 'M1-C1', 'samples': [sample indexes]}
+    """
+    if rows < 2 or cols < 2:
+        raise ValueError('A matrix needs at least 2 rows and 2 columns')
+    pools = []
+    per_matrix = rows * cols
+    for m in range(math.ceil(num_samples / per_matrix)):
+        samples = list(range(m * per_matrix, min((m + 1) * per_matrix, num_samples)))
+        shape = (rows, cols) if len(samples) == per_matrix else matrix_shape(len(samples), rows, cols)
+        pools += _matrix_pools(samples, shape[0], shape[1], m + 1)
+    return pools
+
+
+def sample_transfers(pools, pool_volume):
+    """
+    Transfers grouped by sample, so each sample is aspirated once for all its pools
+
+    :param pool_volume: final volume of every pool, split among its samples
+    :return: list of (sample index, [(pool index, volume)]) in sample order
+    """
+    transfers = {}
+    for p, pool in enumerate(pools):
+        for sample in pool['samples']:
+            transfers.setdefault(sample, []).append((p, pool_volume / len(pool['samples'])))
+    return sorted(transfers.items())
+
+
+def check_sample_volumes(transfers, max_volume):
+    """
+    Samples that would give more than [max_volume] in total to their pools
+
+    :param transfers: see sample_transfers
+    :raises ValueError: listing them (sample numbers are 1 based, as in the pool map)
+    """
+    over = ['{} ({:.0f} µl)'.format(s + 1, sum(v for _, v in pools)) for s, pools in transfers
+            if sum(v for _, v in pools) > max_volume]
+    if over:
+        raise ValueError('Samples giving more than {} µl: {}'.format(max_volume, ', '.join(over)))
+
+
+def pool_map(pools, sources, destinations, mode):
+    """
+    Machine readable map of a pooling run
+
+    :param sources: sample wells, by sample index
+    :param destinations: pool wells, by pool index
+    """
+    return {
+        'mode': mode,
+        'pools': [{'name': pool['name'], 'destination': str(destinations[p]),
+                   'samples': [s + 1 for s in pool['samples']]} for p, pool in enumerate(pools)],
+        'samples': {str(s + 1): str(source) for s, source in enumerate(sources)},
+    }
+
+
+def save_pool_map(ctx, protocol_name, pools_map, folder=DEFAULT_POOL_MAP_FOLDER):
+    """
+    Write the pool map as <folder>/<protocol>_<date>.json (only when the robot is not simulating)
+
+    :return: the file path, None while simulating
+    """
+    ctx.comment('{} pools of {} samples'.format(len(pools_map['pools']), len(pools_map['samples'])))
+    if ctx.is_simulating():
+        return None
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, '{}_{}.json'.format(protocol_name.replace(' ', '_'),
+                                                    datetime.now().strftime('%Y%m%d%H%M%S')))
+    with open(path, 'w') as map_file:
+        json.dump(dict(pools_map, protocol=protocol_name), map_file, indent=1)
+    return path
+
+
+def decode(pools_map, positive):
+    """
+    Samples that may be positive: those whose pools are all positive (for a matrix, its row and its column)
+
+    :param positive: names of the positive pools
+    :return: sorted list of sample numbers (1 based, as in the pool map)
+    """
+    positive = set(positive)
+    pools_of = {}
+    for pool in pools_map['pools']:
+        for sample in pool['samples']:
+            pools_of.setdefault(sample, set()).add(pool['name'])
+    return sorted(s for s, names in pools_of.items() if names <= positive)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Samples to retest from the positive pools of a pool map')
+    parser.add_argument('pool_map', help='pool map json written by a pooling protocol')
+    parser.add_argument('--positive', nargs='*', default=[], help='names of the positive pools')
+    args = parser.parse_args()
+
+    with open(args.pool_map) as pool_map_file:
+        loaded = json.load(pool_map_file)
+    for number in decode(loaded, args.positive):
+        print(number, loaded['samples'][str(number)])
@@ -0,0 +1,195 @@
+"""
+Compile phase for ot2 protocols.
+
+A protocol first builds a Plan: a flat, serializable list of liquid-handling operations where heights, volumes,
+wells and tip events are already resolved. The plan can then be validated, saved and finally executed as a
+separate step, so mistakes such as running out of reagent appear before the robot moves.
+"""
+import json
+
+
+ACTIONS = ['pick_up', 'drop', 'aspirate', 'dispense', 'blow_out', 'touch_tip', 'delay', 'comment']
+
+
+class PlanError(Exception):
+    pass
+
+
+class Plan:
+    """
+    Flat list of liquid-handling operations.
+
+    Every operation is a dict with an 'action' (see ACTIONS) and, depending on it: 'pipette', 'labware', 'well'
+    (index in labware.wells()), 'volume', 'height', 'reference' ('bottom' or 'top'), 'x_offset', 'rate',
+    'speed', 'v_offset', 'seconds' or 'text'.
+    """
+
+    def __init__(self, operations=None):
+        self.operations = list(operations or [])
+        self._labware = {}
+        self._wells = {}
+
+    # ------------------------
+    # Labware
+    # ------------------------
+    def register(self, name, labware):
+        """
+        Give a name to a loaded [labware] so its wells can be referenced in the plan
+        """
+        self._labware[name] = labware
+        for i, well in enumerate(labware.wells()):
+            self._wells[id(well)] = (name, i)
+        return labware
+
+    def well_ref(self, well):
+        try:
+            return self._wells[id(well)]
+        except KeyError:
+            raise PlanError('Well {} belongs to a labware not registered in the plan'.format(well))
+
+    # ------------------------
+    # Operations
+    # ------------------------
+    def _add(self, action, pipette=None, well=None, **fields):
+        operation = {'action': action}
+        if pipette is not None:
+            operation['pipette'] = pipette
+        if well is not None:
+            operation['labware'], operation['well'] = self.well_ref(well)
+        operation.update((k, v) for k, v in fields.items() if v is not None)
+        self.operations.append(operation)
+        return operation
+
+    def pick_up(self, pipette):
+        return self._add('pick_up', pipette)
+
+    def drop(self, pipette):
+        return self._add('drop', pipette)
+
+    def aspirate(self, pipette, well, volume, height, reference='bottom', x_offset=0, rate=1):
+        return self._add('aspirate', pipette, well, volume=volume, height=height, reference=reference,
+                         x_offset=x_offset, rate=rate)
+
+    def dispense(self, pipette, well, volume, height, reference='top', x_offset=0, rate=1):
+        return self._add('dispense', pipette, well, volume=volume, height=height, reference=reference,
+                         x_offset=x_offset, rate=rate)
+
+    def blow_out(self, pipette, well, height=-2):
+        return self._add('blow_out', pipette, well, height=height, reference='top')
+
+    def touch_tip(self, pipette, speed=20, v_offset=-5):
+        return self._add('touch_tip', pipette, speed=speed, v_offset=v_offset)
+
+    def delay(self, seconds):
+        return self._add('delay', seconds=seconds)
+
+    def comment(self, text):
+        return self._add('comment', text=text)
+
+    # ------------------------
+    # Validation
+    # ------------------------
+    def validate(self, max_volumes, initial_volumes=None):
+        """
+        Check the plan without touching the robot
+
+        :param max_volumes: dict pipette name -> maximum volume of its tips
+        :param initial_volumes: dict (labware name, well index) -> available volume. Aspirating more than the
+                                available volume from those wells is an error
+
+        :return: dict (labware name, well index) -> volume in the well after the plan (starting at 0 when unknown)
+        """
+        volumes = dict(initial_volumes or {})
+        has_tip = {}
+        content = {}
+        for n, op in enumerate(self.operations):
+            action = op['action']
+            if action not in ACTIONS:
+                raise PlanError('Operation {}: unknown action {}'.format(n, action))
+            pipette = op.get('pipette')
+            if action == 'pick_up':
+                if has_tip.get(pipette):
+                    raise PlanError('Operation {}: {} already has a tip'.format(n, pipette))
+                has_tip[pipette] = True
+                content[pipette] = 0
+            elif action == 'drop':
+                has_tip[pipette] = False
+            elif action in ('aspirate', 'dispense'):
+                if not has_tip.get(pipette):
+                    raise PlanError('Operation {}: {} without tip'.format(n, action))
+                well = (op['labware'], op['well'])
+                sign = 1 if action == 'aspirate' else -1
+                content[pipette] += sign * op['volume']
+                if content[pipette] > max_volumes[pipette] + 1e-6:
+                    raise PlanError('Operation {}: {} holds {} µl, more than {} µl'.format(
+                        n, pipette, content[pipette], max_volumes[pipette]))
+                if content[pipette] < -1e-6:
+                    raise PlanError('Operation {}: {} dispenses more than it holds'.format(n, pipette))
+                volumes[well] = volumes.get(well, 0) - sign * op['volume']
+                if initial_volumes and well in initial_volumes and volumes[well] < -1e-6:
+                    raise PlanError('Operation {}: not enough liquid in well {} of {}'.format(n, op['well'],
+                                                                                           op['labware']))
+            elif action == 'blow_out':
+                content[pipette] = 0
+        return volumes
+
+    def count(self, action):
+        return sum(1 for op in self.operations if op['action'] == action)
+
+    # ------------------------
+    # Serialization
+    # ------------------------
+    def dumps(self):
+        return json.dumps(self.operations, indent=1)
+
+    def save(self, path):
+        with open(path, 'w') as plan_file:
+            plan_file.write(self.dumps())
+
+    @classmethod
+    def load(cls, path, labware=None):
+        """
+        Load a plan saved with save(), [labware] is a dict name -> loaded labware to execute it
+        """
+        with open(path) as plan_file:
+            plan = cls(json.load(plan_file))
+        for name, lw in (labware or {}).items():
+            plan.register(name, lw)
+        return plan
+
+    # ------------------------
+    # Execution
+    # ------------------------
+    def _location(self, op):
+        from opentrons.types import Point
+
+        well = self._labware[op['labware']].wells()[op['well']]
+        reference = well.bottom if op.get('reference', 'bottom') == 'bottom' else well.top
+        return reference(op.get('height', 0)).move(Point(x=op.get('x_offset', 0)))
+
+    def execute(self, ctx, pipettes):
+        """
+        Run every operation of the plan
+
+        :param ctx: protocol context
+        :param pipettes: dict pipette name -> loaded pipette
+        """
+        for op in self.operations:
+            action = op['action']
+            pipette = pipettes.get(op.get('pipette'))
+            if action == 'pick_up':
+                pipette.pick_up_tip()
+            elif action == 'drop':
+                pipette.drop_tip()
+            elif action == 'aspirate':
+                pipette.aspirate(op['volume'], self._location(op), rate=op.get('rate', 1))
+            elif action == 'dispense':
+                pipette.dispense(op['volume'], self._location(op), rate=op.get('rate', 1))
+            elif action == 'blow_out':
+                pipette.blow_out(self._location(op))
+            elif action == 'touch_tip':
+                pipette.touch_tip(speed=op.get('speed', 20), v_offset=op.get('v_offset', -5))
+            elif action == 'delay':
+                ctx.delay(seconds=op['seconds'])
+            elif action == 'comment':
+                ctx.comment(op['text'])
@@ -0,0 +1,238 @@
+"""
+Run reports.
+
+A RunReport follows the robot commands of a run and, when the protocol calls finish(), writes a JSON report and a
+CSV with one row per step to /data/run_reports (only when the robot is not simulating):
+    samples processed, total and per step time, samples per hour, tips per sample, liquid aspirated from every
+    source (named after the reagent when it is registered) and pauses (user pauses and delays)
+
+Usage:
+    report = run_report.RunReport(ctx, metadata['protocolName'], num_samples)
+    report.add_reagent('Lysis', Lysis.reagent_reservoir)        # optional
+    ...
+    report.finish(steps.records)                                  # records of an instrumentation.StepRecorder
+
+The reports of many runs (copied from the robots) are summarized per station, protocol and day with:
+
+    python -m library.protocols.run_report reports/ --output trends.csv
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import socket
+from collections import defaultdict
+from datetime import datetime
+
+from library.protocols import instrumentation
+
+
+DEFAULT_REPORT_FOLDER = '/data/run_reports'
+STEP_FIELDS = ['protocol', 'robot', 'run', 'step', 'description', 'seconds', 'commands', 'tips', 'volume']
+TREND_FIELDS = ['station', 'protocol', 'day', 'runs', 'samples', 'samples_per_hour', 'seconds_per_sample',
+                'tips_per_sample', 'pause_minutes', 'slowest_step', 'slowest_step_seconds']
+
+
+def station_of(robot):
+    """
+    Station of a robot by its name (sar1 or SA-R1 -> 'A', sbr2 -> 'B', ...), the robot name if it does not follow
+    the naming
+    """
+    match = re.match(r's([a-z])-?r\d+$', robot, re.IGNORECASE)
+    return match.group(1).upper() if match else robot
+
+
+class RunReport:
+    """
+    Metrics of one protocol run
+
+    :param ctx: protocol context
+    :param protocol_name: name of the protocol
+    :param num_samples: samples processed in the run
+    :param folder: where the reports are written
+    :param robot_name: defaults to the host name of the robot
+    """
+
+    def __init__(self, ctx, protocol_name, num_samples, folder=DEFAULT_REPORT_FOLDER, robot_name=None):
+        self.ctx = ctx
+        self.protocol_name = protocol_name
+        self.num_samples = num_samples
+        self.folder = folder
+        self.robot_name = robot_name or socket.gethostname()
+        self.start = datetime.now()
+        self.run_id = self.start.strftime('%Y%m%d%H%M%S')
+        self.reagents = {}
+        # Commands are counted by the counter shared with the StepRecorder of the run, from this point on
+        self.counter = instrumentation.command_counter(ctx)
+        self._totals, self._liquid = self.counter.snapshot()
+
+    def add_reagent(self, name, wells):
+        """
+        Report the liquid aspirated from [wells] (a well, a list of wells or a labware) as [name]
+        """
+        if hasattr(wells, 'wells'):
+            wells = wells.wells()
+        elif not isinstance(wells, (list, tuple)):
+            wells = [wells]
+        for well in wells:
+            self.reagents[str(well)] = name
+
+    @property
+    def commands(self):
+        return self.counter.totals['commands'] - self._totals['commands']
+
+    @property
+    def tips(self):
+        return self.counter.totals['tips'] - self._totals['tips']
+
+    @property
+    def liquid(self):
+        """
+        Liquid aspirated from every source since the start of the report, by reagent name when it is registered
+        """
+        liquid = defaultdict(float)
+        for source, volume in self.counter.liquid.items():
+            liquid[self.reagents.get(source, source)] += volume - self._liquid.get(source, 0)
+        return {k: v for k, v in liquid.items() if v}
+
+    @property
+    def pauses(self):
+        """
+        User pauses and delays since the start of the report, a pause still waiting for the user included
+        """
+        self.counter.close_pause()
+        totals = {k: self.counter.totals[k] - self._totals[k] for k in self._totals}
+        return {'count': totals['pauses'], 'seconds': totals['pause_seconds'], 'delays': totals['delays'],
+                'delay_seconds': totals['delay_seconds']}
+
+    # ------------------------
+    # Report
+    # ------------------------
+    def summary(self, steps=None):
+        """
+        Report of the run as a dict
+
+        :param steps: step records of an instrumentation.StepRecorder
+        """
+        seconds = (datetime.now() - self.start).total_seconds()
+        samples = self.num_samples or 0
+        return {
+            'protocol': self.protocol_name,
+            'robot': self.robot_name,
+            'station': station_of(self.robot_name),
+            'run': self.run_id,
+            'start': self.start.isoformat(),
+            'seconds': round(seconds, 1),
+            'samples': samples,
+            'samples_per_hour': round(samples * 3600 / seconds, 2) if seconds else None,
+            'commands': self.commands,
+            'tips': self.tips,
+            'tips_per_sample': round(self.tips / samples, 2) if samples else None,
+            'liquid': {k: round(v, 1) for k, v in sorted(self.liquid.items())},
+            'pauses': {k: round(v, 1) for k, v in self.pauses.items()},
+            'steps': [{k: record.get(k) for k in STEP_FIELDS[3:]} for record in steps or []],
+        }
+
+    def finish(self, steps=None):
+        """
+        Write the report of the run (JSON and CSV) and comment the main figures
+
+        :param steps: step records of an instrumentation.StepRecorder
+        :return: the report dict
+        """
+        report = self.summary(steps)
+        self.ctx.comment('{} samples in {} s ({} samples/h), {} tips'.format(
+            report['samples'], report['seconds'], report['samples_per_hour'], report['tips']))
+        if not self.ctx.is_simulating() and self.folder:
+            self.write(report)
+        return report
+
+    def write(self, report):
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        base_path = os.path.join(self.folder, '{}_{}_{}'.format(
+            report['run'], report['robot'], report['protocol'].replace(' ', '_')))
+        with open(base_path + '.json', 'w') as json_file:
+            json.dump(report, json_file, indent=1)
+        with open(base_path + '.csv', 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, STEP_FIELDS)
+            writer.writeheader()
+            for step in report['steps']:
+                writer.writerow(dict(step, protocol=report['protocol'], robot=report['robot'], run=report['run']))
+            writer.writerow({'protocol': report['protocol'], 'robot': report['robot'], 'run': report['run'],
+                             'step': 'total', 'seconds': report['seconds'], 'commands': report['commands'],
+                             'tips': report['tips'], 'volume': sum(report['liquid'].values())})
+        return base_path
+
+
+# ------------------------
+# Aggregation
+# ------------------------
+def read_reports(paths):
+    """
+    Reports of the JSON files in [paths] (files or folders, searched recursively)
+    """
+    reports = []
+    for path in paths:
+        files = glob.glob(os.path.join(path, '**', '*.json'), recursive=True) if os.path.isdir(path) else [path]
+        for name in sorted(files):
+            with open(name) as report_file:
+                report = json.load(report_file)
+            if 'samples_per_hour' in report:
+                reports.append(report)
+    return reports
+
+
+def trends(reports):
+    """
+    Runs grouped by station, protocol and day, in that order
+
+    :return: list of dicts with the TREND_FIELDS
+    """
+    groups = defaultdict(list)
+    for report in reports:
+        groups[(report['station'], report['protocol'], report['start'][:10])].append(report)
+
+    rows = []
+    for (station, protocol, day), runs in sorted(groups.items()):
+        samples = sum(r['samples'] for r in runs)
+        seconds = sum(r['seconds'] for r in runs)
+        step_seconds = defaultdict(list)
+        for r in runs:
+            for step in r['steps']:
+                step_seconds[step['description']].append(step['seconds'] or 0)
+        slowest = max(step_seconds, key=lambda k: sum(step_seconds[k]) / len(step_seconds[k]), default=None)
+        rows.append({
+            'station': station,
+            'protocol': protocol,
+            'day': day,
+            'runs': len(runs),
+            'samples': samples,
+            'samples_per_hour': round(samples * 3600 / seconds, 2) if seconds else None,
+            'seconds_per_sample': round(seconds / samples, 1) if samples else None,
+            'tips_per_sample': round(sum(r['tips'] for r in runs) / samples, 2) if samples else None,
+            'pause_minutes': round(sum(r['pauses']['seconds'] for r in runs) / 60, 1),
+            'slowest_step': slowest,
+            'slowest_step_seconds': round(sum(step_seconds[slowest]) / len(step_seconds[slowest]), 1)
+            if slowest else None,
+        })
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput trends per station from run reports')
+    parser.add_argument('paths', nargs='+', help='report files or folders')
+    parser.add_argument('--output', help='CSV file to write the trends')
+    args = parser.parse_args()
+
+    rows = trends(read_reports(args.paths))
+    if args.output:
+        with open(args.output, 'w', newline='') as output_file:
+            writer = csv.DictWriter(output_file, TREND_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    for row in rows:
+        print('{station:<8} {protocol:<40} {day} {runs:>3} runs {samples:>5} samples {samples_per_hour} '
+              'samples/h {tips_per_sample} tips/sample, slowest: {slowest_step}'.format(**row))
@@ -0,0 +1,298 @@
+"""
+Offline run-time estimator for ot2 protocols.
+
+The protocol's run(ctx) is executed against a simulating protocol context whose commands are recorded and
+costed with a simple kinematics and flow-rate model. Usage:
+
+    python run_time_estimator.py protocol.py [--set numero_muestras=94] [--model model.json]
+"""
+import argparse
+import ast
+import importlib.util
+import json
+import math
+import re
+import sys
+from collections import OrderedDict
+
+
+# Times in seconds, speeds in mm/s, flow rates in ul/s, temperature rates in ºC/s
+DEFAULT_MODEL = {
+    'xy_speed': 400,
+    'z_speed': 125,
+    'arc_height': 20,                 # z travelled up and down when moving between different labware
+    'move_overhead': 0.3,             # acceleration and settle time for each movement
+    'flow_rate': {},                  # pipette name -> {'aspirate': x, 'dispense': y}, by default pipette's own
+    'pick_up_tip': 4.0,
+    'drop_tip': 3.0,
+    'blow_out': 1.0,
+    'touch_tip': 2.5,
+    'home': 10.0,
+    'magnet_engage': 4.0,
+    'magnet_disengage': 4.0,
+    'temperature_rate': 0.05,
+    'ambient_temperature': 22,
+    'pause': 0,                       # time an operator takes to resume a pause
+}
+
+# Commands emitted by the API that only group other commands
+COMPOSITE_COMMANDS = ['command.MIX', 'command.TRANSFER', 'command.DISTRIBUTE', 'command.CONSOLIDATE',
+                      'command.AIR_GAP']
+
+
+def override_parameters(source, params):
+    """
+    Rewrite top level assignments (protocol parameters) of a protocol [source] code.
+
+    :param source: protocol python code
+    :param params: dict parameter name -> new value
+
+    :return: new source code
+    """
+    tree = ast.parse(source)
+    lines = source.splitlines(True)
+    found = set()
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            # Only the first assignment is the parameter, later ones derive from it
+            if name in params and name not in found:
+                first, last = node.lineno - 1, node.end_lineno - 1
+                comment = re.search(r'\s+#.*$', lines[last][node.end_col_offset:])
+                lines[first] = '{} = {!r}{}\n'.format(name, params[name], comment.group(0).rstrip() if comment else '')
+                for i in range(first + 1, last + 1):
+                    lines[i] = ''
+                found.add(name)
+    missing = set(params) - found
+    if missing:
+        raise ValueError('Parameters not found in protocol: {}'.format(', '.join(sorted(missing))))
+    return ''.join(lines)
+
+
+def load_protocol(path, params=None):
+    """
+    Load a protocol file as a module, optionally overriding its parameters
+    """
+    with open(path, encoding='utf-8') as protocol_file:
+        source = protocol_file.read()
+    if params:
+        source = override_parameters(source, params)
+    spec = importlib.util.spec_from_loader('protocol', loader=None, origin=path)
+    protocol = importlib.util.module_from_spec(spec)
+    protocol.__file__ = path
+    exec(compile(source, path, 'exec'), protocol.__dict__)
+    return protocol
+
+
+def _position(location):
+    if location is None:
+        return None, None
+    if hasattr(location, 'point'):
+        return location.point, location.labware
+    return location.top().point, location
+
+
+def _labware_of(place):
+    while place is not None and hasattr(place, 'parent') and not hasattr(place, 'wells'):
+        place = place.parent
+    return place
+
+
+class RunTimeEstimator:
+    """
+    Record the commands of a simulated protocol run and estimate the time each one takes on the robot
+    """
+
+    def __init__(self, model=None):
+        self.model = dict(DEFAULT_MODEL)
+        self.model.update(model or {})
+        self.steps = OrderedDict()
+        self.commands = {}
+        self.total = 0
+        self._step = 'Setup'
+        self._point = None
+        self._labware = None
+        self._temperature = {}
+        self._ramps = {}
+        self._starting = False
+
+    # ------------------------
+    # Costs
+    # ------------------------
+    def _move(self, location):
+        point, place = _position(location)
+        if point is None:
+            return 0
+        labware = _labware_of(place)
+        if self._point is None:
+            self._point, self._labware = point, labware
+            return 0
+        xy = math.hypot(point.x - self._point.x, point.y - self._point.y)
+        z = abs(point.z - self._point.z)
+        if labware is not self._labware:
+            z += 2 * self.model['arc_height']
+        self._point, self._labware = point, labware
+        if xy == 0 and z == 0:
+            return 0
+        return xy / self.model['xy_speed'] + z / self.model['z_speed'] + self.model['move_overhead']
+
+    def _flow_rate(self, instrument, action):
+        rates = self.model['flow_rate'].get(getattr(instrument, 'name', ''), {})
+        if action in rates:
+            return rates[action]
+        return getattr(instrument.flow_rate, action)
+
+    def cost(self, name, payload):
+        """
+        Estimated seconds for a single command
+        """
+        model = self.model
+        if name in ('command.ASPIRATE', 'command.DISPENSE'):
+            action = 'aspirate' if name == 'command.ASPIRATE' else 'dispense'
+            rate = payload.get('rate') or 1
+            return self._move(payload.get('location')) + \
+                payload['volume'] / (self._flow_rate(payload['instrument'], action) * rate)
+        if name == 'command.PICK_UP_TIP':
+            return self._move(payload.get('location')) + model['pick_up_tip']
+        if name in ('command.DROP_TIP', 'command.RETURN_TIP'):
+            return self._move(payload.get('location')) + model['drop_tip']
+        if name == 'command.BLOW_OUT':
+            return self._move(payload.get('location')) + model['blow_out']
+        if name == 'command.TOUCH_TIP':
+            return model['touch_tip']
+        if name == 'command.MOVE_TO':
+            return self._move(payload.get('location'))
+        if name == 'command.HOME':
+            self._point = None
+            return model['home']
+        if name == 'command.DELAY':
+            return (payload.get('minutes') or 0) * 60 + (payload.get('seconds') or 0)
+        if name == 'command.PAUSE':
+            return model['pause']
+        if name == 'command.MAGDECK_ENGAGE':
+            return model['magnet_engage']
+        if name == 'command.MAGDECK_DISENGAGE':
+            return model['magnet_disengage']
+        if name == 'command.TEMPDECK_SET_TEMP':
+            module = payload.get('module', 'tempdeck')
+            current = self._temperature.get(module, model['ambient_temperature'])
+            self._temperature[module] = payload['celsius']
+            ramp = abs(current - payload['celsius']) / model['temperature_rate']
+            # start_set_temperature publishes the same command but returns at once: the ramp runs during the
+            # next commands and only what is left of it is charged at await_temperature
+            if self._starting:
+                self._ramps[module] = self.total + ramp
+                return 0
+            self._ramps.pop(module, None)
+            return ramp
+        if name == 'command.TEMPDECK_AWAIT_TEMP':
+            end = self._ramps.pop(payload.get('module', 'tempdeck'), None)
+            return max(0, end - self.total) if end is not None else 0
+        return 0
+
+    # ------------------------
+    # Recording
+    # ------------------------
+    def record(self, message):
+        if message.get('$') != 'before':
+            return
+        name = message['name']
+        payload = message.get('payload', {})
+        if name == 'command.COMMENT':
+            self._step = payload.get('text', self._step)
+            return
+        if name in COMPOSITE_COMMANDS:
+            return
+        seconds = self.cost(name, payload)
+        step = self.steps.setdefault(self._step, {'time': 0, 'commands': 0})
+        step['time'] += seconds
+        step['commands'] += 1
+        command = self.commands.setdefault(name.replace('command.', ''), {'time': 0, 'count': 0})
+        command['time'] += seconds
+        command['count'] += 1
+        self.total += seconds
+
+    def _watch_module(self, module):
+        # set_temperature and start_set_temperature publish the same command, tell them apart while recording
+        if not hasattr(module, 'start_set_temperature'):
+            return module
+        start_set_temperature = module.start_set_temperature
+
+        def starting(celsius):
+            self._starting = True
+            try:
+                return start_set_temperature(celsius)
+            finally:
+                self._starting = False
+        module.start_set_temperature = starting
+        return module
+
+    def run(self, protocol):
+        """
+        Execute protocol.run(ctx) in the opentrons simulator recording every command
+        """
+        from opentrons import simulate
+        from opentrons.commands import types as command_types
+
+        api_level = getattr(protocol, 'metadata', {}).get('apiLevel', '2.0')
+        ctx = simulate.get_protocol_api(api_level)
+        load_module = ctx.load_module
+        ctx.load_module = lambda *args, **kwargs: self._watch_module(load_module(*args, **kwargs))
+        unsubscribe = ctx.broker.subscribe(command_types.COMMAND, self.record)
+        try:
+            protocol.run(ctx)
+        finally:
+            unsubscribe()
+        return self
+
+    def report(self, out=sys.stdout):
+        out.write('{:<60} {:>10} {:>10}\n'.format('Step', 'Commands', 'Time'))
+        for step, data in self.steps.items():
+            out.write('{:<60} {:>10} {:>10}\n'.format(step[:60], data['commands'], format_time(data['time'])))
+        out.write('\n{:<60} {:>10} {:>10}\n'.format('Command', 'Count', 'Time'))
+        for command, data in sorted(self.commands.items(), key=lambda c: -c[1]['time']):
+            out.write('{:<60} {:>10} {:>10}\n'.format(command, data['count'], format_time(data['time'])))
+        out.write('\nEstimated total time: {}\n'.format(format_time(self.total)))
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def estimate(path, params=None, model=None):
+    """
+    Estimate the run time of the protocol at [path]
+
+    :param path: protocol file
+    :param params: dict of protocol parameters to override (e.g. {'numero_muestras': 94})
+    :param model: dict overriding DEFAULT_MODEL values
+
+    :return: RunTimeEstimator with the recorded steps
+    """
+    return RunTimeEstimator(model).run(load_protocol(path, params))
+
+
+def parse_parameter(text):
+    name, _, value = text.partition('=')
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name.strip(), value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate how long an ot2 protocol takes on the robot')
+    parser.add_argument('protocol', help='protocol file')
+    parser.add_argument('--set', action='append', default=[], type=parse_parameter, metavar='NAME=VALUE',
+                        help='override a protocol parameter, e.g. --set numero_muestras=94')
+    parser.add_argument('--model', help='json file overriding the default kinematics and flow-rate model')
+    args = parser.parse_args()
+
+    user_model = None
+    if args.model:
+        with open(args.model) as model_file:
+            user_model = json.load(model_file)
+    estimate(args.protocol, dict(args.set), user_model).report()
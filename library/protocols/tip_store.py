@@ -0,0 +1,167 @@
+"""
+Persistent tip state shared by every protocol.
+
+The used tips of each tip rack are kept as a bitmap (bit i set = rack.wells()[i] used) keyed by robot, slot and
+tip rack type, so a new run (or a cancelled one started again) goes on from the first free tip instead of A1.
+The state is saved after every pick up with an atomic replace of the file, so a crash never leaves it half
+written.
+
+Usage:
+    tips = tip_store.TipStore(ctx)
+    tips.attach(p20, m20)       # mark the tips used in previous runs and track the new pick ups
+    ...
+    tips.reset(m20.tip_racks)   # after the racks are replaced
+"""
+import json
+import os
+import socket
+import tempfile
+
+
+DEFAULT_STORE_PATH = '/data/tip_state/tips.json'
+
+
+def rack_key(rack):
+    """
+    Key of a tip rack in the store: '<slot>:<load name>'
+    """
+    return '{}:{}'.format(rack.parent, rack.load_name)
+
+
+def wells_to_bitmap(indexes):
+    bitmap = 0
+    for i in indexes:
+        bitmap |= 1 << i
+    return bitmap
+
+
+def bitmap_to_wells(bitmap):
+    return [i for i in range(bitmap.bit_length()) if bitmap >> i & 1]
+
+
+def write_json(path, data):
+    """
+    Write data to a temporary file and replace path with it, keeping the previous file as .bak, so a crash never
+    leaves a half written file
+    """
+    folder_path = os.path.dirname(path) or '.'
+    if not os.path.isdir(folder_path):
+        os.makedirs(folder_path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder_path, prefix='.' + os.path.basename(path) + '-')
+    with os.fdopen(fd, 'w') as tmp_file:
+        json.dump(data, tmp_file, sort_keys=True)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    if os.path.isfile(path):
+        os.replace(path, path + '.bak')
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    """
+    Read a file written by write_json, falling back to the .bak copy. None if neither can be read
+    """
+    for candidate in (path, path + '.bak'):
+        try:
+            with open(candidate) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+class TipStore:
+    """
+    Tip state of the tip racks of one robot, persisted in a JSON file: {robot: {rack_key: bitmap as hex}}
+
+    :param ctx: protocol context. Nothing is read nor written while simulating
+    :param path: JSON file with the state of every robot
+    :param robot_name: defaults to the host name of the robot
+    """
+
+    def __init__(self, ctx, path=DEFAULT_STORE_PATH, robot_name=None):
+        self.ctx = ctx
+        self.path = path
+        self.robot_name = robot_name or socket.gethostname()
+        self.persistent = not ctx.is_simulating()
+        self.data = (read_json(path) or {}) if self.persistent else {}
+        self.racks = {}
+        self._subscribed = False
+
+    @property
+    def state(self):
+        return self.data.setdefault(self.robot_name, {})
+
+    # ------------------------
+    # File
+    # ------------------------
+    def save(self):
+        if self.persistent:
+            write_json(self.path, self.data)
+
+    # ------------------------
+    # Tip racks
+    # ------------------------
+    def used(self, rack):
+        """
+        Indexes (in rack.wells() order) of the used tips of a rack
+        """
+        return bitmap_to_wells(int(self.state.get(rack_key(rack), '0'), 16))
+
+    def mark_used(self, rack, indexes, save=True):
+        key = rack_key(rack)
+        bitmap = int(self.state.get(key, '0'), 16) | wells_to_bitmap(indexes)
+        self.state[key] = format(bitmap, 'x')
+        if save:
+            self.save()
+
+    def attach(self, *pipettes, reset=False):
+        """
+        Mark as used in the tip racks of the pipettes the tips used by previous runs and record every new pick up
+
+        :param reset: forget the previous runs (the racks are full)
+        """
+        racks = [rack for pipette in pipettes for rack in pipette.tip_racks]
+        if reset:
+            self.reset(racks)
+        for rack in racks:
+            self.racks[rack_key(rack)] = rack
+            wells = rack.wells()
+            for i in self.used(rack):
+                if wells[i].has_tip:
+                    rack.use_tips(wells[i])
+        self._subscribe()
+
+    def reset(self, racks=None):
+        """
+        Mark as full the given tip racks (all of this robot when None)
+        """
+        if racks is None:
+            self.state.clear()
+        else:
+            for rack in racks:
+                self.state.pop(rack_key(rack), None)
+        self.save()
+
+    def _subscribe(self):
+        if self._subscribed:
+            return
+        try:
+            from opentrons.commands import types as command_types
+        except ImportError:
+            return
+        self.ctx.broker.subscribe(command_types.COMMAND, self._on_command)
+        self._subscribed = True
+
+    def _on_command(self, message):
+        if message.get('$') != 'after' or message['name'] != 'command.PICK_UP_TIP':
+            return
+        payload = message.get('payload', {})
+        well = payload.get('location')
+        rack = getattr(well, 'parent', None)
+        if rack is None or rack_key(rack) not in self.racks:
+            return
+        wells = rack.wells()
+        start = wells.index(well)
+        channels = getattr(payload.get('instrument'), 'channels', 1)
+        self.mark_used(rack, range(start, min(start + channels, len(wells))))
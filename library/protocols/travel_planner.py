@@ -0,0 +1,135 @@
+import math
+
+
+# OT-2 deck geometry in mm (front-left corner of each slot, slot 1 at the origin)
+SLOT_PITCH_X = 132.5
+SLOT_PITCH_Y = 90.5
+HOME_POSITION = (418, 353)
+
+
+def slot_origin(slot):
+    """
+    Front-left corner of an OT-2 deck [slot] (1 to 12)
+    """
+    slot = int(slot) - 1
+    return (slot % 3) * SLOT_PITCH_X, (slot // 3) * SLOT_PITCH_Y
+
+
+def xy(location):
+    """
+    XY coordinates of a well, a Location, a (slot, (x, y)) pair relative to the slot or a plain (x, y) tuple
+    """
+    if hasattr(location, 'top'):
+        point = location.top().point
+        return point.x, point.y
+    if hasattr(location, 'point'):
+        return location.point.x, location.point.y
+    if len(location) == 2 and isinstance(location[1], (tuple, list)):
+        origin = slot_origin(location[0])
+        return origin[0] + location[1][0], origin[1] + location[1][1]
+    return location[0], location[1]
+
+
+def distance(a, b):
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+def route_length(transfers, start=HOME_POSITION):
+    """
+    XY distance travelled visiting every (source, destination) of [transfers] in order with the same tip.
+
+    :param transfers: list of (source, destination) already converted with xy()
+    :param start: position of the gantry before the first transfer
+
+    :return: distance in mm
+    """
+    total = 0
+    position = start
+    for source, dest in transfers:
+        total += distance(position, source) + distance(source, dest)
+        position = dest
+    return total
+
+
+def _nearest_neighbour(transfers, start):
+    pending = list(range(len(transfers)))
+    order = []
+    position = start
+    while pending:
+        nxt = min(pending, key=lambda i: distance(position, transfers[i][0]))
+        pending.remove(nxt)
+        order.append(nxt)
+        position = transfers[nxt][1]
+    return order
+
+
+def _two_opt(order, transfers, start, max_passes):
+    # Reversing order[i:j + 1] only changes the hops at its ends and the direction of the hops inside it, the
+    # inside is accumulated while j grows so every candidate costs O(1) and a pass O(n^2)
+    n = len(order)
+    # cost[a][b]: from the destination of transfer a to the source of transfer b, row n is the start position
+    cost = [[distance(dest, source) for source, _ in transfers] for _, dest in transfers]
+    cost.append([distance(start, source) for source, _ in transfers])
+    tour = [n] + list(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n):
+            forward = backward = 0
+            for j in range(i + 1, n + 1):
+                forward += cost[tour[j - 1]][tour[j]]
+                backward += cost[tour[j]][tour[j - 1]]
+                delta = cost[tour[i - 1]][tour[j]] - cost[tour[i - 1]][tour[i]] + backward - forward
+                if j < n:
+                    delta += cost[tour[i]][tour[j + 1]] - cost[tour[j]][tour[j + 1]]
+                if delta < -1e-6:
+                    tour[i:j + 1] = tour[i:j + 1][::-1]
+                    forward, backward = backward, forward
+                    improved = True
+        if not improved:
+            break
+    return tour[1:]
+
+
+def _groups(transfers, priority):
+    groups = {}
+    for i, transfer in enumerate(transfers):
+        groups.setdefault(priority(transfer) if priority else 0, []).append(i)
+    return [groups[key] for key in sorted(groups)]
+
+
+def plan_transfers(transfers, priority=None, start=HOME_POSITION, max_passes=3):
+    """
+    Reorder (source, destination) transfers done with the same tip to minimize the XY travel of the gantry.
+
+    Only useful while the tip is kept: when it is changed on every transfer the gantry goes to the trash and the
+    tip rack in between, and the order barely changes the distance.
+
+    :param transfers: list of (source, destination) pairs. Each element may be a well or anything accepted by xy()
+    :param priority: optional function transfer -> sortable key. Transfers with a lower key are always done
+                     before the others (e.g. controls first), only transfers with the same key are reordered
+    :param start: position of the gantry before the first transfer
+    :param max_passes: maximum number of 2-opt improvement passes for each priority group
+
+    :return: (ordered transfers, original distance in mm, planned distance in mm)
+    """
+    transfers = list(transfers)
+    points = [(xy(s), xy(d)) for s, d in transfers]
+
+    order = []
+    position = start
+    for indexes in _groups(transfers, priority):
+        group_points = [points[i] for i in indexes]
+        group_order = _nearest_neighbour(group_points, position)
+        group_order = _two_opt(group_order, group_points, position, max_passes)
+        order += [indexes[i] for i in group_order]
+        position = group_points[group_order[-1]][1]
+
+    original = route_length(points, start)
+    planned = route_length([points[i] for i in order], start)
+    # Never return something worse than the original order (only sorted by priority)
+    baseline = [i for indexes in _groups(transfers, priority) for i in indexes]
+    baseline_length = route_length([points[i] for i in baseline], start)
+    if baseline_length <= planned:
+        order, planned = baseline, baseline_length
+    return [transfers[i] for i in order], original, planned
+
@@ -0,0 +1,12 @@
+from setuptools import setup
+
+
+setup(
+    name='ot2-covid19-library',
+    version='1.0.0',
+    description='Common functions to abstract the ot2 covid19 protocols',
+    license='GPL-3.0',
+    packages=['library', 'library.protocols'],
+    package_data={'library.protocols': ['catalog.json']},
+    install_requires=['numpy'],
+)
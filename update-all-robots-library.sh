@@ -18,47 +18,18 @@
 # -------------------------
 # Install requirements
 # -------------------------
-# sudo apt install -y sshpass ssh-agent openssh-client
+# sudo apt install -y sshpass ssh-agent openssh-client python3
 
 # -------------------------
 # Constants
 # -------------------------
-IP='192.168.167.'
 export SSHPASS='L@b0r4t010'
 PUBLIC_KEY_PATH='~/ot-ssh-key'
-LOCAL_LIBRARY_PATH='/home/luis/Escritorio/ot2-covid19'
-ROBOT_RP_USER='root'
-ROBOT_LIBRARY_PATH='/root'
-
-SARS=(${IP}'51' ${IP}'52')
-SBRS=(${IP}'54' ${IP}'55' ${IP}'56')
-SCRS=(${IP}'58' ${IP}'59')
-
-ALL_ROBOTS=("${SARS[@]}" "${SBRS[@]}" "${SCRS[@]}")
-
-
-# -------------------------
-# Input processing
-# -------------------------
-if [[ $1 == "a" ]]; then
-    printf "Updating A robots\n\n"
-    TARGETS=("${SARS[@]}")
-elif [[ $1 == "b" ]]; then
-    printf "Updating B robots\n\n"
-    TARGETS=("${SBRS[@]}")
-elif [[ $1 == "c" ]]; then
-    printf "Updating C robots\n\n"
-    TARGETS=("${SCRS[@]}")
-else
-    printf "Updating all robots\n\n"
-    TARGETS=("${ALL_ROBOTS[@]}")
-fi
+LOCAL_REPOSITORY_PATH='/home/luis/Escritorio/ot2-covid19'
 
 
 # -------------------------
-# Updating loop
+# Updating (robots of the group in parallel, only changed files, see library/deploy.py)
 # -------------------------
-for robot_ip in "${TARGETS[@]}"; do
-   echo "updating ~> $robot_ip"
-   sshpass -e scp -i $PUBLIC_KEY_PATH -r $LOCAL_LIBRARY_PATH $ROBOT_RP_USER@$robot_ip:$ROBOT_LIBRARY_PATH
-done
+cd "$LOCAL_REPOSITORY_PATH" || exit 1
+python3 -m library.deploy --site santiago --key "$PUBLIC_KEY_PATH" "${1:-all}" "${@:2}"